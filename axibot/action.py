@@ -4,19 +4,31 @@ from pprint import pformat
 
 
 class Move:
+    # Moves are created in very large numbers, so don't give each one a
+    # __dict__. Subclasses list their fields in __slots__.
+    __slots__ = ()
+
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
     def __repr__(self):
-        return '<%s %s>' % (self.__class__.__name__, pformat(self.__dict__))
+        return '<%s %s>' % (self.__class__.__name__, pformat(self.as_dict()))
 
     def __str__(self):
-        attrs = ['%s:%s' % (k, v) for k, v in self.__dict__.items()]
+        attrs = ['%s:%s' % (k, getattr(self, k)) for k in self.__slots__]
         return '%s %s' % (self.name, ' '.join(attrs))
 
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        return ((self.__class__ == other.__class__) and
+                (self.as_dict() == other.as_dict()))
+
+    def __ne__(self, other):
+        return not self == other
 
 
 class PenUpMove(Move):
     name = 'pen_up'
+    __slots__ = ('delay',)
 
     def __init__(self, delay):
         self.delay = delay
@@ -27,6 +39,7 @@ class PenUpMove(Move):
 
 class PenDownMove(Move):
     name = 'pen_down'
+    __slots__ = ('delay',)
 
     def __init__(self, delay):
         self.delay = delay
@@ -37,6 +50,7 @@ class PenDownMove(Move):
 
 class XYMove(Move):
     name = 'xy_move'
+    __slots__ = ('m1', 'm2', 'duration')
 
     def __init__(self, m1, m2, duration):
         assert isinstance(m1, int), "got %r, wanted an int" % m1
@@ -52,12 +66,26 @@ class XYMove(Move):
         self.m2 = m2
         self.duration = duration
 
+    @classmethod
+    def unchecked(cls, m1, m2, duration):
+        """
+        Create a move without validating its fields, for fields which were
+        already validated when the move was first created, like those stored
+        in a job.
+        """
+        move = cls.__new__(cls)
+        move.m1 = m1
+        move.m2 = m2
+        move.duration = duration
+        return move
+
     def time(self):
         return self.duration
 
 
 class XYAccelMove(Move):
     name = 'xy_accel_move'
+    __slots__ = ('dx', 'dy', 'v_initial', 'v_final')
 
     # XXX These might be better as "m1" and "m2" rather than dx/dy.
     def __init__(self, dx, dy, v_initial, v_final):
@@ -72,6 +100,7 @@ class XYAccelMove(Move):
 
 class ABMove(Move):
     name = 'ab_move'
+    __slots__ = ('da', 'db', 'duration')
 
     def __init__(self, da, db, duration):
         self.da = da
@@ -0,0 +1,194 @@
+"""
+Persistent on-disk cache of planned jobs.
+
+Planning a large document can take a long time, and the result depends only
+on the document itself and the planner settings, a ``planning.PlannerConfig``
+which defaults to the settings in ``axibot.config``. Jobs are stored under a
+hash of both, so replotting the same document is instant, and changing any
+planner setting naturally misses the cache.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+
+import os
+import os.path
+import json
+import hashlib
+import struct
+import tempfile
+
+from six import BytesIO
+
+from . import __version__, config, planning
+from .job import Job
+
+log = logging.getLogger(__name__)
+
+
+SUFFIX = '.axibot.bin'
+
+
+def planner_settings(planner_config=None):
+    """
+    Return a dict of every setting in ``planner_config`` (by default, the
+    current settings), including the version of axibot itself, since changes
+    to the planner change its output.
+    """
+    planner_config = planner_config or planning.PlannerConfig.default()
+    settings = planner_config._asdict()
+    settings['version'] = __version__
+    return settings
+
+
+def cache_key(document, planner_config=None):
+    """
+    Return the hex digest identifying the job planned from ``document`` with
+    ``planner_config``, or the current planner settings.
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps(planner_settings(planner_config),
+                        sort_keys=True).encode('utf-8'))
+    h.update(b'\0')
+    h.update(document.encode('utf-8'))
+    return h.hexdigest()
+
+
+class PlanCache:
+    """
+    A directory of jobs in the binary job format, bounded to ``max_size``
+    bytes by evicting the least recently used entries. Hit and miss counts
+    are kept alongside the jobs so they accumulate across runs.
+    """
+    def __init__(self, directory=None, max_size=None):
+        self.directory = directory or config.CACHE_DIR
+        self.max_size = max_size or config.CACHE_MAX_SIZE
+
+    def path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    @property
+    def stats_path(self):
+        return os.path.join(self.directory, 'stats.json')
+
+    def entries(self):
+        """
+        Return a list of (mtime, size, path) for each cached job, least
+        recently used first.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        out = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SUFFIX):
+                path = os.path.join(self.directory, name)
+                st = os.stat(path)
+                out.append((st.st_mtime, st.st_size, path))
+        out.sort()
+        return out
+
+    def stats(self):
+        """
+        Return a dict of cache statistics.
+        """
+        try:
+            with open(self.stats_path) as f:
+                stats = json.load(f)
+        except (IOError, OSError, ValueError):
+            stats = {'hits': 0, 'misses': 0}
+        entries = self.entries()
+        stats['entries'] = len(entries)
+        stats['size'] = sum(size for mtime, size, path in entries)
+        return stats
+
+    def record(self, name):
+        stats = self.stats()
+        stats[name] += 1
+        try:
+            self.write_atomic(self.stats_path, json.dumps(
+                {'hits': stats['hits'], 'misses': stats['misses']}))
+        except (IOError, OSError) as e:
+            log.debug("Could not record cache stats: %s", e)
+
+    def write_atomic(self, path, data):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def get(self, document, filename=None, planner_config=None):
+        """
+        Return the cached job for ``document``, or None on a cache miss. The
+        job is memory-mapped, so even a very large cached plan loads
+        instantly.
+        """
+        path = self.path(cache_key(document, planner_config))
+        try:
+            job = Job.deserialize_binary(path)
+        except (IOError, OSError):
+            self.record('misses')
+            return None
+        except (ValueError, struct.error):
+            log.warn("Discarding corrupt cache entry %s.", path)
+            os.remove(path)
+            self.record('misses')
+            return None
+        # Mark as recently used.
+        os.utime(path, None)
+        self.record('hits')
+        if filename:
+            job.filename = filename
+        return job
+
+    def put(self, document, job, planner_config=None):
+        """
+        Store ``job`` as the plan for ``document``, then evict old entries.
+        """
+        path = self.path(cache_key(document, planner_config))
+        f = BytesIO()
+        job.serialize_binary(f)
+        self.write_atomic(path, f.getvalue())
+        self.evict()
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            log.debug("Evicting %s from plan cache.", path)
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        for mtime, size, path in self.entries():
+            os.remove(path)
+        if os.path.exists(self.stats_path):
+            os.remove(self.stats_path)
+
+
+def plan_job(document, filename, cache=None, planner_config=None, **kwargs):
+    """
+    Like ``planning.plan_job()``, but return a cached job if there is one,
+    and cache the job otherwise. Pass ``cache=False`` to bypass the cache.
+    """
+    planner_config = planner_config or planning.PlannerConfig.default()
+    if cache is False:
+        return planning.plan_job(document, filename,
+                                 planner_config=planner_config, **kwargs)
+    cache = cache or PlanCache()
+    job = cache.get(document, filename=filename,
+                    planner_config=planner_config)
+    if job is not None:
+        log.info("Using cached plan for %s.", filename)
+        return job
+    job = planning.plan_job(document, filename,
+                            planner_config=planner_config, **kwargs)
+    try:
+        cache.put(document, job, planner_config)
+    except (IOError, OSError) as e:
+        log.warn("Could not cache plan for %s: %s", filename, e)
+    return job
@@ -0,0 +1,122 @@
+"""
+Crash-safe checkpoints of plotting progress.
+
+While a job is plotting, the index of the last action acknowledged by the
+EiBotBoard is periodically written to disk, along with the pen state and
+position at that point. If the host dies mid-plot, the job can be resumed from
+the checkpoint rather than restarted from scratch.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+
+import os
+import os.path
+import json
+import time
+import tempfile
+
+from . import config
+
+log = logging.getLogger(__name__)
+
+
+def default_path():
+    return os.path.join(config.CHECKPOINT_DIR, 'checkpoint.json')
+
+
+def load(path=None):
+    """
+    Return the checkpoint saved at ``path`` as a dict, or None if there isn't
+    one.
+    """
+    path = path or default_path()
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError):
+        return None
+    except ValueError:
+        log.warn("Ignoring corrupt checkpoint %s.", path)
+        return None
+
+
+def fsync_write(path, data):
+    """
+    Atomically replace the file at ``path`` with ``data``, making sure it has
+    reached the disk before returning.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        # Not all platforms can open a directory to sync it.
+        return
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class Checkpointer:
+    """
+    Records plotting progress through ``job``. Call ``update()`` after every
+    action: the checkpoint is only written if at least ``interval`` seconds
+    have passed since the last write, so this is cheap to do.
+
+    ``job_hash`` identifies the job, defaulting to its content hash. A job
+    which is still being planned as it's plotted doesn't have one yet, but
+    planning is deterministic, so it can be identified by the plan cache key
+    of its document instead.
+    """
+    def __init__(self, job, path=None, interval=None, job_hash=None):
+        self.job = job
+        self.job_hash = job_hash or job.content_hash()
+        self.path = path or default_path()
+        if interval is None:
+            interval = config.CHECKPOINT_INTERVAL
+        self.interval = interval
+        self.last_write = None
+
+    def matches(self, checkpoint):
+        """
+        Return True if ``checkpoint`` was saved while plotting this job.
+        """
+        return bool(checkpoint) and checkpoint['job_hash'] == self.job_hash
+
+    def update(self, action_index, force=False):
+        """
+        Note that every action before ``action_index`` has been completed.
+        """
+        now = time.monotonic()
+        if (force or (self.last_write is None) or
+                (now - self.last_write) >= self.interval):
+            self.write(action_index)
+            self.last_write = now
+
+    def write(self, action_index):
+        job = self.job
+        state = {
+            'job_hash': self.job_hash,
+            'filename': job.filename,
+            'action_index': action_index,
+            'pen_up': job.pen_up_at(action_index),
+            'position': job.position_at(action_index),
+        }
+        fsync_write(self.path, json.dumps(state).encode('utf-8'))
+
+    def clear(self):
+        """
+        Remove the checkpoint, once the job has completed or been canceled.
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
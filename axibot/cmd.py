@@ -15,7 +15,7 @@ try:
 except ImportError:
     coloredlogs = None
 
-from . import planning, config
+from . import planning, config, cache, checkpoint, profile
 from .ebb import EiBotBoard, MockEiBotBoard
 from .job import Job
 
@@ -35,6 +35,82 @@ def manual_command(bot, cmd):
         log.error("Error: %s", e)
 
 
+def ask(question, default):
+    answer = input(question).strip().lower()
+    if not answer:
+        return default
+    return answer.startswith('y')
+
+
+def calibrate(opts, bot):
+    """
+    Find the shortest pen delays which work reliably on this machine, by
+    plotting test marks and asking whether they came out right, and save
+    them in the profile.
+
+    Each pen down test draws a short line, which should be as long as the
+    first one, drawn with a generous delay: if the pen lands late, the start
+    is missing. Each pen up test leaves a dot and moves off: if the pen leaves
+    the paper late, there's a streak after the dot.
+    """
+    name = opts.profile or config.PROFILE
+    dist = config.PEN_UP_POSITION - config.PEN_DOWN_POSITION
+    # Twice the time the servo should take is assumed to be reliable.
+    max_up_delay = 2 * int((1000. * dist) / config.SERVO_SPEED)
+    max_down_delay = 2 * int((1000. * dist) / config.SERVO_DOWN_SPEED)
+
+    def next_mark():
+        # 0.2" to the right while testing, then back and 0.1" down.
+        bot.xy_move(400, 400, 100)
+        bot.pen_up(max_up_delay)
+        bot.xy_move(-200, -600, 300)
+
+    def pen_down_reliable(delay):
+        bot.pen_down(delay)
+        next_mark()
+        return ask("Is the last line as long as the first one? [Y/n] ", True)
+
+    def pen_up_reliable(delay):
+        bot.pen_down(max_down_delay)
+        bot.pen_up(delay)
+        next_mark()
+        return not ask("Is there a streak after the last dot? [y/N] ", False)
+
+    bot.pen_up(max_up_delay)
+    input("Put paper under the pen, and press enter to begin.")
+    bot.enable_motors(1)
+    bot.pen_down(max_down_delay)
+    next_mark()
+    pen_down_delay = profile.shortest_delay(pen_down_reliable, 0,
+                                            max_down_delay)
+    pen_up_delay = profile.shortest_delay(pen_up_reliable, 0, max_up_delay)
+    bot.disable_motors()
+
+    # Save the delays as corrections to the delay model, so they still apply
+    # if the pen positions are adjusted a little.
+    margin = config.CALIBRATION_MARGIN
+    planner_config = planning.PlannerConfig.default()._replace(
+        extra_pen_up_delay=0, extra_pen_down_delay=0)
+    model_up_delay, model_down_delay = planning.calculate_pen_delays(
+        config.PEN_UP_POSITION, config.PEN_DOWN_POSITION, config.SERVO_SPEED,
+        planner_config, config.SERVO_DOWN_SPEED)
+    settings = profile.load(name) or {}
+    settings.update({
+        'SERVO_SPEED': config.SERVO_SPEED,
+        'SERVO_DOWN_SPEED': config.SERVO_DOWN_SPEED,
+        'PEN_UP_POSITION': config.PEN_UP_POSITION,
+        'PEN_DOWN_POSITION': config.PEN_DOWN_POSITION,
+        'EXTRA_PEN_UP_DELAY': pen_up_delay + margin - model_up_delay,
+        'EXTRA_PEN_DOWN_DELAY': pen_down_delay + margin - model_down_delay,
+    })
+    profile.save(name, settings)
+    profile.apply(settings)
+    log.info("Pen up delay: %d ms, pen down delay: %d ms (was %d and %d).",
+             pen_up_delay + margin, pen_down_delay + margin,
+             model_up_delay, model_down_delay)
+    log.info("Saved profile %s.", profile.profile_path(name))
+
+
 def manual(opts):
     if opts.mock:
         bot = MockEiBotBoard()
@@ -42,8 +118,10 @@ def manual(opts):
         bot = EiBotBoard.find()
     try:
         bot.servo_setup(config.PEN_DOWN_POSITION, config.PEN_UP_POSITION,
-                        config.SERVO_SPEED, config.SERVO_SPEED)
-        if opts.cmd:
+                        config.SERVO_SPEED, config.SERVO_DOWN_SPEED)
+        if opts.calibrate:
+            calibrate(opts, bot)
+        elif opts.cmd:
             cmd = ' '.join(opts.cmd)
             manual_command(bot, cmd)
         else:
@@ -70,47 +148,57 @@ def human_friendly_timedelta(td):
     return ", ".join(pieces)
 
 
-def load_job(filename):
+def load_job(filename, use_cache=True, workers=None):
     if filename.endswith('.svg'):
         with open(filename) as f:
-            return planning.plan_job(f.read(), filename)
+            return cache.plan_job(f.read(), filename,
+                                  cache=None if use_cache else False,
+                                  workers=workers)
     elif filename.endswith('.axibot.json'):
         with open(filename) as f:
             return Job.deserialize(f)
+    elif filename.endswith('.axibot.bin'):
+        return Job.deserialize_binary(filename)
     else:
-        print("Only .svg and .axibot.json files are supported!")
+        print("Only .svg, .axibot.json and .axibot.bin files are supported!")
         raise SystemExit
 
 
 def plan(opts):
     outfile = opts.out
     if not outfile:
-        outfile = opts.filename.rsplit('.', 1)[0] + '.axibot.json'
+        for suffix in ('.axibot.json', '.axibot.bin', '.svg'):
+            if opts.filename.endswith(suffix):
+                base = opts.filename[:-len(suffix)]
+                break
+        else:
+            base = opts.filename.rsplit('.', 1)[0]
+        outfile = base + ('.axibot.bin' if opts.binary else '.axibot.json')
     if os.path.exists(outfile) and not opts.overwrite:
         print("File '%s' exists, pass --overwrite or --out." % outfile)
     else:
-        job = load_job(opts.filename)
-        with open(outfile, 'w') as f:
-            job.serialize(f)
+        job = load_job(opts.filename, use_cache=opts.cache,
+                       workers=opts.workers)
+        if outfile.endswith('.axibot.bin'):
+            with open(outfile, 'wb') as f:
+                job.serialize_binary(f)
+        else:
+            with open(outfile, 'w') as f:
+                job.serialize(f)
 
 
 def info(opts):
-    job = load_job(opts.filename)
+    job = load_job(opts.filename, use_cache=opts.cache, workers=opts.workers)
     td = job.duration()
     log.info("Number of moves: %s", len(job))
     log.info("Expected time: %s", human_friendly_timedelta(td))
 
 
-def plot(opts):
-    job = load_job(opts.filename)
-    count = len(job)
-    log.info("Loaded %d actions.", count)
-
-    pen_up_delay, pen_down_delay = \
-        planning.calculate_pen_delays(job.pen_up_position,
-                                      job.pen_down_position,
-                                      job.servo_speed)
-
+def open_bot(opts, pen_up_delay):
+    """
+    Connect to the bot, lift the pen, and wait for the carriage to be moved
+    to the origin.
+    """
     if opts.mock:
         bot = MockEiBotBoard()
     else:
@@ -122,34 +210,193 @@ def plot(opts):
         log.info("Configuring servos.")
         bot.disable_motors()
         bot.servo_setup(config.PEN_DOWN_POSITION, config.PEN_UP_POSITION,
-                        config.SERVO_SPEED, config.SERVO_SPEED)
+                        config.SERVO_SPEED, config.SERVO_DOWN_SPEED)
         log.info("Pen up and motors off. Move carriage to top left corner.")
         input("Press enter to begin.")
+    except BaseException:
+        bot.close()
+        raise
+    return bot
+
+
+def finish_plot(opts, bot, start_time, estimated_td):
+    end_time = time.time()
+    actual_td = timedelta(seconds=(end_time - start_time))
+    print("Finished!")
+    print("Expected time: %s" % human_friendly_timedelta(estimated_td))
+    print("Actual time: %s" % human_friendly_timedelta(actual_td))
+    if opts.mock:
+        print("---")
+        print("Mock EiBotBoard recorded:")
+        print("Max speed: %0.3f steps/ms" % bot.max_speed)
+        print("Max acceleration: %0.3f steps/ms delta" %
+              bot.max_acceleration)
+
+
+def plot(opts):
+    job_hash = None
+    if opts.filename.endswith('.svg'):
+        with open(opts.filename) as f:
+            document = f.read()
+        # Checkpoints of a document are identified by its plan cache key, so
+        # that a plot streamed while it was planned can be resumed.
+        job_hash = cache.cache_key(document)
+        plan_cache = cache.PlanCache() if opts.cache else None
+        job = plan_cache and plan_cache.get(document, opts.filename)
+        if job is None:
+            if not opts.resume:
+                return plot_stream(opts, document, plan_cache, job_hash)
+            job = planning.plan_job(document, opts.filename,
+                                    workers=opts.workers)
+            if plan_cache:
+                try:
+                    plan_cache.put(document, job)
+                except (IOError, OSError) as e:
+                    log.warn("Could not cache plan for %s: %s",
+                             opts.filename, e)
+    else:
+        job = load_job(opts.filename, use_cache=opts.cache,
+                       workers=opts.workers)
+    count = len(job)
+    log.info("Loaded %d actions.", count)
+
+    pen_up_delay, pen_down_delay = \
+        planning.calculate_pen_delays(job.pen_up_position,
+                                      job.pen_down_position,
+                                      job.servo_speed,
+                                      servo_down_speed=job.servo_down_speed)
+
+    checkpointer = checkpoint.Checkpointer(job, job_hash=job_hash)
+    start_index = 0
+    if opts.resume:
+        saved = checkpoint.load()
+        if checkpointer.matches(saved):
+            start_index = saved['action_index']
+            log.info("Resuming from action %d/%d.", start_index, count)
+        else:
+            log.warn("No checkpoint for this job, starting from the "
+                     "beginning.")
 
+    bot = open_bot(opts, pen_up_delay)
+    try:
         start_time = time.time()
         bot.enable_motors(1)
 
-        for ii, move in enumerate(job):
-            log.info("Move %d/%d: %s" % (ii, count, move))
-            bot.do(move)
+        if start_index:
+            # Travel from the origin to where we left off, and accelerate
+            # back up to the planned speed from there.
+            for move in planning.plan_seek((0, 0), True,
+                                           job.position_at(start_index),
+                                           job.pen_up_at(start_index),
+                                           pen_up_delay=pen_up_delay,
+                                           pen_down_delay=pen_down_delay):
+                bot.do(move)
+            ramp, start_index = planning.plan_resume(job, start_index)
+            for move in ramp:
+                bot.do(move)
+
+        ii = start_index
+        try:
+            for ii in range(start_index, count):
+                move = job[ii]
+                log.info("Move %d/%d: %s" % (ii, count, move))
+                bot.do(move)
+                checkpointer.update(ii + 1)
+        except BaseException:
+            # Including KeyboardInterrupt: save exactly where we got to.
+            checkpointer.update(ii, force=True)
+            log.warn("Plotting stopped at action %d/%d. Resume with "
+                     "'axibot plot --resume'.", ii, count)
+            raise
+        checkpointer.clear()
 
         bot.pen_up(pen_up_delay)
-        end_time = time.time()
-        estimated_td = job.duration()
-        actual_td = timedelta(seconds=(end_time - start_time))
-        print("Finished!")
-        print("Expected time: %s" % human_friendly_timedelta(estimated_td))
-        print("Actual time: %s" % human_friendly_timedelta(actual_td))
-        if opts.mock:
-            print("---")
-            print("Mock EiBotBoard recorded:")
-            print("Max speed: %0.3f steps/ms" % bot.max_speed)
-            print("Max acceleration: %0.3f steps/ms delta" %
-                  bot.max_acceleration)
+        finish_plot(opts, bot, start_time, job.duration())
     finally:
         bot.close()
 
 
+def plot_stream(opts, document, plan_cache=None, job_hash=None):
+    """
+    Plot an SVG document while it is still being planned, so that plotting
+    can start as soon as the first segments are ready. The planner runs ahead
+    in the background, by up to ``config.PLAN_BUFFER_SIZE`` segments.
+
+    The plotted actions are collected into a job, which is cached once the
+    whole document has been plotted. Progress is checkpointed under
+    ``job_hash``, the plan cache key of the document, so that
+    ``axibot plot --resume`` can replan the same job and carry on from there.
+    """
+    planner_config = planning.PlannerConfig.default()
+    pen_up_delay, pen_down_delay = \
+        planning.calculate_pen_delays(planner_config.pen_up_position,
+                                      planner_config.pen_down_position,
+                                      planner_config.servo_speed,
+                                      planner_config,
+                                      planner_config.servo_down_speed)
+    job = Job(pen_up_position=planner_config.pen_up_position,
+              pen_down_position=planner_config.pen_down_position,
+              servo_speed=planner_config.servo_speed,
+              servo_down_speed=planner_config.servo_down_speed,
+              document=document,
+              filename=opts.filename)
+    # Start planning straight away, so it gets a head start while the
+    # carriage is positioned.
+    segments = planning.PlanBuffer(
+        planning.stream_segment_actions(document,
+                                        pen_up_delay=pen_up_delay,
+                                        pen_down_delay=pen_down_delay,
+                                        planner_config=planner_config))
+    checkpointer = checkpoint.Checkpointer(
+        job, job_hash=job_hash or cache.cache_key(document, planner_config))
+    try:
+        bot = open_bot(opts, pen_up_delay)
+        try:
+            start_time = time.time()
+            bot.enable_motors(1)
+            try:
+                for actions in segments:
+                    for move in actions:
+                        log.info("Move %d: %s" % (len(job), move))
+                        bot.do(move)
+                        job.append(move)
+                        checkpointer.update(len(job))
+            except BaseException:
+                # Including KeyboardInterrupt: save exactly where we got to.
+                checkpointer.update(len(job), force=True)
+                log.warn("Plotting stopped at action %d. Resume with "
+                         "'axibot plot --resume'.", len(job))
+                raise
+            checkpointer.clear()
+            bot.pen_up(pen_up_delay)
+            finish_plot(opts, bot, start_time, job.duration())
+        finally:
+            bot.close()
+    finally:
+        segments.close()
+
+    if plan_cache:
+        try:
+            plan_cache.put(document, job, planner_config)
+        except (IOError, OSError) as e:
+            log.warn("Could not cache plan for %s: %s", opts.filename, e)
+
+
+def cache_command(opts):
+    plan_cache = cache.PlanCache()
+    if opts.clear:
+        plan_cache.clear()
+        log.info("Cleared plan cache in %s.", plan_cache.directory)
+    stats = plan_cache.stats()
+    lookups = stats['hits'] + stats['misses']
+    log.info("Plan cache: %s", plan_cache.directory)
+    log.info("Entries: %d, %0.1f MB of %0.1f MB", stats['entries'],
+             stats['size'] / 1e6, plan_cache.max_size / 1e6)
+    log.info("Hits: %d, misses: %d (%0.1f%% hit rate)",
+             stats['hits'], stats['misses'],
+             (100. * stats['hits'] / lookups) if lookups else 0)
+
+
 def server(opts):
     from axibot.server import serve
     serve(opts)
@@ -159,6 +406,13 @@ def main(args=sys.argv):
     p = argparse.ArgumentParser(description='Print with the AxiDraw.')
     p.add_argument('--verbose', action='store_true')
     p.add_argument('--mock', action='store_true')
+    p.add_argument('--no-cache', dest='cache', action='store_false',
+                   help='Always re-plan SVG files, bypassing the plan cache.')
+    p.add_argument('--workers', type=int,
+                   help='Number of processes to plan SVG files with.')
+    p.add_argument('--profile',
+                   help='Name of the machine profile to use, instead of '
+                   '"%s".' % config.PROFILE)
     p.set_defaults(function=None)
 
     subparsers = p.add_subparsers(help='sub-command help')
@@ -168,11 +422,15 @@ def main(args=sys.argv):
     p_plan.add_argument('filename')
     p_plan.add_argument('--out')
     p_plan.add_argument('--overwrite', action='store_true')
+    p_plan.add_argument('--binary', action='store_true',
+                        help='Write the compact .axibot.bin format.')
     p_plan.set_defaults(function=plan)
 
     p_plot = subparsers.add_parser(
         'plot', help='Plot an SVG file directly.')
     p_plot.add_argument('filename')
+    p_plot.add_argument('--resume', action='store_true',
+                        help='Resume from the last checkpoint of this job.')
     p_plot.set_defaults(function=plot)
 
     p_info = subparsers.add_parser(
@@ -188,8 +446,17 @@ def main(args=sys.argv):
     p_manual = subparsers.add_parser(
         'manual', help='Manual control shell.')
     p_manual.add_argument('cmd', nargs='*')
+    p_manual.add_argument('--calibrate', action='store_true',
+                          help='Measure the shortest reliable pen delays, '
+                          'and save them in the profile.')
     p_manual.set_defaults(function=manual)
 
+    p_cache = subparsers.add_parser(
+        'cache', help='Show plan cache statistics.')
+    p_cache.add_argument('--clear', action='store_true',
+                         help='Remove all cached plans.')
+    p_cache.set_defaults(function=cache_command)
+
     opts, args = p.parse_known_args(args[1:])
 
     if coloredlogs:
@@ -198,6 +465,11 @@ def main(args=sys.argv):
         logging.basicConfig(level=logging.DEBUG if opts.verbose else
                             logging.INFO)
 
+    if profile.activate(opts.profile):
+        log.debug("Using profile %s.", opts.profile or config.PROFILE)
+    elif opts.profile and not getattr(opts, 'calibrate', False):
+        log.warn("No profile named %s.", opts.profile)
+
     if opts.function:
         return opts.function(opts)
     else:
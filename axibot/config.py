@@ -1,18 +1,29 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
+import os.path
+
 MAX_RETRIES = 100
 
 # These are unitless timing values used by the EBB.
 SERVO_MIN = 7500
 SERVO_MAX = 28000
 
-# Default
+# Servo speeds for raising and lowering the pen. These can differ, since the
+# servo has to lift the weight of the pen on the way up.
 SERVO_SPEED = 150
+SERVO_DOWN_SPEED = SERVO_SPEED
 
 # Milliseconds?
 EXTRA_PEN_UP_DELAY = 0
 EXTRA_PEN_DOWN_DELAY = 0
 
+# Travel with the pen up starts before the pen-up servo move has finished,
+# once the pen has cleared the paper. It's clear after this fraction of the
+# move, since it only has to lift a little, and travel waits a safety margin
+# in milliseconds after that. A fraction of 1 waits for the whole move.
+PEN_CLEAR_FRACTION = 0.25
+PEN_CLEAR_MARGIN = 20
+
 SPEED_SCALE = 24.950  # ticks per millisecond
 
 # Milliseconds of acceleration to reach full speed with pen down.
@@ -27,6 +38,34 @@ ACCEL_TIME_PEN_UP = 1000
 # Speed in ticks per millisecond.
 SPEED_PEN_UP = 0.75 * SPEED_SCALE
 
+# Speed in ticks per millisecond that the motors can start from and stop from
+# instantly, without missing steps. Moves start and end at this speed rather
+# than from rest, and it is the most the velocity may change through a corner.
+# To calibrate a machine, raise it until short jabs with the pen down start to
+# lose position, then back off by half, and save it in the machine's profile.
+# Zero always starts from rest, so it's the default for uncalibrated machines.
+JUMP_SPEED = 0
+
+# Limit speed and acceleration per motor instead of along the path. The AxiDraw
+# drives its motors by m1 = dx + dy and m2 = dx - dy, so a 45 degree move steps
+# one motor 1.4 times faster than the pen moves, while an axis-aligned move
+# steps both motors at the pen speed. With this set, the speeds and
+# accelerations above are what the busier motor reaches on a diagonal, which
+# lets moves in every other direction run faster.
+MOTOR_LIMITS = False
+
+# Fastest that the EiBotBoard can step each motor, in ticks per millisecond.
+# With MOTOR_LIMITS, speed limits are capped so that neither motor ever steps
+# faster than this. Without, only a feed-rate override is capped, and never
+# below the speed the move would have without it.
+MAX_STEP_RATE = SPEED_SCALE
+
+# Milliseconds over which the acceleration itself ramps up or down, for
+# jerk-limited S-curve speed profiles. These avoid the carriage ringing caused
+# by abrupt changes in acceleration, which should allow shorter acceleration
+# times. Zero uses constant-acceleration trapezoidal profiles.
+JERK_TIME = 0
+
 # Short-move pen-up distance threshold in inches, below which we use the faster
 # pen-down acceleration rate.
 SHORT_THRESHOLD = 1.0
@@ -40,9 +79,90 @@ TIME_SLICE = 30
 # Smoothness of curves. Units are inches.
 CURVE_RESOLUTION = 0.02
 
-# Skip pen-up moves shorter than this distance when possible. Units in inches.
+# Simplify paths so that they deviate by no more than this distance, dropping
+# points which the motors or the pen can't reproduce anyway. Units in inches:
+# 0.0005" is about one motor step. Zero disables simplification.
+SIMPLIFY_TOLERANCE = 0
+
+# Skip pen-up moves shorter than this distance when possible, by dragging the
+# pen across the gap. Units in inches.
 MIN_GAP = 0.010
 
+# Drop points which are within this distance of a straight line through the
+# points either side of them, so that nearly straight runs are planned as a
+# single move. Units in inches: 0.0005" is about one motor step. This helps
+# with densely digitized input, but on smooth curves it gathers many gentle
+# corners into fewer sharper ones, which the cornering speeds take more
+# slowly, so it's off (zero) by default.
+COLLINEAR_TOLERANCE = 0
+
+# Remove the parts of straight lines which retrace lines already drawn, to
+# the nearest motor step, such as the shared edges of tiles or polygons. This
+# saves time and ink, but also removes lines deliberately drawn twice.
+REMOVE_OVERLAPS = False
+
+# Join paths whose endpoints are within this distance of each other, so that
+# strokes split into many paths are plotted continuously. Units in inches.
+# Joining reverses paths and changes the order they're drawn in, so it's off
+# (None) by default.
+JOIN_TOLERANCE = None
+
+# Only drag the pen across gaps which retrace lines already drawn, to within
+# BRIDGE_TOLERANCE inches, so that bridging never adds ink.
+BRIDGE_INKED_ONLY = False
+BRIDGE_TOLERANCE = 0.002
+
+# Maximum distance in inches that the plotted path may deviate from a curve
+# when merging moves too short to plot at full speed. This changes the shape
+# of finely subdivided curves, so it's off (zero) by default.
+CHORD_TOLERANCE = 0
+
 # Positions in arbitrary servo range units, from 0 to 100.
 PEN_UP_POSITION = 60
 PEN_DOWN_POSITION = 50
+
+# Directory of per-machine profiles, which override settings in this module
+# with values calibrated for a particular AxiDraw, and the profile to use.
+PROFILE_DIR = os.path.join(os.path.expanduser('~'), '.config', 'axibot',
+                           'profiles')
+PROFILE = 'default'
+
+# Milliseconds added to the shortest reliable pen delays found by calibration.
+CALIBRATION_MARGIN = 10
+
+# Directory to cache planned jobs in, keyed by document and planner settings.
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'axibot')
+
+# Maximum total size of cached jobs in bytes, beyond which the least recently
+# used jobs are evicted.
+CACHE_MAX_SIZE = 256 * 1024 * 1024
+
+# Directory to keep plotting checkpoints in, for resuming after a crash.
+CHECKPOINT_DIR = os.path.join(os.path.expanduser('~'), '.local', 'share',
+                              'axibot')
+
+# Minimum interval in seconds between checkpoint writes while plotting.
+CHECKPOINT_INTERVAL = 2.0
+
+# Bounds for the runtime feed-rate override, as a fraction of planned speed.
+SPEED_OVERRIDE_MIN = 0.5
+SPEED_OVERRIDE_MAX = 1.5
+
+# Number of upcoming segments to replan at a time when the feed-rate override
+# is in effect.
+REPLAN_WINDOW = 20
+
+# Number of planned segments to buffer ahead of the plotter when plotting a
+# document while it is still being planned.
+PLAN_BUFFER_SIZE = 64
+
+# Seconds for the plotter to wait before checking again for newly planned
+# actions, when it has caught up with the planner.
+PLAN_WAIT = 0.05
+
+# Number of processes to plan segments in. Planning in parallel gives the
+# same result, but only pays off for large documents on multi-core machines.
+PLANNER_WORKERS = 1
+
+# Number of distinct move interpolations to remember while planning.
+INTERPOLATION_CACHE_SIZE = 16384
@@ -27,7 +27,7 @@ def debug_paths(opts):
     with open(opts.filename) as f:
         svg_str = f.read()
     paths = svg.extract_paths(svg_str)
-    paths = svg.preprocess_paths(paths)
+    paths = svg.preprocess_paths(paths, config.JOIN_TOLERANCE)
     for path in paths:
         xdata = []
         ydata = []
@@ -48,7 +48,7 @@ def debug_segments(opts):
     with open(opts.filename) as f:
         svg_str = f.read()
     paths = svg.extract_paths(svg_str)
-    paths = svg.preprocess_paths(paths)
+    paths = svg.preprocess_paths(paths, config.JOIN_TOLERANCE)
     segments = svg.plan_segments(paths, resolution=config.CURVE_RESOLUTION)
 
     xdata = []
@@ -67,7 +67,7 @@ def debug_connected_segments(opts):
     with open(opts.filename) as f:
         svg_str = f.read()
     paths = svg.extract_paths(svg_str)
-    paths = svg.preprocess_paths(paths)
+    paths = svg.preprocess_paths(paths, config.JOIN_TOLERANCE)
     segments = svg.plan_segments(paths, resolution=config.CURVE_RESOLUTION)
     segments = svg.add_pen_up_moves(segments)
 
@@ -86,7 +86,7 @@ def debug_corners(opts):
     with open(opts.filename) as f:
         svg_str = f.read()
     paths = svg.extract_paths(svg_str)
-    paths = svg.preprocess_paths(paths)
+    paths = svg.preprocess_paths(paths, config.JOIN_TOLERANCE)
     segments = svg.plan_segments(paths, resolution=config.CURVE_RESOLUTION)
     segments = svg.add_pen_up_moves(segments)
     step_segments = planning.convert_inches_to_steps(segments)
@@ -147,7 +147,7 @@ def generate_actions(opts):
     with open(opts.filename) as f:
         svg_str = f.read()
     paths = svg.extract_paths(svg_str)
-    paths = svg.preprocess_paths(paths)
+    paths = svg.preprocess_paths(paths, config.JOIN_TOLERANCE)
     segments = svg.plan_segments(paths, resolution=config.CURVE_RESOLUTION)
     segments = svg.add_pen_up_moves(segments)
     step_segments = planning.convert_inches_to_steps(segments)
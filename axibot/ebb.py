@@ -18,7 +18,7 @@ class EiBotException(Exception):
 
 class EiBotBase:
     def do(self, move):
-        kw = move.__dict__.copy()
+        kw = move.as_dict()
         name = move.name
         if name in ('pen_up', 'pen_down',
                     'xy_accel_move', 'xy_move',
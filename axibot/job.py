@@ -2,39 +2,373 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
 from datetime import timedelta
+from array import array
+from collections.abc import MutableSequence
+import hashlib
 import json
+import struct
+
+import numpy as np
 
 from .action import PenUpMove, PenDownMove, XYMove, XYAccelMove, ABMove
 
 
-class Job(list):
+# Binary job files start with this magic string, followed by a little-endian
+# uint32 length of the JSON metadata and a uint64 count of action records.
+# After the metadata come the packed, fixed-width action records.
+BINARY_MAGIC = b'AXIBOT\x00\x01'
+BINARY_HEADER = struct.Struct('<8sIQ')
+
+# One packed record per action. Pen moves store their delay in ``time`` and
+# leave m1/m2 zeroed.
+ACTION_DTYPE = np.dtype([('kind', 'u1'),
+                         ('m1', '<i4'),
+                         ('m2', '<i4'),
+                         ('time', '<i4')])
+
+KIND_PEN_UP = 0
+KIND_PEN_DOWN = 1
+KIND_XY_MOVE = 2
+KIND_AB_MOVE = 3
+
+
+def action_to_record(action):
+    """
+    Return a (kind, m1, m2, time) tuple for ``action``.
+    """
+    if isinstance(action, PenUpMove):
+        fields = (KIND_PEN_UP, 0, 0, action.delay)
+    elif isinstance(action, PenDownMove):
+        fields = (KIND_PEN_DOWN, 0, 0, action.delay)
+    elif isinstance(action, XYMove):
+        fields = (KIND_XY_MOVE, action.m1, action.m2, action.duration)
+    elif isinstance(action, ABMove):
+        fields = (KIND_AB_MOVE, action.da, action.db, action.duration)
+    else:
+        raise ValueError("Can't store %r in a binary job." % action)
+    for value in fields:
+        if not isinstance(value, int):
+            raise ValueError("Can't store non-integer field of %r in a "
+                             "binary job." % action)
+    return fields
+
+
+def record_to_action(kind, m1, m2, time):
+    """
+    Inverse of action_to_record().
+    """
+    if kind == KIND_XY_MOVE:
+        # Checked by XYMove() when the action was stored.
+        return XYMove.unchecked(m1, m2, time)
+    elif kind == KIND_PEN_UP:
+        return PenUpMove(time)
+    elif kind == KIND_PEN_DOWN:
+        return PenDownMove(time)
+    elif kind == KIND_AB_MOVE:
+        return ABMove(m1, m2, time)
+    else:
+        raise ValueError("Unknown action kind %r." % kind)
+
+
+def write_binary(f, records, metadata):
+    meta = json.dumps(metadata).encode('utf-8')
+    f.write(BINARY_HEADER.pack(BINARY_MAGIC, len(meta), len(records)))
+    f.write(meta)
+    f.write(np.ascontiguousarray(records, dtype=ACTION_DTYPE).tobytes())
+
+
+class Job(MutableSequence):
+    """
+    A sequence of actions to plot, along with the pen settings they were
+    planned for. ``servo_speed`` is the speed raising the pen, and
+    ``servo_down_speed`` lowering it, which defaults to the same.
+
+    Actions are stored column-wise in parallel typed arrays of kind, m1, m2,
+    and time (the duration of a move or the delay of a pen move), which costs
+    13 bytes per action. Indexing or iterating a job creates Move instances on
+    the fly. The columns may also be read-only NumPy arrays, for a job loaded
+    from a memory-mapped binary file: these are copied into arrays the first
+    time the job is modified.
+    """
+    # Number of actions to convert at a time when iterating.
+    chunk_size = 4096
+
     def __init__(self, *args, pen_up_position, pen_down_position, servo_speed,
-                 document=None, filename=None):
+                 servo_down_speed=None, document=None, filename=None):
         self.filename = filename
         self.document = document
         self.pen_up_position = pen_up_position
         self.pen_down_position = pen_down_position
         self.servo_speed = servo_speed
-        list.__init__(self, *args)
+        if servo_down_speed is None:
+            servo_down_speed = servo_speed
+        self.servo_down_speed = servo_down_speed
+        self.kinds = array('B')
+        self.m1 = array('i')
+        self.m2 = array('i')
+        self.times = array('i')
+        self._index = None
+        for actions in args:
+            self.extend(actions)
+
+    @classmethod
+    def from_records(cls, records, **metadata):
+        """
+        Create a job whose columns are views of an array of ``ACTION_DTYPE``,
+        without copying it.
+        """
+        job = cls(**metadata)
+        job.kinds = records['kind']
+        job.m1 = records['m1']
+        job.m2 = records['m2']
+        job.times = records['time']
+        return job
+
+    @property
+    def columns(self):
+        return self.kinds, self.m1, self.m2, self.times
+
+    def _make_writable(self):
+        # Any modification invalidates the time/position index.
+        self._index = None
+        if not isinstance(self.kinds, array):
+            self.kinds = array('B', self.kinds.tolist())
+            self.m1 = array('i', self.m1.tolist())
+            self.m2 = array('i', self.m2.tolist())
+            self.times = array('i', self.times.tolist())
+
+    def records(self, start=0, stop=None):
+        """
+        Iterate over (kind, m1, m2, time) tuples, without creating Move
+        instances.
+        """
+        if stop is None:
+            stop = len(self)
+        for chunk_start in range(start, stop, self.chunk_size):
+            chunk_stop = min(chunk_start + self.chunk_size, stop)
+            chunks = [column[chunk_start:chunk_stop].tolist()
+                      for column in self.columns]
+            for fields in zip(*chunks):
+                yield fields
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                return [record_to_action(*fields)
+                        for fields in self.records(start, stop)]
+            return [self[n] for n in range(start, stop, step)]
+        return record_to_action(*(int(column[index])
+                                  for column in self.columns))
+
+    def __setitem__(self, index, action):
+        self._make_writable()
+        if isinstance(index, slice):
+            actions = list(self)
+            actions[index] = action
+            for column in self.columns:
+                del column[:]
+            self.extend(actions)
+        else:
+            fields = action_to_record(action)
+            for column, value in zip(self.columns, fields):
+                column[index] = value
+
+    def __delitem__(self, index):
+        self._make_writable()
+        for column in self.columns:
+            del column[index]
+
+    def insert(self, index, action):
+        self._make_writable()
+        fields = action_to_record(action)
+        for column, value in zip(self.columns, fields):
+            column.insert(index, value)
+
+    def append(self, action):
+        self._make_writable()
+        kind, m1, m2, time = action_to_record(action)
+        self.kinds.append(kind)
+        self.m1.append(m1)
+        self.m2.append(m2)
+        self.times.append(time)
+
+    def extend(self, actions):
+        for action in actions:
+            self.append(action)
+
+    def __iter__(self):
+        for fields in self.records():
+            yield record_to_action(*fields)
+
+    def __eq__(self, other):
+        if isinstance(other, Job):
+            return ((len(self) == len(other)) and
+                    all(np.array_equal(a, b) for a, b
+                        in zip(self.columns, other.columns)))
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<%s %s: %d actions>' % (self.__class__.__name__,
+                                        self.filename, len(self))
+
+    @property
+    def index(self):
+        """
+        Cumulative arrays describing the state of the plotter after each
+        action, built lazily and discarded when the job is modified:
+
+            end_times   time in ms at which each action finishes
+            x, y        position in steps after each action
+            pen_up      pen state after each action
+
+        Positions are relative to the start of the job, which begins with the
+        pen up.
+        """
+        if self._index is None:
+            kinds = np.asarray(self.kinds)
+            m1 = np.asarray(self.m1, dtype=np.int64)
+            m2 = np.asarray(self.m2, dtype=np.int64)
+            xy = kinds == KIND_XY_MOVE
+            ab = kinds == KIND_AB_MOVE
+            # ab moves store da/db, which are already the x/y deltas.
+            dx = np.where(xy, (m1 + m2) // 2, np.where(ab, m1, 0))
+            dy = np.where(xy, (m1 - m2) // 2, np.where(ab, m2, 0))
+            pen = kinds <= KIND_PEN_DOWN
+            last_pen = np.maximum.accumulate(
+                np.where(pen, np.arange(len(kinds)), -1))
+            pen_up = np.where(last_pen >= 0,
+                              kinds[last_pen] == KIND_PEN_UP, True)
+            self._index = {
+                'end_times': np.cumsum(self.times, dtype=np.int64),
+                'x': np.cumsum(dx),
+                'y': np.cumsum(dy),
+                'pen_up': pen_up,
+            }
+        return self._index
+
+    def time_at(self, index):
+        """
+        Time in ms at which the action at ``index`` starts.
+        """
+        if index <= 0:
+            return 0
+        return int(self.index['end_times'][index - 1])
+
+    def position_at(self, index):
+        """
+        Position in steps when the action at ``index`` starts.
+        """
+        if index <= 0:
+            return 0, 0
+        return (int(self.index['x'][index - 1]),
+                int(self.index['y'][index - 1]))
+
+    def pen_up_at(self, index):
+        """
+        Pen state when the action at ``index`` starts.
+        """
+        if index <= 0:
+            return True
+        return bool(self.index['pen_up'][index - 1])
+
+    def index_at_time(self, ms):
+        """
+        Index of the action which is in progress ``ms`` milliseconds into the
+        job, or the length of the job if it will have finished by then.
+        """
+        return int(np.searchsorted(self.index['end_times'], ms,
+                                   side='right'))
 
     def duration(self):
-        duration_ms = sum(action.time() for action in self)
-        return timedelta(seconds=(duration_ms / 1000))
+        return timedelta(seconds=(self.time_at(len(self)) / 1000))
 
-    def serialize(self, f):
-        actions = []
-        for action in self:
-            d = action.__dict__
-            d['name'] = action.name
-            actions.append(d)
-        obj = {
+    def metadata(self):
+        return {
             'filename': self.filename,
             'document': self.document,
             'pen_up_position': self.pen_up_position,
             'pen_down_position': self.pen_down_position,
             'servo_speed': self.servo_speed,
-            'actions': actions,
+            'servo_down_speed': self.servo_down_speed,
         }
+
+    def content_hash(self):
+        """
+        Return a hex digest identifying the actions and pen settings of this
+        job, regardless of which file or document it came from.
+        """
+        h = hashlib.sha256()
+        settings = [self.pen_up_position, self.pen_down_position,
+                    self.servo_speed]
+        # Symmetric jobs hash the same as before down speeds were recorded.
+        if self.servo_down_speed != self.servo_speed:
+            settings.append(self.servo_down_speed)
+        h.update(json.dumps(settings).encode('utf-8'))
+        h.update(self.to_records().tobytes())
+        return h.hexdigest()
+
+    def to_records(self):
+        """
+        Return the actions of this job as an array of ``ACTION_DTYPE``.
+        """
+        records = np.empty(len(self), dtype=ACTION_DTYPE)
+        if len(self):
+            records['kind'] = self.kinds
+            records['m1'] = self.m1
+            records['m2'] = self.m2
+            records['time'] = self.times
+        return records
+
+    def serialize_binary(self, f):
+        """
+        Write this job in the binary job format to the file opened in binary
+        mode as ``f``.
+        """
+        write_binary(f, self.to_records(), self.metadata())
+
+    @classmethod
+    def deserialize_binary(cls, filename):
+        """
+        Memory-map the binary job file ``filename``. Actions are only turned
+        into Move instances as they are accessed, so even very large jobs load
+        instantly.
+        """
+        with open(filename, 'rb') as f:
+            magic, meta_len, count = \
+                BINARY_HEADER.unpack(f.read(BINARY_HEADER.size))
+            if magic != BINARY_MAGIC:
+                raise ValueError("%s is not a binary axibot job." % filename)
+            metadata = json.loads(f.read(meta_len).decode('utf-8'))
+        offset = BINARY_HEADER.size + meta_len
+        if count:
+            records = np.memmap(filename, dtype=ACTION_DTYPE, mode='r',
+                                offset=offset, shape=(count,))
+        else:
+            records = np.zeros(0, dtype=ACTION_DTYPE)
+        # Moves are created from the records without checking them again, so
+        # check them all at once here.
+        xy = records[records['kind'] == KIND_XY_MOVE]
+        if (np.any(records['kind'] > KIND_AB_MOVE) or
+                np.any(xy['time'] < 30) or
+                np.any((xy['m1'] == 0) & (xy['m2'] == 0))):
+            raise ValueError("%s contains invalid actions." % filename)
+        return cls.from_records(records, **metadata)
+
+    def serialize(self, f):
+        actions = []
+        for action in self:
+            d = action.as_dict()
+            d['name'] = action.name
+            actions.append(d)
+        obj = self.metadata()
+        obj['actions'] = actions
         json.dump(obj, f, indent=2)
 
     @classmethod
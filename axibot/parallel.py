@@ -0,0 +1,154 @@
+"""
+Plan the actions for a document's segments across a pool of processes.
+
+Every segment starts and ends at the jump speed, which the motors can start
+and stop at instantly, so segments can be planned independently of each
+other. The step coordinates of all segments are packed into one array in
+shared memory, which worker processes attach to once, so that each task only
+needs to name a range of segments. Workers send back their actions as packed
+job records, which are concatenated in order.
+
+Shared memory needs Python 3.8 or later: on older versions ``available`` is
+False, and plan_job() plans in a single process instead.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+
+from concurrent import futures
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+import numpy as np
+
+from . import config, planning
+from .job import ACTION_DTYPE, action_to_record
+
+log = logging.getLogger(__name__)
+
+available = shared_memory is not None
+
+
+# Number of tasks to split planning into per worker, so that the work stays
+# balanced when some segments are much slower to plan than others.
+TASKS_PER_WORKER = 4
+
+# State of each worker process, set up by attach().
+worker_state = {}
+
+
+def pack_segments(step_segments):
+    """
+    Pack a list of (segment, pen_up) tuples into a (points, offsets, pen_ups)
+    tuple of arrays, where the points of segment ``n`` are
+    ``points[offsets[n]:offsets[n + 1]]``.
+    """
+    lengths = [len(segment) for segment, pen_up in step_segments]
+    offsets = np.zeros(len(step_segments) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    points = np.empty((offsets[-1], 2), dtype=np.int32)
+    for n, (segment, pen_up) in enumerate(step_segments):
+        points[offsets[n]:offsets[n + 1]] = segment
+    pen_ups = np.array([pen_up for segment, pen_up in step_segments],
+                       dtype=bool)
+    return points, offsets, pen_ups
+
+
+def attach(name, shape, offsets, pen_ups):
+    """
+    Worker initializer: map the shared points array.
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    worker_state['shm'] = shm
+    worker_state['points'] = np.ndarray(shape, dtype=np.int32,
+                                        buffer=shm.buf)
+    worker_state['offsets'] = offsets
+    worker_state['pen_ups'] = pen_ups
+
+
+def plan_range(start, stop, pen_up_delay, pen_down_delay, planner_config):
+    """
+    Worker task: plan segments ``start`` to ``stop``, including the pen move
+    into each one, and return their actions as an array of job records.
+    """
+    points = worker_state['points']
+    offsets = worker_state['offsets']
+    pen_ups = worker_state['pen_ups']
+    segments = []
+    for n in range(start, stop):
+        segment = [tuple(point) for point in
+                   points[offsets[n]:offsets[n + 1]].tolist()]
+        segments.append((segment, bool(pen_ups[n])))
+    last_pen_up = bool(pen_ups[start - 1]) if start else True
+    records = []
+    segments_limits = planning.iter_speed(segments,
+                                          planner_config=planner_config)
+    for actions in planning.iter_actions(segments_limits,
+                                         pen_up_delay=pen_up_delay,
+                                         pen_down_delay=pen_down_delay,
+                                         last_pen_up=last_pen_up,
+                                         planner_config=planner_config):
+        records.extend(action_to_record(action) for action in actions)
+    return np.array(records, dtype=ACTION_DTYPE)
+
+
+def split_ranges(offsets, count):
+    """
+    Split the segments described by ``offsets`` into up to ``count``
+    contiguous (start, stop) ranges with roughly equal numbers of points.
+    """
+    total = offsets[-1]
+    bounds = np.searchsorted(offsets, np.linspace(0, total, count + 1))
+    bounds[0] = 0
+    bounds[-1] = len(offsets) - 1
+    bounds = sorted(set(bounds.tolist()))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def plan_records(step_segments, pen_up_delay, pen_down_delay, workers=None,
+                 progress=None, cancel=None, planner_config=None):
+    """
+    Plan the actions for ``step_segments`` across ``workers`` processes,
+    returning an array of job records identical to what plan_actions() would
+    produce. Progress is reported as the 'actions' stage, as tasks finish.
+    """
+    workers = workers or config.PLANNER_WORKERS
+    # Resolve the defaults here, in case workers don't share our config.
+    planner_config = planner_config or planning.PlannerConfig.default()
+    points, offsets, pen_ups = pack_segments(step_segments)
+    ranges = split_ranges(offsets, workers * TASKS_PER_WORKER)
+    log.info("Planning %d segments in %d tasks on %d workers...",
+             len(step_segments), len(ranges), workers)
+
+    shm = shared_memory.SharedMemory(create=True, size=max(points.nbytes, 1))
+    try:
+        shared = np.ndarray(points.shape, dtype=np.int32, buffer=shm.buf)
+        shared[:] = points
+        with futures.ProcessPoolExecutor(
+                max_workers=workers, initializer=attach,
+                initargs=(shm.name, points.shape, offsets, pen_ups)) as pool:
+            tasks = [pool.submit(plan_range, start, stop,
+                                 pen_up_delay, pen_down_delay, planner_config)
+                     for start, stop in ranges]
+            try:
+                done = planning.track_progress(futures.as_completed(tasks),
+                                               'actions', progress=progress,
+                                               cancel=cancel,
+                                               total=len(tasks))
+                for task in done:
+                    task.result()
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                raise
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+    if not tasks:
+        return np.zeros(0, dtype=ACTION_DTYPE)
+    return np.concatenate([task.result() for task in tasks])
@@ -4,33 +4,155 @@ from __future__ import (absolute_import, division, print_function,
 import logging
 
 import math
+import functools
+from collections import namedtuple
+import queue
+import threading
+
+import numpy as np
 
 from . import config, svg
 from .action import XYMove, PenUpMove, PenDownMove
-from .job import Job
+from .job import Job, KIND_PEN_DOWN
 
 log = logging.getLogger(__name__)
 
 
-def calculate_pen_delays(up_position, down_position, servo_speed):
+# Settings in ``axibot.config`` which affect the output of the planner.
+PLANNER_SETTINGS = (
+    'SERVO_SPEED',
+    'SERVO_DOWN_SPEED',
+    'EXTRA_PEN_UP_DELAY',
+    'EXTRA_PEN_DOWN_DELAY',
+    'PEN_CLEAR_FRACTION',
+    'PEN_CLEAR_MARGIN',
+    'ACCEL_TIME_PEN_DOWN',
+    'SPEED_PEN_DOWN',
+    'ACCEL_TIME_PEN_UP',
+    'SPEED_PEN_UP',
+    'SHORT_THRESHOLD',
+    'DPI_16X',
+    'TIME_SLICE',
+    'CURVE_RESOLUTION',
+    'SIMPLIFY_TOLERANCE',
+    'MIN_GAP',
+    'JOIN_TOLERANCE',
+    'REMOVE_OVERLAPS',
+    'BRIDGE_INKED_ONLY',
+    'BRIDGE_TOLERANCE',
+    'CHORD_TOLERANCE',
+    'COLLINEAR_TOLERANCE',
+    'JUMP_SPEED',
+    'MOTOR_LIMITS',
+    'MAX_STEP_RATE',
+    'JERK_TIME',
+    'PEN_UP_POSITION',
+    'PEN_DOWN_POSITION',
+)
+
+
+class PlannerConfig(namedtuple('PlannerConfig',
+                               [name.lower() for name in PLANNER_SETTINGS])):
+    """
+    An immutable set of planner settings, with the same names as the
+    corresponding settings in ``axibot.config`` but in lower case.
+
+    Every planning function takes an optional ``planner_config``, defaulting
+    to the current values in ``axibot.config``, so that documents can be
+    planned with different settings at the same time::
+
+        fast = PlannerConfig.default()._replace(speed_pen_down=10)
+        job = plan_job(document, filename, planner_config=fast)
+    """
+    __slots__ = ()
+
+    @classmethod
+    def default(cls):
+        """
+        Return the current settings from ``axibot.config``.
+        """
+        return cls(*(getattr(config, name) for name in PLANNER_SETTINGS))
+
+
+class PlanningCanceled(Exception):
+    """
+    Raised from inside plan_job() when its cancellation token is triggered.
+    """
+    pass
+
+
+class CancelToken:
+    """
+    Handed to plan_job() by a caller which may want to abort planning from
+    another thread. Planning checks the token between paths and segments.
+    """
+    def __init__(self):
+        self.canceled = False
+
+    def cancel(self):
+        self.canceled = True
+
+    def check(self):
+        if self.canceled:
+            raise PlanningCanceled()
+
+
+def track_progress(items, stage, progress=None, cancel=None, total=None):
+    """
+    Iterate over ``items``, checking the ``cancel`` token before each item and
+    calling ``progress(stage, percent)`` whenever the integer percentage
+    completed changes. Pass ``total`` if ``items`` has no length.
+    """
+    if total is None:
+        total = len(items)
+    last_percent = None
+    for n, item in enumerate(items):
+        if cancel:
+            cancel.check()
+        if progress:
+            percent = (100 * n) // total
+            if percent != last_percent:
+                progress(stage, percent)
+                last_percent = percent
+        yield item
+    if progress:
+        progress(stage, 100)
+
+
+def calculate_pen_delays(up_position, down_position, servo_speed,
+                         planner_config=None, servo_down_speed=None):
     """
     The AxiDraw motion controller must know how long to wait after giving a
     'pen up' or 'pen down' command. This requires calculating the speed that
     the servo can move to or from the two respective states. This function
     performs that calculation and returns a tuple of (pen_up_delay,
     pen_down_delay). All delays are in milliseconds.
+
+    ``servo_speed`` is the speed raising the pen, and ``servo_down_speed`` the
+    speed lowering it, which defaults to the same.
+
+    The delay is the time before the next command starts, not the time the
+    servo takes to move, so the pen up delay only waits until the pen has
+    cleared the paper. Travel overlaps the rest of the servo move.
     """
     assert up_position > down_position
+    planner_config = planner_config or PlannerConfig.default()
+
+    if servo_down_speed is None:
+        servo_down_speed = servo_speed
 
-    # Math initially taken from axidraw inkscape driver, but I think this can
-    # be sped up a bit. We might also want to use different speeds for up/down,
-    # due to the added weight of the pen slowing down the servo in the 'up'
-    # direction.
+    # Math initially taken from axidraw inkscape driver. The extra delays,
+    # which may be negative, correct this model for a particular machine:
+    # they're set by calibration.
     dist = up_position - down_position
-    time = int((1000. * dist) / config.SERVO_SPEED)
+    up_time = int((1000. * dist) / servo_speed)
+    down_time = int((1000. * dist) / servo_down_speed)
+    clear_time = min(int(math.ceil(up_time *
+                                   planner_config.pen_clear_fraction)) +
+                     planner_config.pen_clear_margin, up_time)
 
-    return ((time + config.EXTRA_PEN_UP_DELAY),
-            (time + config.EXTRA_PEN_DOWN_DELAY))
+    return (max(clear_time + planner_config.extra_pen_up_delay, 0),
+            max(down_time + planner_config.extra_pen_down_delay, 0))
 
 
 def distance(a, b):
@@ -40,16 +162,85 @@ def distance(a, b):
     return math.sqrt((b[0] - a[0])**2 + (b[1] - a[1])**2)
 
 
-def convert_inches_to_steps(segments):
+def speed_limits(pen_up, speed_scale=1.0, planner_config=None, short=False):
     """
-    Take the output from add_pen_up_moves() and convert all points from inches
-    to steps.
+    Return a tuple of (max speed in steps/ms, max acceleration in steps/ms^2)
+    for a pen state. ``speed_scale`` scales the speed limit, for example to
+    apply a feed-rate override: the acceleration limit is physical, and stays
+    the same.
 
-    This also 'collapses points': that is, if there are two or more adjacent
-    points in a segment are at the same position, they are combined into one.
+    ``short`` pen-up moves, which never get near full speed, use the faster
+    pen-down acceleration rate: see is_short_move().
     """
-    spi = config.DPI_16X
-    out = []
+    planner_config = planner_config or PlannerConfig.default()
+    if pen_up:
+        vmax = planner_config.speed_pen_up
+        accel_rate = vmax / planner_config.accel_time_pen_up
+        if short:
+            accel_rate = max(accel_rate,
+                             planner_config.speed_pen_down /
+                             planner_config.accel_time_pen_down)
+    else:
+        vmax = planner_config.speed_pen_down
+        accel_rate = vmax / planner_config.accel_time_pen_down
+    return vmax * speed_scale, accel_rate
+
+
+def is_short_move(points, pen_up, planner_config=None):
+    """
+    Return True if ``points`` is a pen-up segment shorter than
+    ``SHORT_THRESHOLD``.
+    """
+    if not pen_up:
+        return False
+    planner_config = planner_config or PlannerConfig.default()
+    threshold = planner_config.short_threshold * planner_config.dpi_16x
+    length = 0
+    for a, b in zip(points, points[1:]):
+        length += distance(a, b)
+        if length >= threshold:
+            return False
+    return True
+
+
+def direction_limits(a, b, pen_up, speed_scale=1.0, planner_config=None,
+                     short=False):
+    """
+    Return the speed limit in steps/ms and the acceleration limit in
+    steps/ms^2 for a move from ``a`` to ``b``.
+
+    These are the same as speed_limits() unless ``planner_config.motor_limits``
+    is set, in which case they're limits on the busier of the two motors, so
+    they depend on the direction of the move. Either way, raising the speed
+    limit with ``speed_scale`` never steps the busier motor faster than
+    ``max_step_rate``, or faster than the unscaled limit does if that's
+    already more.
+    """
+    planner_config = planner_config or PlannerConfig.default()
+    vmax, accel_rate = speed_limits(pen_up, speed_scale, planner_config, short)
+    if a == b:
+        return vmax, accel_rate
+    dx = b[0] - a[0]
+    dy = b[1] - a[1]
+    # Steps taken by the busier motor per step moved along the path: 1 for an
+    # axis-aligned move, up to sqrt(2) on a diagonal.
+    motor_ratio = max(abs(dx + dy), abs(dx - dy)) / distance(a, b)
+    if not planner_config.motor_limits:
+        # Only cap the override, so that unscaled plans don't change.
+        base_vmax, _ = speed_limits(pen_up, 1.0, planner_config, short)
+        step_vmax = planner_config.max_step_rate / motor_ratio
+        return min(vmax, max(base_vmax, step_vmax)), accel_rate
+    motor_vmax = min(math.sqrt(2) * vmax, planner_config.max_step_rate)
+    motor_accel_rate = math.sqrt(2) * accel_rate
+    return motor_vmax / motor_ratio, motor_accel_rate / motor_ratio
+
+
+def iter_steps(segments, planner_config=None):
+    """
+    Generator version of convert_inches_to_steps().
+    """
+    planner_config = planner_config or PlannerConfig.default()
+    spi = planner_config.dpi_16x
     for segment, pen_up in segments:
         points = []
         last_point = None
@@ -60,10 +251,122 @@ def convert_inches_to_steps(segments):
             if (last_point is None) or (steps_point != last_point):
                 points.append(steps_point)
             last_point = steps_point
-        out.append((points, pen_up))
+        yield points, pen_up
+
+
+def convert_inches_to_steps(segments, planner_config=None):
+    """
+    Take the output from add_pen_up_moves() and convert all points from inches
+    to steps.
+
+    This also 'collapses points': that is, if there are two or more adjacent
+    points in a segment are at the same position, they are combined into one.
+    """
+    return list(iter_steps(segments, planner_config))
+
+
+def merge_short_moves(points, min_dist, tolerance):
+    """
+    Drop points from a segment so that hops shorter than ``min_dist`` are
+    merged with the following ones, as long as every dropped point stays
+    within ``tolerance`` of the chord which replaces it. The first and last
+    points are always kept.
+
+    Distances are measured from the chord itself rather than the line through
+    it, so that the tip of a stroke which doubles back is never dropped.
+    """
+    out = [points[0]]
+    last = len(points) - 1
+    a = 0
+    while a < last:
+        b = a + 1
+        while ((b < last) and (distance(points[a], points[b]) < min_dist) and
+               all(svg.point_line_distance(points[a], points[b + 1],
+                                           points[n]) <= tolerance
+                   for n in range(a + 1, b + 1))):
+            b += 1
+        out.append(points[b])
+        a = b
+    return out
+
+
+def collapse_collinear(points, tolerance):
+    """
+    Drop points from a segment which lie within ``tolerance`` of a straight
+    line between the points kept either side of them. The first and last
+    points are always kept.
+
+    Each run of dropped points is found in one pass, by narrowing the range of
+    directions from the start of the run which pass within ``tolerance`` of
+    every point so far. The run also has to keep moving away from its start,
+    so that a path which doubles back on itself keeps its turning point.
+    """
+    out = [points[0]]
+    count = len(points)
+    n = 1
+    while n < count:
+        a = out[-1]
+        base = None
+        lo = -math.pi
+        hi = math.pi
+        last_dist = 0
+        keep = n
+        for m in range(n, count):
+            dx = points[m][0] - a[0]
+            dy = points[m][1] - a[1]
+            dist = math.hypot(dx, dy)
+            if dist <= last_dist:
+                break
+            angle = math.atan2(dy, dx)
+            if base is None:
+                base = angle
+            angle = ((angle - base + math.pi) % (2 * math.pi)) - math.pi
+            if not lo <= angle <= hi:
+                break
+            keep = m
+            last_dist = dist
+            if dist > tolerance:
+                width = math.asin(tolerance / dist)
+                lo = max(lo, angle - width)
+                hi = min(hi, angle + width)
+        out.append(points[keep])
+        n = keep + 1
     return out
 
 
+def iter_collapsed(segments, planner_config=None):
+    """
+    Collapse nearly collinear points in each segment, within
+    ``collinear_tolerance`` inches. Every point is a corner for the speed
+    planner and the end of a move, so this saves both planning time and
+    moves.
+    """
+    planner_config = planner_config or PlannerConfig.default()
+    tolerance = planner_config.collinear_tolerance * planner_config.dpi_16x
+    for segment, pen_up in segments:
+        if tolerance and (len(segment) > 2):
+            segment = collapse_collinear(segment, tolerance)
+        yield segment, pen_up
+
+
+def iter_merged(segments, planner_config=None):
+    """
+    Merge hops in each segment which are too short to cover at full speed in
+    one time slice. Every move takes at least one time slice, so a curve
+    subdivided finer than that would otherwise be plotted at a crawl. Dropped
+    points stay within ``chord_tolerance`` inches of the path.
+    """
+    planner_config = planner_config or PlannerConfig.default()
+    tolerance = planner_config.chord_tolerance * planner_config.dpi_16x
+    for segment, pen_up in segments:
+        if tolerance and (len(segment) > 2):
+            vmax, accel_rate = speed_limits(pen_up,
+                                            planner_config=planner_config)
+            segment = merge_short_moves(
+                segment, vmax * planner_config.time_slice, tolerance)
+        yield segment, pen_up
+
+
 def cornering_angle(a, b, c):
     """
     Given three points, compute the angle in radians between AB and BC.
@@ -113,26 +416,57 @@ def cornering_speed(angle, vmax):
         return (1.0 + math.sin(angle - math.pi)) * vmax
 
 
-def segment_corner_limits(segment, pen_up):
+def jump_cornering_speed(angle, vjump):
+    """
+    Given a corner angle in radians, compute the fastest speed at which the
+    change in velocity through the corner is no more than the jump speed
+    ``vjump``, which the motors can take instantly.
+    """
+    change = 2 * math.sin((math.pi - angle) / 2)
+    if change <= 0:
+        return math.inf
+    return vjump / change
+
+
+def jump_speed(pen_up, speed_scale=1.0, planner_config=None):
+    """
+    Return the speed in steps/ms that the motors can start from and stop
+    from instantly for a pen state. It's physical, so it isn't scaled, but it
+    can't exceed the speed limit.
+    """
+    planner_config = planner_config or PlannerConfig.default()
+    vmax, accel_rate = speed_limits(pen_up, speed_scale, planner_config)
+    return min(planner_config.jump_speed, vmax)
+
+
+def segment_corner_limits(segment, pen_up, speed_scale=1.0,
+                          planner_config=None):
     """
     Given a segment and pen state, tag each point with the 'speed limit' for
-    that corner. Ensure that the segment starts and ends at zero speed.
+    that corner. Ensure that the segment starts and ends at the jump speed,
+    from which the motors can start and stop instantly.
     """
-    out = []
-    out.append((segment[0], 0.0))
+    vjump = jump_speed(pen_up, speed_scale, planner_config)
+    hop_vmax = [direction_limits(a, b, pen_up, speed_scale, planner_config)[0]
+                for a, b in zip(segment, segment[1:])]
 
-    vmax = config.SPEED_PEN_UP if pen_up else config.SPEED_PEN_DOWN
+    out = []
+    out.append((segment[0], vjump))
 
-    for a, b, c in zip(segment[:-2], segment[1:-1], segment[2:]):
+    for n, (a, b, c) in enumerate(zip(segment[:-2], segment[1:-1],
+                                      segment[2:])):
+        vmax = min(hop_vmax[n], hop_vmax[n + 1])
         angle = cornering_angle(a, b, c)
-        limit = cornering_speed(angle, vmax)
-        out.append((b, limit))
+        limit = max(cornering_speed(angle, vmax),
+                    jump_cornering_speed(angle, vjump))
+        out.append((b, min(limit, vmax)))
 
-    out.append((segment[-1], 0.0))
+    out.append((segment[-1], vjump))
     return out
 
 
-def segment_acceleration_limits(segment, pen_up):
+def segment_acceleration_limits(segment, pen_up, speed_scale=1.0,
+                                planner_config=None):
     """
     Given a segment w/ speed limits and pen state, tag each point with the
     target speed for that corner. This will possibly reduce speeds from the
@@ -142,21 +476,21 @@ def segment_acceleration_limits(segment, pen_up):
     acceleration, one backward for deceleration.
     """
     assert segment
-    if pen_up:
-        vmax = config.SPEED_PEN_UP
-        accel_time = config.ACCEL_TIME_PEN_UP
-    else:
-        vmax = config.SPEED_PEN_DOWN
-        accel_time = config.ACCEL_TIME_PEN_DOWN
-    accel_rate = vmax / accel_time
+    planner_config = planner_config or PlannerConfig.default()
+    short = is_short_move([point for point, speed in segment], pen_up,
+                          planner_config)
 
     out = []
     last_point, last_speed = segment[0]
     out.append((last_point, last_speed))
     for point, speed_limit in segment[1:]:
+        vmax, accel_rate = direction_limits(last_point, point, pen_up,
+                                            speed_scale, planner_config,
+                                            short)
         dist = distance(point, last_point)
         # can we accelerate from last_speed to speed_limit in this distance?
-        top_speed = math.sqrt((2 * accel_rate * dist) + last_speed**2)
+        top_speed = ramp_top_speed(last_speed, dist, accel_rate,
+                                   planner_config.jerk_time)
         # if not we need to limit the speed at this point
         speed = min(speed_limit, top_speed)
         assert speed <= vmax
@@ -168,7 +502,7 @@ def segment_acceleration_limits(segment, pen_up):
     return out
 
 
-def plan_speed(segments):
+def plan_speed(segments, speed_scale=1.0, planner_config=None):
     """
     Given a list of (segment, pen_up) tuples, tag each segment with a target
     speed for that corner. This combines two limits:
@@ -181,20 +515,30 @@ def plan_speed(segments):
     making the pen line squiggly, or just slamming the motors around and
     causing wear on the machine.
     """
-    out = []
+    return list(iter_speed(segments, speed_scale, planner_config))
+
+
+def iter_speed(segments, speed_scale=1.0, planner_config=None):
+    """
+    Generator version of plan_speed(). Each segment starts and ends at the
+    jump speed, so segments can be planned one at a time.
+    """
+    planner_config = planner_config or PlannerConfig.default()
     for segment, pen_up in segments:
         assert segment
-        points = segment_corner_limits(segment, pen_up)
+        points = segment_corner_limits(segment, pen_up, speed_scale,
+                                       planner_config)
         # Calculate forward acceleration
-        points = segment_acceleration_limits(points, pen_up)
+        points = segment_acceleration_limits(points, pen_up, speed_scale,
+                                             planner_config)
         assert points
         # Calculate reverse acceleration (deceleration)
-        points = segment_acceleration_limits(points[::-1], pen_up)
+        points = segment_acceleration_limits(points[::-1], pen_up,
+                                             speed_scale, planner_config)
         assert points
         points = points[::-1]
         assert points
-        out.append((points, pen_up))
-    return out
+        yield points, pen_up
 
 
 def check_limits(dots):
@@ -286,7 +630,7 @@ def interpolate_distance_trapezoidal(vstart, accel_time, accel_dist,
 
     if accel_slices:
         accel_timeslice = accel_time / accel_slices
-        assert accel_timeslice > timeslice, \
+        assert accel_timeslice >= timeslice, \
             "accel timeslice %r too small" % accel_timeslice
         vstep = (vmax - vstart) / (accel_slices + 1)
         for n in range(accel_slices):
@@ -304,7 +648,7 @@ def interpolate_distance_trapezoidal(vstart, accel_time, accel_dist,
     coast_slices = int(math.floor(coast_time / timeslice))
     if coast_slices:
         coast_timeslice = coast_time / coast_slices
-        assert coast_timeslice > timeslice, \
+        assert coast_timeslice >= timeslice, \
             "coast_timeslice %r too small" % coast_timeslice
         for n in range(coast_slices):
             v = vmax
@@ -313,7 +657,7 @@ def interpolate_distance_trapezoidal(vstart, accel_time, accel_dist,
 
     if decel_slices:
         decel_timeslice = decel_time / decel_slices
-        assert decel_timeslice > timeslice, \
+        assert decel_timeslice >= timeslice, \
             "decel timeslice %r too small" % decel_timeslice
         vstep = (vend - vmax) / (decel_slices + 1)
         for n in range(decel_slices):
@@ -350,7 +694,7 @@ def interpolate_distance_linear(dist, vstart, vend, accel_rate, timeslice):
         return [(dist, duration)]
     if slices:
         lin_timeslice = lin_time / slices
-        assert lin_timeslice > timeslice, \
+        assert lin_timeslice >= timeslice, \
             "lin timeslice %r too small" % lin_timeslice
         vstep = (vend - vstart) / slices
         for n in range(slices):
@@ -364,12 +708,14 @@ def interpolate_distance_linear(dist, vstart, vend, accel_rate, timeslice):
     return dtarray
 
 
-def interpolate_distance_triangular(dist, vstart, vend, accel_rate, timeslice):
+def interpolate_distance_triangular(dist, vstart, vend, accel_rate, timeslice,
+                                    vjump=0):
     accel_time = ((math.sqrt((2 * vstart**2) +
                              (2 * vend**2) +
                              (4 * accel_rate * dist)) -
                    (2 * vstart)) /
                   (2 * accel_rate))
+    triangle_time = (2 * accel_time) - ((vend - vstart) / accel_rate)
     accel_slices = int(math.floor(accel_time / timeslice))
     if accel_slices <= 0:
         accel_slices = 0
@@ -388,7 +734,7 @@ def interpolate_distance_triangular(dist, vstart, vend, accel_rate, timeslice):
         # Triangular
         if accel_slices:
             accel_timeslice = accel_time / accel_slices
-            assert accel_timeslice > timeslice, \
+            assert accel_timeslice >= timeslice, \
                 "accel timeslice %r too small" % accel_timeslice
             vstep = (vmax - vstart) / (accel_slices + 1.0)
             for n in range(accel_slices):
@@ -399,7 +745,7 @@ def interpolate_distance_triangular(dist, vstart, vend, accel_rate, timeslice):
 
         if decel_slices:
             decel_timeslice = decel_time / decel_slices
-            assert decel_timeslice > timeslice, \
+            assert decel_timeslice >= timeslice, \
                 "decel timeslice %r too small" % decel_timeslice
             vstep = (vend - vmax) / (decel_slices + 1.0)
             for n in range(decel_slices):
@@ -409,19 +755,16 @@ def interpolate_distance_triangular(dist, vstart, vend, accel_rate, timeslice):
                     dtarray.append((x, decel_timeslice))
     elif vend == vstart:
         if vstart:
-            # Constant speed that is non-zero
-            duration = dist / vstart
-            # XXX this should be set more intelligently
-            if duration > 200:
-                duration = 200
-            if duration < 30:
-                duration = 30
-            return [(dist, duration)]
-        else:
+            # Too short to slice up: make the move in one go, taking as long
+            # as speeding up and slowing down again would.
+            return [(dist, max(triangle_time, timeslice))]
+        elif vjump:
             # Segment that has to start and end at zero speed, but is really
-            # short. This is a really obnoxious case, for now we're just going
-            # to set it to do the move in 100ms. Need to figure out the 'vmin'
-            # which can be accelerated to instantaneously.
+            # short: jump straight to the jump speed and back.
+            return [(dist, max(dist / vjump, timeslice))]
+        else:
+            # Without a jump speed, this is a really obnoxious case, for now
+            # we're just going to set it to do the move in 100ms.
             return [(dist, 100)]
     else:
         dtarray = interpolate_distance_linear(dist, vstart, vend, accel_rate,
@@ -431,7 +774,130 @@ def interpolate_distance_triangular(dist, vstart, vend, accel_rate, timeslice):
     return dtarray
 
 
-def interpolate_distance(dist, vstart, vend, vmax, accel_max, timeslice):
+def scurve_ramp(vstart, vend, accel_rate, jerk_time):
+    """
+    Return the phases of a jerk-limited change of speed from ``vstart`` to
+    ``vend``, as a list of (duration, initial acceleration, jerk) tuples. The
+    acceleration ramps up over at most ``jerk_time`` ms, holds at
+    ``accel_rate`` for as long as needed, and ramps back down.
+    """
+    dv = abs(vend - vstart)
+    sign = 1 if vend >= vstart else -1
+    if dv >= accel_rate * jerk_time:
+        ramp_time = jerk_time
+        hold_time = (dv / accel_rate) - jerk_time
+        peak_accel = accel_rate
+    else:
+        ramp_time = math.sqrt(dv * jerk_time / accel_rate)
+        hold_time = 0
+        peak_accel = dv / ramp_time if ramp_time else 0
+    jerk = peak_accel / ramp_time if ramp_time else 0
+    return [(ramp_time, 0, sign * jerk),
+            (hold_time, sign * peak_accel, 0),
+            (ramp_time, sign * peak_accel, -sign * jerk)]
+
+
+def scurve_ramp_distance(vstart, vend, accel_rate, jerk_time):
+    """
+    Distance covered by scurve_ramp(). The speed profile is symmetric about
+    its midpoint, so this is the average speed times the duration.
+    """
+    duration = sum(phase[0]
+                   for phase in scurve_ramp(vstart, vend, accel_rate,
+                                            jerk_time))
+    return (vstart + vend) * duration / 2
+
+
+def cube_root(x):
+    return math.copysign(abs(x) ** (1 / 3), x)
+
+
+def ramp_top_speed(vstart, dist, accel_rate, jerk_time=0):
+    """
+    Return the fastest speed which can be reached from ``vstart`` within
+    ``dist``, with S-curve acceleration if ``jerk_time`` is set.
+    """
+    if not jerk_time:
+        return math.sqrt((2 * accel_rate * dist) + vstart**2)
+    # If full acceleration is reached, the distance is
+    # (2 * vstart + dv) * (dv + full) / (2 * accel_rate).
+    full = accel_rate * jerk_time
+    b = (2 * vstart) + full
+    c = (2 * vstart * full) - (2 * accel_rate * dist)
+    dv = (math.sqrt((b**2) - (4 * c)) - b) / 2
+    if dv < full:
+        # Otherwise it's (2 * vstart + dv) * sqrt(dv * jerk_time / accel_rate)
+        # which is a cubic in sqrt(dv), with one real root.
+        p = 2 * vstart
+        q = dist * math.sqrt(accel_rate / jerk_time)
+        r = math.sqrt((q**2 / 4) + (p**3 / 27))
+        dv = (cube_root((q / 2) + r) + cube_root((q / 2) - r))**2
+    return vstart + dv
+
+
+def phase_position(vstart, phases, t):
+    """
+    Distance covered ``t`` ms into a list of (duration, initial acceleration,
+    jerk) phases.
+    """
+    x = 0
+    v = vstart
+    for duration, accel, jerk in phases:
+        dt = min(t, duration)
+        x += (v * dt) + (accel * dt**2 / 2) + (jerk * dt**3 / 6)
+        v += (accel * dt) + (jerk * dt**2 / 2)
+        t -= dt
+        if t <= 0:
+            break
+    return x
+
+
+def interpolate_distance_scurve(dist, vstart, vend, vmax, accel_rate,
+                                timeslice, jerk_time):
+    """
+    Like interpolate_distance(), but with jerk-limited S-curve acceleration.
+    Accelerate to the fastest peak speed the distance allows, coast, and
+    decelerate.
+    """
+    def ramps_distance(vpeak):
+        return (scurve_ramp_distance(vstart, vpeak, accel_rate, jerk_time) +
+                scurve_ramp_distance(vpeak, vend, accel_rate, jerk_time))
+
+    vpeak = vmax
+    if ramps_distance(vpeak) > dist:
+        # Find the peak speed at which there's no time to coast.
+        lo = max(vstart, vend)
+        hi = vmax
+        for n in range(50):
+            vpeak = (lo + hi) / 2
+            if ramps_distance(vpeak) > dist:
+                hi = vpeak
+            else:
+                lo = vpeak
+        vpeak = lo
+
+    if vpeak > 0:
+        coast_time = max(dist - ramps_distance(vpeak), 0) / vpeak
+    else:
+        coast_time = 0
+    phases = (scurve_ramp(vstart, vpeak, accel_rate, jerk_time) +
+              [(coast_time, 0, 0)] +
+              scurve_ramp(vpeak, vend, accel_rate, jerk_time))
+    duration = sum(phase[0] for phase in phases)
+
+    slices = int(math.floor(duration / timeslice))
+    if not slices:
+        return [(dist, timeslice)]
+    slice_time = duration / slices
+    dtarray = [(phase_position(vstart, phases, n * slice_time), slice_time)
+               for n in range(1, slices)]
+    # Don't let float error move the end point.
+    dtarray.append((dist, slice_time))
+    return dtarray
+
+
+def interpolate_distance(dist, vstart, vend, vmax, accel_max, timeslice,
+                         vjump=0, jerk_time=0):
     """
     Given a distance to traverse, start and end velocities in the direction of
     movement, a maximum speed, an acceleration rate, and a minimum
@@ -441,7 +907,13 @@ def interpolate_distance(dist, vstart, vend, vmax, accel_max, timeslice):
     Velocity units are motor steps per second.
     Acceleration units are steps/second^2.
     Timeslice provided is in seconds.
+    Jump speed is the speed the motors can start and stop at instantly.
+    Jerk time, if set, selects S-curve rather than trapezoidal acceleration.
     """
+    if jerk_time:
+        return interpolate_distance_scurve(dist, vstart, vend, vmax,
+                                           accel_max, timeslice, jerk_time)
+
     accel_time = (vmax - vstart) / accel_max
     decel_time = (vmax - vend) / accel_max
     accel_dist = (vstart * accel_time) + (0.5 * accel_max * (accel_time**2))
@@ -456,10 +928,11 @@ def interpolate_distance(dist, vstart, vend, vmax, accel_max, timeslice):
     else:
         # Triangular or linear
         return interpolate_distance_triangular(dist, vstart, vend, accel_max,
-                                               timeslice)
+                                               timeslice, vjump)
 
 
-def interpolate_pair(start, vstart, end, vend, pen_up):
+def interpolate_pair(start, vstart, end, vend, pen_up, speed_scale=1.0,
+                     planner_config=None, short=False):
     """
     Given start/end positions, velocities, and pen state, return the array of
     distance/time to move between two points.
@@ -470,87 +943,523 @@ def interpolate_pair(start, vstart, end, vend, pen_up):
     We want to always be accelerating at a constant rate, decelerating at a
     constant rate, or moving at the maximum speed for this pen state.
     """
-    if pen_up:
-        vmax = config.SPEED_PEN_UP
-        accel_max = vmax / config.ACCEL_TIME_PEN_UP
-    else:
-        vmax = config.SPEED_PEN_DOWN
-        accel_max = vmax / config.ACCEL_TIME_PEN_DOWN
+    planner_config = planner_config or PlannerConfig.default()
+    vmax, accel_max = direction_limits(start, end, pen_up, speed_scale,
+                                       planner_config, short)
 
-    timeslice = config.TIME_SLICE
+    timeslice = planner_config.time_slice
+    vjump = jump_speed(pen_up, speed_scale, planner_config)
 
     dist = distance(end, start)
 
     assert vstart <= vmax, "%f must be <= %f" % (vstart, vmax)
     assert vend <= vmax, "%f must be <= %f" % (vend, vmax)
-    return interpolate_distance(dist, vstart, vend, vmax, accel_max, timeslice)
+    return interpolate_distance(dist, vstart, vend, vmax, accel_max, timeslice,
+                                vjump, planner_config.jerk_time)
+
+
+@functools.lru_cache(maxsize=config.INTERPOLATION_CACHE_SIZE)
+def memoized_distance(dist, vstart, vend, vmax, accel_max, timeslice, vjump,
+                      jerk_time):
+    """
+    Memoized interpolate_distance(), which doesn't depend on the direction of
+    the move. Text and fills repeat the same short strokes many times.
+    """
+    return tuple(interpolate_distance(dist, vstart, vend, vmax, accel_max,
+                                      timeslice, vjump, jerk_time))
+
+
+@functools.lru_cache(maxsize=config.INTERPOLATION_CACHE_SIZE)
+def memoized_moves(dx, dy, vstart, vend, vmax, accel_max, timeslice, vjump,
+                   jerk_time):
+    """
+    Memoized moves for a vector of (dx, dy) steps. Moves only depend on the
+    vector, not where it starts.
+    """
+    dist = distance((0, 0), (dx, dy))
+    dtarray = memoized_distance(dist, vstart, vend, vmax, accel_max,
+                                timeslice, vjump, jerk_time)
+    return tuple(dtarray_to_moves((0, 0), (dx, dy), dtarray))
+
+
+def interpolate_moves(start, vstart, end, vend, pen_up, speed_scale=1.0,
+                      planner_config=None, short=False):
+    """
+    Equivalent to dtarray_to_moves(start, end, interpolate_pair(...)), but
+    memoized on the move vector and speeds. Returns a tuple of moves, which
+    may be shared with other calls.
+
+    Speeds are matched exactly: interpolate_distance() treats equal start and
+    end speeds specially, so even rounding them to 1e-9 changes some plans.
+    Repeated strokes have bit-identical speeds anyway, since they come from
+    identical geometry.
+    """
+    planner_config = planner_config or PlannerConfig.default()
+    vmax, accel_max = direction_limits(start, end, pen_up, speed_scale,
+                                       planner_config, short)
+    assert vstart <= vmax, "%f must be <= %f" % (vstart, vmax)
+    assert vend <= vmax, "%f must be <= %f" % (vend, vmax)
+    return memoized_moves(end[0] - start[0], end[1] - start[1],
+                          vstart, vend, vmax, accel_max,
+                          planner_config.time_slice,
+                          jump_speed(pen_up, speed_scale, planner_config),
+                          planner_config.jerk_time)
+
+
+def interpolation_cache_stats():
+    """
+    Return a dict of hit and miss counts for the memoized interpolation
+    caches, since the process started or clear_interpolation_cache().
+    """
+    stats = {}
+    for name, func in (('distance', memoized_distance),
+                       ('moves', memoized_moves)):
+        info = func.cache_info()
+        stats[name] = {'hits': info.hits, 'misses': info.misses,
+                       'size': info.currsize}
+    return stats
 
 
-def interpolate_segment(segment, pen_up):
+def clear_interpolation_cache():
+    memoized_distance.cache_clear()
+    memoized_moves.cache_clear()
+
+
+def interpolate_segment(segment, pen_up, speed_scale=1.0,
+                        planner_config=None):
     """
     Given a segment with assigned speeds at each point, and a max
     acceleration/deceleration rate, create the moves to traverse the segment.
     """
-    assert segment[0][1] == 0
-    assert segment[-1][1] == 0
+    planner_config = planner_config or PlannerConfig.default()
+    vjump = jump_speed(pen_up, speed_scale, planner_config)
+    assert segment[0][1] <= vjump
+    assert segment[-1][1] <= vjump
+    short = is_short_move([point for point, speed in segment], pen_up,
+                          planner_config)
 
     actions = []
     # Iterate over point pairs.
     last_point, last_speed = segment[0]
     for point, speed in segment[1:]:
         if point != last_point:
-            dist_array = interpolate_pair(last_point, last_speed,
-                                          point, speed, pen_up)
-            actions.extend(dtarray_to_moves(last_point, point, dist_array))
+            actions.extend(interpolate_moves(last_point, last_speed,
+                                             point, speed, pen_up,
+                                             speed_scale, planner_config,
+                                             short))
         last_point = point
         last_speed = speed
     return actions
 
 
-def plan_actions(segments_with_speed, pen_up_delay, pen_down_delay):
+def iter_actions(segments_with_speed, pen_up_delay, pen_down_delay,
+                 last_pen_up=True, planner_config=None):
     """
-    Given a list of (segment, pen_up) tuples as returned by plan_speed(),
-    return a list of moves. Also add any pen state changes.
+    Generator version of plan_actions(), yielding a list of actions for each
+    segment as soon as it has been planned, starting with the pen move into
+    that segment if there is one. ``last_pen_up`` is the pen state before the
+    first segment.
     """
-    actions = []
-    last_pen_up = True
+    planner_config = planner_config or PlannerConfig.default()
     for segment, pen_up in segments_with_speed:
+        actions = []
         if pen_up != last_pen_up:
             if pen_up:
                 actions.append(PenUpMove(pen_up_delay))
             else:
                 actions.append(PenDownMove(pen_down_delay))
             last_pen_up = pen_up
-        actions.extend(interpolate_segment(segment, pen_up))
+        actions.extend(interpolate_segment(segment, pen_up,
+                                           planner_config=planner_config))
+        yield actions
+
+
+def plan_actions(segments_with_speed, pen_up_delay, pen_down_delay,
+                 planner_config=None):
+    """
+    Given a list of (segment, pen_up) tuples as returned by plan_speed(),
+    return a list of moves. Also add any pen state changes.
+    """
+    actions = []
+    for segment_actions in iter_actions(segments_with_speed,
+                                        pen_up_delay=pen_up_delay,
+                                        pen_down_delay=pen_down_delay,
+                                        planner_config=planner_config):
+        actions.extend(segment_actions)
     return actions
 
 
-def plan_job(document, filename):
-    pen_up_position = config.PEN_UP_POSITION
-    pen_down_position = config.PEN_DOWN_POSITION
-    servo_speed = config.SERVO_SPEED
-    pen_up_delay, pen_down_delay = \
-        calculate_pen_delays(pen_up_position, pen_down_position, servo_speed)
+def plan_seek(start, start_pen_up, end, end_pen_up,
+              pen_up_delay, pen_down_delay, planner_config=None):
+    """
+    Plan the actions to get from position ``start`` in steps with the pen in
+    state ``start_pen_up``, to position ``end`` with the pen in state
+    ``end_pen_up``: for example, to resume a job partway through. The move
+    itself is always made with the pen up.
+    """
+    actions = []
+    if not start_pen_up:
+        actions.append(PenUpMove(pen_up_delay))
+    if start != end:
+        segments_limits = plan_speed([([start, end], True)],
+                                     planner_config=planner_config)
+        actions.extend(plan_actions(segments_limits,
+                                    pen_up_delay=pen_up_delay,
+                                    pen_down_delay=pen_down_delay,
+                                    planner_config=planner_config))
+    if not end_pen_up:
+        actions.append(PenDownMove(pen_down_delay))
+    return actions
 
-    log.info("Loading %s...", filename)
+
+def max_acceleration(pen_up, planner_config=None):
+    """
+    Return the maximum acceleration in steps/ms^2 for a pen state.
+    """
+    return speed_limits(pen_up, planner_config=planner_config)[1]
+
+
+def move_vector(action):
+    """
+    Return the (dx, dy) of an XYMove in steps.
+    """
+    return ((action.m1 + action.m2) // 2,
+            (action.m1 - action.m2) // 2)
+
+
+def vector_to_move(dx, dy, duration):
+    # Convert to AxiDraw coordinate space.
+    return XYMove(m1=dx + dy, m2=dx - dy,
+                  duration=max(int(round(duration)), 30))
+
+
+def plan_pause(moves, vstart, accel_rate):
+    """
+    Plan a controlled stop while travelling at speed ``vstart`` in steps/ms,
+    decelerating at up to ``accel_rate`` along the upcoming planned ``moves``
+    rather than overshooting them. Moves are never sped up from their planned
+    duration, only slowed down.
+
+    Returns a tuple of (actions, consumed, remainder), where ``consumed`` is
+    the number of moves that were fully traversed while stopping, and
+    ``remainder`` is the untraversed part of the move that we stopped partway
+    through, or None.
+    """
+    actions = []
+    v = vstart
+    for consumed, move in enumerate(moves):
+        if (v <= 0) or not isinstance(move, XYMove):
+            # Already stopped, or at a pen move where the plan stops anyway.
+            return actions, consumed, None
+        dx, dy = move_vector(move)
+        dist = math.sqrt(dx**2 + dy**2)
+        stop_dist = v**2 / (2 * accel_rate)
+        if stop_dist < dist:
+            # Stop partway through this move, and keep the rest for later.
+            frac = stop_dist / dist
+            done_dx = int(round(dx * frac))
+            done_dy = int(round(dy * frac))
+            if not (done_dx or done_dy):
+                return actions, consumed, move
+            actions.append(vector_to_move(done_dx, done_dy,
+                                          2 * stop_dist / v))
+            if (done_dx, done_dy) == (dx, dy):
+                return actions, consumed + 1, None
+            remainder = vector_to_move(dx - done_dx, dy - done_dy,
+                                       move.duration * (1 - frac))
+            return actions, consumed, remainder
+        vend = math.sqrt(max(v**2 - 2 * accel_rate * dist, 0))
+        duration = max(move.duration, 2 * dist / (v + vend))
+        actions.append(vector_to_move(dx, dy, duration))
+        # Don't speed back up if the plan was slower than our deceleration.
+        v = min(vend, dist / duration)
+    return actions, len(actions), None
+
+
+def plan_unpause(moves, accel_rate):
+    """
+    Plan the re-acceleration from rest into the upcoming planned ``moves``,
+    by slowing down each move until the planned speed can be reached from
+    rest at ``accel_rate``.
+
+    Returns a tuple of (actions, consumed), where ``actions`` replace the
+    first ``consumed`` moves. The plan continues unchanged after that.
+    """
+    actions = []
+    v = 0
+    for consumed, move in enumerate(moves):
+        if not isinstance(move, XYMove):
+            return actions, consumed
+        dx, dy = move_vector(move)
+        dist = math.sqrt(dx**2 + dy**2)
+        vend = math.sqrt(v**2 + 2 * accel_rate * dist)
+        ramp_duration = 2 * dist / (v + vend)
+        if move.duration >= ramp_duration:
+            # Caught up with the planned speed profile.
+            return actions, consumed
+        actions.append(vector_to_move(dx, dy, ramp_duration))
+        v = vend
+    return actions, len(actions)
+
+
+def plan_resume(job, index, planner_config=None):
+    """
+    Plan the re-acceleration from rest into ``job`` at action ``index``, such
+    as a checkpoint, which is usually partway through a segment that was
+    planned to be travelling at speed. Starting the planned moves from a
+    standstill instead could make the motors lose steps.
+
+    Returns a tuple of (actions, index of the next job action to run after
+    them).
+    """
+    moves = (job[n] for n in range(index, len(job)))
+    ramp, consumed = plan_unpause(
+        moves, max_acceleration(job.pen_up_at(index), planner_config))
+    return ramp, index + consumed
+
+
+def bridge_tolerance(planner_config):
+    """
+    Return the tolerance for svg.iter_bridged(): bridges must retrace lines
+    already drawn, or None if any small gap may be bridged.
+    """
+    if planner_config.bridge_inked_only:
+        return planner_config.bridge_tolerance
+    return None
+
+
+def overlap_dpi(planner_config):
+    """
+    Return the grid for svg.remove_overlaps(), which is the motor steps, or
+    None if overlapping lines are plotted.
+    """
+    if planner_config.remove_overlaps:
+        return planner_config.dpi_16x
+    return None
+
+
+def plan_step_segments(document, progress=None, cancel=None,
+                       planner_config=None):
+    """
+    Plan the geometry to plot an SVG document: a list of (segment, pen_up)
+    tuples, with points in steps, ready for speed planning.
+    """
+    planner_config = planner_config or PlannerConfig.default()
     log.info("Extracting paths...")
+    if progress:
+        progress('extracting', 0)
     paths = svg.extract_paths(document)
-    paths = svg.preprocess_paths(paths)
+    paths = svg.preprocess_paths(paths, planner_config.join_tolerance,
+                                 overlap_dpi(planner_config))
     log.info("Planning segments...")
-    segments = svg.plan_segments(paths, resolution=config.CURVE_RESOLUTION)
+    segments = svg.plan_segments(track_progress(paths, 'segments',
+                                                progress=progress,
+                                                cancel=cancel),
+                                 resolution=planner_config.curve_resolution)
+    if planner_config.simplify_tolerance:
+        log.info("Simplifying segments...")
+        count = sum(len(segment) for segment in segments)
+        segments = svg.simplify_segments(segments,
+                                         planner_config.simplify_tolerance)
+        log.info("Simplified %d points to %d.", count,
+                 sum(len(segment) for segment in segments))
+    log.info("Bridging small gaps...")
+    count = len(segments)
+    segments = svg.bridge_gaps(segments, planner_config.min_gap,
+                               bridge_tolerance(planner_config))
+    log.info("Bridged %d gaps with the pen down.", count - len(segments))
     log.info("Adding pen-up moves...")
     segments = svg.add_pen_up_moves(segments)
     log.info("Converting inches to steps...")
-    step_segments = convert_inches_to_steps(segments)
+    segments = convert_inches_to_steps(segments, planner_config)
+    log.info("Collapsing collinear points and merging short moves...")
+    return list(iter_merged(iter_collapsed(segments, planner_config),
+                            planner_config))
+
+
+def segment_action_ranges(job):
+    """
+    Return a list of (start, stop) action index ranges of the XY moves planned
+    for each segment of ``job``.
+
+    Consecutive segments always alternate pen state, so each run of XY moves
+    between pen moves corresponds to exactly one segment.
+    """
+    kinds = np.asarray(job.kinds)
+    pen_moves = np.flatnonzero(kinds <= KIND_PEN_DOWN)
+    starts = [0] + (pen_moves + 1).tolist()
+    stops = pen_moves.tolist() + [len(kinds)]
+    return list(zip(starts, stops))
+
+
+def plan_segment_range(step_segments, start, stop, speed_scale=1.0,
+                       planner_config=None):
+    """
+    Plan the XY moves for segments ``start`` to ``stop`` of ``step_segments``
+    alone, with the speed limit scaled by ``speed_scale``. Every segment
+    starts and ends at the jump speed, so this is consistent with planning
+    the whole document at once.
+
+    Returns a list with one list of actions per segment.
+    """
+    planner_config = planner_config or PlannerConfig.default()
+    out = []
+    segments_limits = plan_speed(step_segments[start:stop], speed_scale,
+                                 planner_config)
+    for segment, pen_up in segments_limits:
+        out.append(interpolate_segment(segment, pen_up, speed_scale,
+                                       planner_config))
+    return out
+
+
+def stream_segment_actions(document, pen_up_delay, pen_down_delay,
+                           progress=None, cancel=None, planner_config=None):
+    """
+    Plan the actions to plot an SVG document lazily, returning a generator of
+    one list of actions per segment, as soon as each segment is planned.
+
+    Only path extraction and ordering need the whole document up front, so
+    the first actions are available almost immediately, rather than after the
+    whole document has been planned. Chaining the lists together gives the
+    same actions as plan_job(). Progress is reported as the 'planning' stage.
+    """
+    planner_config = planner_config or PlannerConfig.default()
+    log.info("Extracting paths...")
+    if progress:
+        progress('extracting', 0)
+    paths = svg.preprocess_paths(svg.extract_paths(document),
+                                 planner_config.join_tolerance,
+                                 overlap_dpi(planner_config))
+    segments = svg.iter_segments(track_progress(paths, 'planning',
+                                                progress=progress,
+                                                cancel=cancel),
+                                 resolution=planner_config.curve_resolution)
+    segments = svg.iter_simplified(segments,
+                                   planner_config.simplify_tolerance)
+    segments = svg.iter_bridged(segments, planner_config.min_gap,
+                                bridge_tolerance(planner_config))
+    segments = iter_steps(svg.iter_pen_up_moves(segments), planner_config)
+    segments = iter_merged(iter_collapsed(segments, planner_config),
+                           planner_config)
+    return iter_actions(iter_speed(segments, planner_config=planner_config),
+                        pen_up_delay=pen_up_delay,
+                        pen_down_delay=pen_down_delay,
+                        planner_config=planner_config)
+
+
+class PlanBuffer:
+    """
+    Run a planning generator in a background thread, keeping up to ``size``
+    of its items queued until they are consumed by iterating over the buffer.
+    Exceptions raised by the planner are re-raised to the consumer.
+
+    Closing the buffer, or abandoning iteration over it, stops the planner.
+    """
+    done = object()
+
+    def __init__(self, items, size=None):
+        self.queue = queue.Queue(size or config.PLAN_BUFFER_SIZE)
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, args=(items,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, items):
+        try:
+            for item in items:
+                if not self.put((item, None)):
+                    return
+        except Exception as e:
+            self.put((None, e))
+        else:
+            self.put((self.done, None))
+
+    def put(self, entry):
+        # Don't block forever if the consumer has gone away.
+        while not self.closed:
+            try:
+                self.queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        try:
+            while True:
+                item, error = self.queue.get()
+                if error:
+                    raise error
+                if item is self.done:
+                    return
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        self.closed = True
+
+
+def plan_job(document, filename, progress=None, cancel=None, workers=None,
+             planner_config=None):
+    """
+    Plan the actions to plot an SVG document, returning a Job.
+
+    If supplied, ``progress`` is called as ``progress(stage, percent)`` as
+    planning proceeds, and ``cancel`` is a CancelToken which will abort
+    planning with PlanningCanceled when triggered.
+
+    With more than one of ``workers`` (``config.PLANNER_WORKERS`` by
+    default), segments are planned in parallel processes, with identical
+    results. ``planner_config`` is a PlannerConfig, defaulting to the
+    settings in ``axibot.config``.
+    """
+    planner_config = planner_config or PlannerConfig.default()
+    pen_up_position = planner_config.pen_up_position
+    pen_down_position = planner_config.pen_down_position
+    servo_speed = planner_config.servo_speed
+    servo_down_speed = planner_config.servo_down_speed
+    pen_up_delay, pen_down_delay = \
+        calculate_pen_delays(pen_up_position, pen_down_position, servo_speed,
+                             planner_config, servo_down_speed)
+    workers = workers or config.PLANNER_WORKERS
+    metadata = dict(pen_up_position=pen_up_position,
+                    pen_down_position=pen_down_position,
+                    servo_speed=servo_speed,
+                    servo_down_speed=servo_down_speed,
+                    document=document,
+                    filename=filename)
+
+    def track(items, stage):
+        return track_progress(items, stage, progress=progress, cancel=cancel)
+
+    log.info("Loading %s...", filename)
+    step_segments = plan_step_segments(document, progress=progress,
+                                       cancel=cancel,
+                                       planner_config=planner_config)
+    if workers > 1:
+        from . import parallel
+        if not parallel.available:
+            log.warn("Parallel planning needs Python 3.8 or later. "
+                     "Planning in one process.")
+            workers = 1
+    if workers > 1:
+        records = parallel.plan_records(step_segments,
+                                        pen_up_delay=pen_up_delay,
+                                        pen_down_delay=pen_down_delay,
+                                        workers=workers,
+                                        progress=progress, cancel=cancel,
+                                        planner_config=planner_config)
+        return Job.from_records(records, **metadata)
     log.info("Planning speed limits...")
-    segments_limits = plan_speed(step_segments)
+    segments_limits = plan_speed(track(step_segments, 'speed'),
+                                 planner_config=planner_config)
     log.info("Planning actions...")
-    actions = plan_actions(segments_limits,
+    actions = plan_actions(track(segments_limits, 'actions'),
                            pen_up_delay=pen_up_delay,
-                           pen_down_delay=pen_down_delay)
-    return Job(actions,
-               pen_up_position=pen_up_position,
-               pen_down_position=pen_down_position,
-               servo_speed=servo_speed,
-               document=document,
-               filename=filename)
+                           pen_down_delay=pen_down_delay,
+                           planner_config=planner_config)
+    stats = interpolation_cache_stats()['moves']
+    log.debug("Interpolation cache: %d hits, %d misses.",
+              stats['hits'], stats['misses'])
+    return Job(actions, **metadata)
@@ -0,0 +1,99 @@
+"""
+Per-machine profiles.
+
+Every AxiDraw's servo and pen holder behave a little differently, so settings
+calibrated for a particular machine, such as the pen delays measured by
+``axibot manual --calibrate``, are saved in a named profile. A profile is a
+JSON object of settings which override those in ``axibot.config``.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+
+import os.path
+import json
+
+from . import config
+from .checkpoint import fsync_write
+
+log = logging.getLogger(__name__)
+
+
+# Settings in ``axibot.config`` which a profile may override.
+PROFILE_SETTINGS = (
+    'SERVO_SPEED',
+    'SERVO_DOWN_SPEED',
+    'EXTRA_PEN_UP_DELAY',
+    'EXTRA_PEN_DOWN_DELAY',
+    'PEN_UP_POSITION',
+    'PEN_DOWN_POSITION',
+    'JUMP_SPEED',
+    'CHORD_TOLERANCE',
+    'JOIN_TOLERANCE',
+)
+
+
+def profile_path(name):
+    return os.path.join(config.PROFILE_DIR, name + '.json')
+
+
+def load(name):
+    """
+    Return the settings saved in profile ``name`` as a dict, or None if there
+    is no such profile.
+    """
+    path = profile_path(name)
+    try:
+        with open(path) as f:
+            settings = json.load(f)
+    except (IOError, OSError):
+        return None
+    for key in list(settings):
+        if key not in PROFILE_SETTINGS:
+            log.warn("Ignoring unknown setting %s in profile %s.", key, path)
+            del settings[key]
+    return settings
+
+
+def save(name, settings):
+    """
+    Save ``settings`` as profile ``name``, replacing any existing profile.
+    """
+    fsync_write(profile_path(name),
+                json.dumps(settings, indent=2,
+                           sort_keys=True).encode('utf-8'))
+
+
+def apply(settings):
+    """
+    Override the settings in ``axibot.config`` with ``settings``.
+    """
+    for key, value in settings.items():
+        setattr(config, key, value)
+
+
+def activate(name=None):
+    """
+    Apply profile ``name``, defaulting to ``config.PROFILE``. Returns the
+    settings which were applied, or None if there is no such profile.
+    """
+    settings = load(name or config.PROFILE)
+    if settings:
+        apply(settings)
+    return settings
+
+
+def shortest_delay(reliable, low, high, resolution=5):
+    """
+    Return the shortest delay in ms, to within ``resolution``, for which
+    ``reliable(delay)`` returns True. It's assumed to be True for ``high``,
+    and to stay True for any longer delay.
+    """
+    while high - low > resolution:
+        delay = (low + high) // 2
+        if reliable(delay):
+            high = delay
+        else:
+            low = delay
+    return high
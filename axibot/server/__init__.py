@@ -6,7 +6,7 @@ from aiohttp import web
 import aiohttp_mako
 
 from ..ebb import EiBotBoard, MockEiBotBoard
-from .. import planning, config
+from .. import planning, config, cache
 
 from . import views, handlers, plotting
 from .state import State
@@ -22,24 +22,35 @@ base_dir = os.path.dirname(os.path.dirname(__here__))
 examples_dir = os.path.join(base_dir, 'examples')
 
 
-def make_app(bot):
-    app = web.Application()
-
+def setup_state(app, bot, use_cache=True):
+    """
+    Initialize the plotting state of ``app``, which drives ``bot``.
+    """
     app['state'] = State.idle
     app['action_index'] = 0
     app['clients'] = set()
     app['bot'] = bot
     app['position'] = 0, 0
     app['pen_up'] = None
+    app['upload_task'] = None
+    app['planning_job'] = None
+    app['failed_job'] = None
+    app['pause'] = None
+    app['speed_override'] = 1.0
+    app['replanner'] = None
+    app['plan_cache'] = cache.PlanCache() if use_cache else False
+    app['planner_config'] = planner_config = planning.PlannerConfig.default()
 
     bot.enable_motors(1)
     bot.servo_setup(config.PEN_DOWN_POSITION, config.PEN_UP_POSITION,
-                    config.SERVO_SPEED, config.SERVO_SPEED)
+                    config.SERVO_SPEED, config.SERVO_DOWN_SPEED)
 
     app['pen_up_delay'], app['pen_down_delay'] = \
-        planning.calculate_pen_delays(config.PEN_UP_POSITION,
-                                      config.PEN_DOWN_POSITION,
-                                      config.SERVO_SPEED)
+        planning.calculate_pen_delays(planner_config.pen_up_position,
+                                      planner_config.pen_down_position,
+                                      planner_config.servo_speed,
+                                      planner_config,
+                                      planner_config.servo_down_speed)
 
     # This will initialize the server state.
     filename = 'line.svg'
@@ -49,6 +60,14 @@ def make_app(bot):
         app['estimated_time'] = job.duration().total_seconds()
         app['consumed_time'] = 0
 
+    # Pick up where we left off if the server died while plotting.
+    plotting.restore_checkpoint(app)
+
+
+def make_app(bot, use_cache=True):
+    app = web.Application()
+    setup_state(app, bot, use_cache=use_cache)
+
     aiohttp_mako.setup(app,
                        directories=[template_dir],
                        input_encoding='utf-8',
@@ -71,7 +90,7 @@ def serve(opts):
         bot = EiBotBoard.find()
 
     try:
-        app = make_app(bot)
+        app = make_app(bot, use_cache=opts.cache)
         web.run_app(app, port=opts.port)
     finally:
         bot.close()
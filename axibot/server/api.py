@@ -7,6 +7,7 @@ Server to client messages:
     new document
     error
     completed job
+    progress of a long-running operation
 
 Client to server messages:
 
@@ -14,7 +15,9 @@ Client to server messages:
     manual pen up
     manual pen down
     resume plotting
+    pause plotting
     cancel plotting
+    set speed override
 """
 import json
 
@@ -37,7 +40,7 @@ class StateMessage(Message):
     Inform a connected client that the server's state has changed.
     """
     def __init__(self, state, num_actions, action_index, x, y, pen_up,
-                 estimated_time, consumed_time):
+                 estimated_time, consumed_time, speed_override):
         self.state = state
         self.num_actions = num_actions
         self.action_index = action_index
@@ -46,6 +49,7 @@ class StateMessage(Message):
         self.pen_up = pen_up
         self.estimated_time = estimated_time
         self.consumed_time = consumed_time
+        self.speed_override = speed_override
 
 
 class NewDocumentMessage(Message):
@@ -75,6 +79,17 @@ class CompletedJobMessage(Message):
         self.actual_time = actual_time
 
 
+class ProgressMessage(Message):
+    """
+    Inform connected clients of the progress of a long-running operation,
+    like processing an uploaded document.
+    """
+    def __init__(self, operation, stage, percent):
+        self.operation = operation
+        self.stage = stage
+        self.percent = percent
+
+
 class SetDocumentMessage(Message):
     """
     Instruct the server to set a new active document.
@@ -100,7 +115,16 @@ class ManualPenDownMessage(Message):
 
 class ResumePlottingMessage(Message):
     """
-    Instruct the server to resume plotting.
+    Instruct the server to resume plotting. If ``seconds`` is given, plotting
+    resumes from that far into the job.
+    """
+    def __init__(self, seconds=None):
+        self.seconds = seconds
+
+
+class PausePlottingMessage(Message):
+    """
+    Instruct the server to pause plotting, holding position with the pen up.
     """
     pass
 
@@ -112,16 +136,28 @@ class CancelPlottingMessage(Message):
     pass
 
 
+class SetSpeedOverrideMessage(Message):
+    """
+    Instruct the server to scale the planned speed by ``percent``, taking
+    effect a few segments ahead without stopping.
+    """
+    def __init__(self, percent):
+        self.percent = percent
+
+
 Message.types = {
     'state': StateMessage,
     'new-document': NewDocumentMessage,
     'error': ErrorMessage,
     'completed-job': CompletedJobMessage,
+    'progress': ProgressMessage,
     'set-document': SetDocumentMessage,
     'manual-pen-up': ManualPenUpMessage,
     'manual-pen-down': ManualPenDownMessage,
     'resume-plotting': ResumePlottingMessage,
+    'pause-plotting': PausePlottingMessage,
     'cancel-plotting': CancelPlottingMessage,
+    'set-speed-override': SetSpeedOverrideMessage,
 }
 
 Message.reverse_types = {v: k for k, v in Message.types.items()}
@@ -1,8 +1,12 @@
 import logging
 
+import asyncio
+
 import aiohttp
 from aiohttp import web
 
+from .. import planning
+
 from . import api, plotting
 from .state import State
 
@@ -29,6 +33,7 @@ def notify_state(app, specific_client=None, exclude_client=None):
         x=app['position'][0],
         y=app['position'][1],
         pen_up=app['pen_up'],
+        speed_override=int(round(app['speed_override'] * 100)),
     )
     if specific_client:
         specific_client.send_str(msg.serialize())
@@ -55,47 +60,161 @@ def notify_job_complete(app):
     broadcast(app, msg)
 
 
-async def handle_user_message(app, ws, msg):
-    if isinstance(msg, api.SetDocumentMessage):
-        assert app['state'] == State.idle
-        try:
-            app['state'] = State.processing
-            notify_state(app)
-            job = await plotting.process_upload_background(app,
-                                                           msg.document,
-                                                           msg.filename)
-        except Exception as e:
-            notify_error(app, ws, str(e))
+def notify_progress(app, operation, stage, percent):
+    msg = api.ProgressMessage(operation=operation, stage=stage,
+                              percent=percent)
+    broadcast(app, msg)
+
+
+def check_state(app, ws, action, *allowed):
+    """
+    Guard a user command against the current server state. If the server is
+    not in one of the ``allowed`` states, tell the requesting client why the
+    command was refused and return False.
+    """
+    state = app['state']
+    if state in allowed:
+        return True
+    log.warn("Refusing to %s while %s.", action, state.name)
+    notify_error(app, ws, "Cannot %s while %s." % (action, state.name))
+    return False
+
+
+def set_job(app, job):
+    app['job'] = job
+    app['failed_job'] = None
+    app['action_index'] = 0
+    app['replanner'] = None
+    app['estimated_time'] = job.duration().total_seconds()
+    notify_new_document(app)
+
+
+async def upload_document(app, ws, msg):
+    app['state'] = State.processing
+    notify_state(app)
+    notify_progress(app, 'upload', 'processing', 0)
+    previous_job = app['job']
+    cancel = planning.CancelToken()
+    canceled = False
+    try:
+        job = await app.loop.run_in_executor(None, plotting.lookup_upload,
+                                             app, msg.document, msg.filename)
+        if job is None:
+            # Plotting can start while this is still running.
+            job = await plotting.stream_upload(app, msg.document,
+                                               msg.filename, cancel=cancel)
         else:
-            app['job'] = job
-            app['estimated_time'] = job.duration().total_seconds()
-            notify_new_document(app)
-        finally:
-            app['state'] = State.idle
+            set_job(app, job)
+    except (asyncio.CancelledError, planning.PlanningCanceled):
+        # Stop the planner thread too, it doesn't know we've given up on it.
+        log.info("Upload of %s canceled.", msg.filename)
+        cancel.cancel()
+        canceled = True
+        restore_job(app, previous_job)
+    except Exception as e:
+        notify_error(app, ws, str(e))
+        restore_job(app, previous_job)
+    else:
+        if app['speed_override'] != 1.0:
+            plotting.set_speed_override(app, app['speed_override'])
+        notify_progress(app, 'upload', 'done', 100)
+    finally:
+        # If this upload was superseded by a newer one, that one now owns the
+        # server state. If plotting started while the upload was being
+        # planned, leave that alone too.
+        if (not canceled) or (app['upload_task'] is None):
+            app['upload_task'] = None
+            if app['state'] == State.processing:
+                app['state'] = State.idle
             notify_state(app)
 
+
+def restore_job(app, previous_job):
+    """
+    Go back to ``previous_job`` after a failed upload, unless the partly
+    planned job has already been plotted from.
+    """
+    if ((app['job'] is not previous_job) and
+            (app['state'] in (State.processing, State.idle))):
+        set_job(app, previous_job)
+
+
+def set_document(app, ws, msg):
+    # A new upload supersedes any upload which is still being processed.
+    abort_upload(app)
+    app['upload_task'] = app.loop.create_task(upload_document(app, ws, msg))
+
+
+def abort_upload(app):
+    task = app['upload_task']
+    if task:
+        log.info("Canceling in-flight upload.")
+        app['upload_task'] = None
+        task.cancel()
+
+
+async def handle_user_message(app, ws, msg):
+    if isinstance(msg, api.SetDocumentMessage):
+        if check_state(app, ws, 'set document',
+                       State.idle, State.processing):
+            set_document(app, ws, msg)
+
     elif isinstance(msg, api.ManualPenUpMessage):
-        assert app['state'] == State.idle
-        plotting.manual_pen_up(app)
+        if check_state(app, ws, 'raise pen', State.idle):
+            plotting.manual_pen_up(app)
 
     elif isinstance(msg, api.ManualPenDownMessage):
-        assert app['state'] == State.idle
-        plotting.manual_pen_down(app)
+        if check_state(app, ws, 'lower pen', State.idle):
+            plotting.manual_pen_down(app)
 
     elif isinstance(msg, api.ResumePlottingMessage):
-        assert app['state'] == State.idle
-        plotting.resume(app)
-        notify_state(app)
+        if check_state(app, ws, 'resume plotting',
+                       State.idle, State.paused, State.processing):
+            if ((app['state'] == State.processing) and
+                    (app['job'] is not app['planning_job'])):
+                notify_error(app, ws, "Cannot plot until planning starts.")
+            elif app['job'] is app['failed_job']:
+                notify_error(app, ws, "Cannot plot a document which failed "
+                             "to plan.")
+            else:
+                plotting.resume(app, seconds=msg.seconds)
+                notify_state(app)
+
+    elif isinstance(msg, api.PausePlottingMessage):
+        if check_state(app, ws, 'pause plotting', State.plotting):
+            plotting.pause(app)
 
     elif isinstance(msg, api.CancelPlottingMessage):
-        assert app['state'] == State.plotting
-        plotting.cancel(app)
-        notify_state(app)
+        if check_state(app, ws, 'cancel',
+                       State.plotting, State.processing, State.paused):
+            if app['state'] == State.processing:
+                abort_upload(app)
+            else:
+                plotting.cancel(app)
+                notify_state(app)
+
+    elif isinstance(msg, api.SetSpeedOverrideMessage):
+        plotting.set_speed_override(app, msg.percent / 100.)
 
     else:
         log.error("Unknown user message: %s, ignoring.", msg)
 
 
+async def run_user_message(app, ws, msg):
+    """
+    Handle a single user message as its own task, so that a slow command
+    (like processing a large upload) doesn't block the client connection
+    from sending further commands.
+    """
+    try:
+        await handle_user_message(app, ws, msg)
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        log.exception("Error handling user message: %s", msg)
+        notify_error(app, ws, str(e))
+
+
 async def client_handler(request):
     ws = web.WebSocketResponse()
     await ws.prepare(request)
@@ -112,7 +231,7 @@ async def client_handler(request):
             if raw_msg.tp == aiohttp.MsgType.text:
                 msg = api.Message.deserialize(raw_msg.data)
                 log.info("User message: %s", msg)
-                await handle_user_message(app, ws, msg)
+                app.loop.create_task(run_user_message(app, ws, msg))
             elif raw_msg.tp == aiohttp.MsgType.closed:
                 break
             elif raw_msg.tp == aiohttp.MsgType.error:
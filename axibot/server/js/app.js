@@ -11,7 +11,10 @@ var vm = new Vue({
     'consumedTime': 0,
     'estimatedTime': 0,
     'actionIndex': 0,
-    'numActions': 0
+    'numActions': 0,
+    'speedOverride': 100,
+    'progressStage': null,
+    'progressPercent': 0
   },
   computed: {
     previewX: function () {
@@ -37,6 +40,13 @@ var vm = new Vue({
     resumePlotting: function () {
       this.sendMessage({type: "resume-plotting"});
     },
+    setSpeedOverride: function (e) {
+      this.sendMessage({type: "set-speed-override",
+                        percent: parseInt(e.target.value)});
+    },
+    pausePlotting: function () {
+      this.sendMessage({type: "pause-plotting"});
+    },
     cancelPlotting: function () {
       this.sendMessage({type: "cancel-plotting"});
     },
@@ -79,12 +89,17 @@ var vm = new Vue({
         vm.penUp = msg.pen_up;
         vm.consumedTime = msg.consumed_time;
         vm.estimatedTime = msg.estimated_time;
+        vm.speedOverride = msg.speed_override;
 
       } else if (msg.type == 'new-document') {
         var doc = document.getElementById('document');
         console.log("received file", msg.filename);
         doc.innerHTML = msg.document;
 
+      } else if (msg.type == 'progress') {
+        vm.progressStage = msg.stage;
+        vm.progressPercent = msg.percent;
+
       } else if (msg.type == 'completed-job') {
         var est = utils.secondsToString(msg.estimated_time);
         var actual = utils.secondsToString(msg.actual_time);
@@ -1,9 +1,13 @@
 import logging
 
+import asyncio
+import os.path
 import math
+import itertools
 from six.moves import StringIO
+from io import BytesIO
 
-from .. import planning, config
+from .. import planning, config, cache, checkpoint
 from ..job import Job
 from ..action import PenUpMove, PenDownMove, XYMove
 
@@ -20,10 +24,13 @@ def estimate_time(actions):
 def step_segments_to_actions(app, step_segments):
     pen_up_delay = app['pen_up_delay']
     pen_down_delay = app['pen_down_delay']
-    segments_limits = planning.plan_speed(step_segments)
+    planner_config = app['planner_config']
+    segments_limits = planning.plan_speed(step_segments,
+                                          planner_config=planner_config)
     return planning.plan_actions(segments_limits,
                                  pen_up_delay=pen_up_delay,
-                                 pen_down_delay=pen_down_delay)
+                                 pen_down_delay=pen_down_delay,
+                                 planner_config=planner_config)
 
 
 def plan_pen_up_move(app, start, end):
@@ -40,12 +47,13 @@ def plan_deceleration(app, position, v):
 
     Return a tuple of (end point, actions)
     """
+    planner_config = app['planner_config']
     if app['pen_up']:
-        vmax = config.SPEED_PEN_UP
-        accel_time = config.ACCEL_TIME_PEN_UP
+        vmax = planner_config.speed_pen_up
+        accel_time = planner_config.accel_time_pen_up
     else:
-        vmax = config.SPEED_PEN_DOWN
-        accel_time = config.ACCEL_TIME_PEN_DOWN
+        vmax = planner_config.speed_pen_down
+        accel_time = planner_config.accel_time_pen_down
 
     # Calculate distance required for deceleration.
     vx, vy = v
@@ -72,21 +80,99 @@ def plan_deceleration(app, position, v):
 
     # Plan the actions for this deceleration segment.
     dtarray = planning.interpolate_pair(position, vmag,
-                                        end, 0, app['pen_up'])
+                                        end, 0, app['pen_up'],
+                                        planner_config=planner_config)
     return end, planning.dtarray_to_moves(position, end, dtarray)
 
 
-def process_upload(app, document, filename):
+def process_upload(app, document, filename, progress=None, cancel=None):
     if document[0] == '{':
         f = StringIO(document)
         return Job.deserialize(f)
     else:
-        return planning.plan_job(document, filename=filename)
+        return cache.plan_job(document, filename=filename,
+                              cache=app['plan_cache'],
+                              planner_config=app['planner_config'],
+                              progress=progress, cancel=cancel)
 
 
-async def process_upload_background(app, document, filename):
-    return await app.loop.run_in_executor(None, process_upload, app,
-                                          document, filename)
+def lookup_upload(app, document, filename):
+    """
+    Return the job for an upload if it's available without planning: either
+    a serialized job, or an SVG document in the plan cache. Otherwise return
+    None.
+    """
+    if document[0] == '{':
+        f = StringIO(document)
+        return Job.deserialize(f)
+    elif app['plan_cache']:
+        return app['plan_cache'].get(document, filename=filename,
+                                     planner_config=app['planner_config'])
+    return None
+
+
+async def stream_upload(app, document, filename, cancel=None):
+    """
+    Plan an uploaded SVG document, making it the current job straight away
+    and extending it with batches of whole segments as they are planned, so
+    that plotting can start before planning has finished. Batches always end
+    at a segment boundary, where the carriage can stop instantly, so plotting
+    can safely wait there if it catches up with the planner.
+
+    Returns the job once it is complete.
+    """
+    planner_config = app['planner_config']
+    job = Job(pen_up_position=planner_config.pen_up_position,
+              pen_down_position=planner_config.pen_down_position,
+              servo_speed=planner_config.servo_speed,
+              servo_down_speed=planner_config.servo_down_speed,
+              document=document,
+              filename=filename)
+    app['planning_job'] = job
+    handlers.set_job(app, job)
+
+    def progress(stage, percent):
+        # Called from the executor thread, so hop back onto the event loop.
+        app.loop.call_soon_threadsafe(handlers.notify_progress, app,
+                                      'upload', stage, percent)
+
+    def extend(actions):
+        job.extend(actions)
+        app['estimated_time'] = job.duration().total_seconds()
+        handlers.notify_state(app)
+
+    def run():
+        segments = planning.stream_segment_actions(
+            document,
+            pen_up_delay=app['pen_up_delay'],
+            pen_down_delay=app['pen_down_delay'],
+            progress=progress, cancel=cancel,
+            planner_config=planner_config)
+        batch = []
+        for n, actions in enumerate(segments, start=1):
+            batch.extend(actions)
+            if n % config.PLAN_BUFFER_SIZE == 0:
+                app.loop.call_soon_threadsafe(extend, batch)
+                batch = []
+        return batch
+
+    try:
+        extend(await app.loop.run_in_executor(None, run))
+    except BaseException:
+        # Only the start of the document was planned, so plot_task() must
+        # not plot it to the end as if it were the whole job.
+        app['failed_job'] = job
+        raise
+    finally:
+        app['planning_job'] = None
+
+    if app['plan_cache']:
+        try:
+            await app.loop.run_in_executor(None, app['plan_cache'].put,
+                                           document, job, planner_config)
+        except (IOError, OSError) as e:
+            log.warn("Could not cache plan for %s: %s", filename, e)
+    return job
 
 
 def update_bot_state(app, action):
@@ -104,8 +190,99 @@ def update_bot_state(app, action):
         app['consumed_time'] += (action.delay / 1000.)
 
 
+def update_job_state(app, index):
+    """
+    Set the bot state to the state it will have when starting the action at
+    ``index`` in the current job, using the job's time/position index.
+    """
+    job = app['job']
+    app['position'] = job.position_at(index)
+    app['pen_up'] = job.pen_up_at(index)
+    app['consumed_time'] = job.time_at(index) / 1000.
+
+
+async def run_actions(app, actions):
+    """
+    Run actions which aren't part of the current job, like moves to get the
+    pen into position.
+    """
+    bot = app['bot']
+    for action in actions:
+        def run_action():
+            bot.do(action)
+        update_bot_state(app, action)
+        await app.loop.run_in_executor(None, run_action)
+        handlers.notify_state(app)
+
+
+def plan_seek(app, index):
+    """
+    Plan the actions to take the bot from its current position and pen state
+    to the state required to start the action at ``index`` in the current job.
+    """
+    job = app['job']
+    start = tuple(int(round(v)) for v in app['position'])
+    return planning.plan_seek(start, app['pen_up'],
+                              job.position_at(index), job.pen_up_at(index),
+                              pen_up_delay=app['pen_up_delay'],
+                              pen_down_delay=app['pen_down_delay'],
+                              planner_config=app['planner_config'])
+
+
+def checkpoint_job_path():
+    return os.path.join(config.CHECKPOINT_DIR, 'job.axibot.bin')
+
+
+def restore_checkpoint(app):
+    """
+    If the server died while plotting, reload the job it was plotting and
+    set it up to resume where it left off.
+    """
+    saved = checkpoint.load()
+    if not saved:
+        return
+    try:
+        job = Job.deserialize_binary(checkpoint_job_path())
+    except (IOError, OSError, ValueError) as e:
+        log.warn("Found a checkpoint, but could not load its job: %s", e)
+        return
+    if job.content_hash() != saved['job_hash']:
+        log.warn("Found a checkpoint, but it doesn't match the saved job.")
+        return
+    log.warn("Restored checkpoint of %s at action %d/%d. Move the carriage "
+             "to the origin, then resume plotting.",
+             job.filename, saved['action_index'], len(job))
+    app['job'] = job
+    app['action_index'] = saved['action_index']
+    app['estimated_time'] = job.duration().total_seconds()
+    app['consumed_time'] = job.time_at(saved['action_index']) / 1000.
+
+
+def start_checkpoint(app, job):
+    """
+    Save ``job`` alongside the checkpoint so that it can be restored, and
+    return a Checkpointer for recording progress through it.
+    """
+    checkpointer = checkpoint.Checkpointer(job)
+    path = checkpoint_job_path()
+    if not (os.path.exists(path) and
+            checkpointer.matches(checkpoint.load())):
+        f = BytesIO()
+        job.serialize_binary(f)
+        checkpoint.fsync_write(path, f.getvalue())
+    checkpointer.update(app['action_index'], force=True)
+    return checkpointer
+
+
+def job_moves(job, start):
+    for n in range(start, len(job)):
+        yield job[n]
+
+
 async def cancel_to_origin(app, action):
-    if isinstance(action, PenUpMove):
+    if action is None:
+        v = 0, 0
+    elif isinstance(action, PenUpMove):
         v = 0, 0
     elif isinstance(action, PenDownMove):
         v = 0, 0
@@ -128,57 +305,310 @@ async def cancel_to_origin(app, action):
     orig_estimated = app['estimated_time']
     app['estimated_time'] = estimate_time(actions)
     app['consumed_time'] = 0
-    bot = app['bot']
 
-    for action in actions:
-        def run_action():
-            bot.do(action)
-        update_bot_state(app, action)
-        await app.loop.run_in_executor(None, run_action)
-        handlers.notify_state(app)
+    await run_actions(app, actions)
 
     app['estimated_time'] = orig_estimated
     app['consumed_time'] = 0
 
 
-async def plot_task(app):
-    log.debug("plot_task: begin")
-    app['state'] = State.plotting
-    bot = app['bot']
-    app['consumed_time'] = 0
-
-    if app['pen_up'] is not True:
-        bot.pen_up(app['pen_up_delay'])
-        app['pen_up'] = True
+async def pause_in_place(app, action, action_index, replanned=None):
+    """
+    Decelerate to a stop along the planned path after ``action``, then lift
+    the pen. Remember where we stopped, including the part of the move we
+    stopped partway through, so that plotting can resume from there.
 
-    while True:
-        job = app['job']
-        action_index = app['action_index']
-        action = job[action_index]
+    If we're partway through a segment replanned for the speed override,
+    ``replanned`` is a tuple of (index after the segment, the segment's
+    actions still to run), and ``action_index`` is the start of the segment.
+    """
+    job = app['job']
+    pen_up = app['pen_up']
+    if isinstance(action, XYMove):
+        dx, dy = planning.move_vector(action)
+        v = math.sqrt(dx**2 + dy**2) / action.duration
+    else:
+        v = 0
+    accel_rate = planning.max_acceleration(pen_up, app['planner_config'])
+    if replanned:
+        # The segment ends with a pen move, so we always stop within it.
+        stop, pending = replanned
+        actions, consumed, remainder = planning.plan_pause(pending, v,
+                                                           accel_rate)
+        if remainder:
+            pending = [remainder] + pending[consumed + 1:]
+        else:
+            pending = pending[consumed:]
+        # Only whole segments of the job are checkpointed.
+        app['action_index'] = action_index
+        app['pause'] = stop, pending
+    else:
+        actions, consumed, remainder = planning.plan_pause(
+            job_moves(job, action_index), v, accel_rate)
+        app['action_index'] = action_index + consumed
+        if remainder:
+            app['pause'] = app['action_index'] + 1, [remainder]
+        else:
+            app['pause'] = app['action_index'], []
+    if not pen_up:
+        actions.append(PenUpMove(app['pen_up_delay']))
+    await run_actions(app, actions)
 
-        def run_action():
-            bot.do(action)
 
-        update_bot_state(app, action)
-        await app.loop.run_in_executor(None, run_action)
-        action_index += 1
-        if action_index == len(job):
-            # Finished
-            log.debug("plot_task: plotting complete")
-            handlers.notify_job_complete(app)
-            app['consumed_time'] = 0
-            break
+def plan_unpause(app):
+    """
+    Plan the actions to resume from a pause: drop the pen if needed, and then
+    re-accelerate into the moves left over from the pause and the rest of the
+    job. Returns a tuple of (actions, index of the next job action to run
+    after them).
+    """
+    job = app['job']
+    index, pending = app['pause']
+    pen_up = job.pen_up_at(index)
+    actions = []
+    if not pen_up:
+        actions.append(PenDownMove(app['pen_down_delay']))
+    moves = itertools.chain(pending, job_moves(job, index))
+    ramp, consumed = planning.plan_unpause(
+        moves, planning.max_acceleration(pen_up, app['planner_config']))
+    actions.extend(ramp)
+    # Left over moves which didn't need slowing down still need doing.
+    actions.extend(pending[consumed:])
+    return actions, index + max(consumed - len(pending), 0)
+
+
+class Replanner:
+    """
+    Replans a rolling window of upcoming segments of a job in the background
+    with the feed-rate override applied, so that the speed can be changed
+    without stopping.
+
+    Every segment starts and ends at the jump speed, so a replanned segment
+    can simply be swapped in for the actions originally planned for it.
+    Segments which haven't been replanned yet are plotted as originally
+    planned.
+    """
+    def __init__(self, app, job):
+        self.app = app
+        self.job = job
+        self.step_segments = None
+        self.ranges = None
+        self.starts = None
+        self.scale = None
+        self.planned = {}
+        self.pending = False
+        future = app.loop.run_in_executor(None, self.prepare)
+        future.add_done_callback(self.prepared)
+
+    def prepare(self):
+        # The job only has actions, so re-derive the segment geometry from its
+        # document.
+        step_segments = planning.plan_step_segments(
+            self.job.document, planner_config=self.app['planner_config'])
+        ranges = planning.segment_action_ranges(self.job)
+        if len(ranges) != len(step_segments):
+            raise ValueError("Job %s doesn't match its document." %
+                             self.job.filename)
+        # The job may have been planned with other settings, so only swap in
+        # segments which start and end where the job's own actions do.
+        self.starts = {}
+        mismatched = 0
+        for n, (start, stop) in enumerate(ranges):
+            segment, pen_up = step_segments[n]
+            if start == stop:
+                continue
+            if ((tuple(segment[0]) == self.job.position_at(start)) and
+                    (tuple(segment[-1]) == self.job.position_at(stop)) and
+                    (pen_up == self.job.pen_up_at(start))):
+                self.starts[start] = n
+            else:
+                mismatched += 1
+        if mismatched:
+            log.warn("%d segments of %s don't match its document, and will "
+                     "be plotted at the original speed.", mismatched,
+                     self.job.filename)
+        self.ranges = ranges
+        self.step_segments = step_segments
+
+    def prepared(self, future):
+        if future.exception():
+            log.error("Can't override speed: %s", future.exception())
+
+    def take(self, index, scale):
+        """
+        If the segment starting at action ``index`` has been replanned at
+        ``scale``, return a tuple of (index after the segment, actions).
+        Otherwise return None, and the job's own actions should be used.
+        """
+        if (self.step_segments is None) or (scale == 1.0):
+            return None
+        n = self.starts.get(index)
+        if n is None:
+            return None
+        if scale != self.scale:
+            self.scale = scale
+            self.planned = {}
+        # Keep the window ahead of us topped up.
+        self.schedule(n + 1, scale)
+        actions = self.planned.pop(n, None)
+        if actions is None:
+            return None
+        return self.ranges[n][1], actions
+
+    def schedule(self, n, scale):
+        if self.pending:
+            return
+        stop = min(n + config.REPLAN_WINDOW, len(self.ranges))
+        missing = [k for k in range(n, stop) if k not in self.planned]
+        if not missing:
+            return
+        start = missing[0]
+        self.pending = True
+        future = self.app.loop.run_in_executor(
+            None, planning.plan_segment_range, self.step_segments,
+            start, stop, scale, self.app['planner_config'])
+        future.add_done_callback(
+            lambda f: self.planned_window(f, start, scale))
+
+    def planned_window(self, future, start, scale):
+        self.pending = False
+        if future.exception():
+            log.error("Replanning failed: %s", future.exception())
+        elif scale == self.scale:
+            for n, actions in enumerate(future.result(), start):
+                self.planned[n] = actions
 
-        app['action_index'] = action_index
 
-        if app['state'] == State.canceling:
-            log.debug("plot_task: canceling")
-            # Decelerate, pen up, fastest move back to origin
-            await cancel_to_origin(app, action)
-            break
-        # notify clients of state change
+async def plot_task(app):
+    log.debug("plot_task: begin")
+    app['state'] = State.plotting
+    bot = app['bot']
+    job = app['job']
+    action_index = app['action_index']
+
+    if app['pause']:
+        log.info("plot_task: resuming from pause at action %d",
+                 action_index)
+        actions, action_index = plan_unpause(app)
+        app['pause'] = None
+        await run_actions(app, actions)
+    else:
+        if app['pen_up'] is not True:
+            bot.pen_up(app['pen_up_delay'])
+            app['pen_up'] = True
+
+        if action_index:
+            log.info("plot_task: resuming at action %d", action_index)
+            await run_actions(app, plan_seek(app, action_index))
+            # The job was probably travelling at speed here, so accelerate
+            # back up to it rather than starting its moves from rest.
+            ramp, action_index = planning.plan_resume(
+                job, action_index, app['planner_config'])
+            await run_actions(app, ramp)
+
+    update_job_state(app, action_index)
+    checkpointer = None
+    action = None
+    paused = False
+
+    try:
+        while True:
+            if job is app['failed_job']:
+                # Nor can the rest of it ever be plotted.
+                if app['state'] != State.canceling:
+                    log.warn("plot_task: planning failed, canceling")
+                    app['state'] = State.canceling
+            elif (checkpointer is None) and (job is not app['planning_job']):
+                # A job that's still being planned can't be checkpointed yet.
+                checkpointer = start_checkpoint(app, job)
+
+            if (action_index == len(job)) and (checkpointer is not None):
+                # Finished
+                log.debug("plot_task: plotting complete")
+                handlers.notify_job_complete(app)
+                app['consumed_time'] = 0
+                break
+
+            if app['state'] == State.canceling:
+                log.debug("plot_task: canceling")
+                # Decelerate, pen up, fastest move back to origin
+                await cancel_to_origin(app, action)
+                break
+
+            if app['state'] == State.pausing:
+                log.debug("plot_task: pausing")
+                await pause_in_place(app, action, action_index)
+                if checkpointer:
+                    checkpointer.update(app['action_index'], force=True)
+                paused = True
+                break
+
+            if action_index == len(job):
+                # We've caught up with the planner, at the end of a segment.
+                await asyncio.sleep(config.PLAN_WAIT)
+                continue
+
+            # notify clients of state change
+            handlers.notify_state(app)
+
+            replanner = app['replanner']
+            replanned = replanner and replanner.take(action_index,
+                                                     app['speed_override'])
+            if replanned:
+                # Plot a whole segment replanned for the speed override.
+                stop, actions = replanned
+                for n, action in enumerate(actions):
+                    def run_action():
+                        bot.do(action)
+
+                    update_bot_state(app, action)
+                    await app.loop.run_in_executor(None, run_action)
+                    if app['state'] in (State.canceling, State.pausing):
+                        break
+                else:
+                    action_index = stop
+                    app['action_index'] = action_index
+                    update_job_state(app, action_index)
+                    if checkpointer:
+                        checkpointer.update(action_index)
+                    continue
+                if app['state'] == State.pausing:
+                    log.debug("plot_task: pausing")
+                    await pause_in_place(app, action, action_index,
+                                         (stop, actions[n + 1:]))
+                    if checkpointer:
+                        checkpointer.update(app['action_index'], force=True)
+                    paused = True
+                    break
+                log.debug("plot_task: canceling")
+                await cancel_to_origin(app, action)
+                break
+
+            action = job[action_index]
+
+            def run_action():
+                bot.do(action)
+
+            update_job_state(app, action_index + 1)
+            await app.loop.run_in_executor(None, run_action)
+            action_index += 1
+            app['action_index'] = action_index
+            if checkpointer:
+                checkpointer.update(action_index)
+    except Exception:
+        # Make sure the checkpoint is as fresh as possible for resuming.
+        if checkpointer:
+            checkpointer.update(action_index, force=True)
+        raise
+
+    if paused:
+        app['state'] = State.paused
         handlers.notify_state(app)
+        log.warn("plot_task: paused")
+        return
 
+    if checkpointer:
+        checkpointer.clear()
     app['state'] = State.idle
     app['action_index'] = 0
 
@@ -188,6 +618,21 @@ async def plot_task(app):
     log.warn("plot_task: end")
 
 
+async def cancel_paused_task(app):
+    """
+    Abandon a paused job: the pen is already up, so just go home.
+    """
+    app['pause'] = None
+    start = tuple(int(round(v)) for v in app['position'])
+    if start != (0, 0):
+        await run_actions(app, plan_pen_up_move(app, start, (0, 0)))
+    checkpoint.Checkpointer(app['job']).clear()
+    app['state'] = State.idle
+    app['action_index'] = 0
+    update_job_state(app, 0)
+    handlers.notify_state(app)
+
+
 async def manual_task(app, action):
     orig_state = app['state']
     log.debug("manual task: set state to plotting")
@@ -214,10 +659,46 @@ def manual_pen_down(app):
     app.loop.create_task(manual_task(app, PenDownMove(pen_down_delay)))
 
 
-def resume(app):
+def resume(app, seconds=None):
+    if seconds is not None:
+        # Seeking elsewhere abandons any pause in progress.
+        app['pause'] = None
+        # Seek to the action in progress that far into the job. plot_task()
+        # then ramps up into it from rest, since it may be mid-segment. A
+        # job which is still being planned may have no actions yet.
+        job = app['job']
+        app['action_index'] = max(min(job.index_at_time(seconds * 1000),
+                                      len(job) - 1), 0)
+    # Claim the plotting state before the task starts, so a second resume
+    # request can't sneak past the state guard in the meantime.
+    app['state'] = State.plotting
     app.loop.create_task(plot_task(app))
 
 
 def cancel(app):
+    if app['state'] == State.paused:
+        app.loop.create_task(cancel_paused_task(app))
     app['state'] = State.canceling
     handlers.notify_state(app)
+
+
+def pause(app):
+    app['state'] = State.pausing
+    handlers.notify_state(app)
+
+
+def set_speed_override(app, scale):
+    """
+    Scale the speed of the rest of the job by ``scale``, within the limits
+    allowed by the config.
+    """
+    scale = min(max(scale, config.SPEED_OVERRIDE_MIN),
+                config.SPEED_OVERRIDE_MAX)
+    app['speed_override'] = scale
+    replanner = app['replanner']
+    job = app['job']
+    # A job which is still being planned is replanned once it's complete.
+    if ((scale != 1.0) and (job is not app['planning_job']) and
+            ((not replanner) or (replanner.job is not job))):
+        app['replanner'] = Replanner(app, job)
+    handlers.notify_state(app)
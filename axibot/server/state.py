@@ -7,14 +7,23 @@ Possible system states:
     plotting document           (plotting)
     canceling plotting          (canceling)
     processing document         (processing)
+    pausing plotting            (pausing)
+    paused mid-document         (paused)
 
 Possible state transitions are:
 
     idle -> plotting            (begin plotting)
     idle -> processing          (upload)
     processing -> idle          (done)
+    processing -> processing    (new upload supersedes the current one)
+    processing -> idle          (upload canceled)
+    processing -> plotting      (begin plotting while still planning)
     plotting -> canceling       (cancel requested)
     canceling -> idle           (canceled)
+    plotting -> pausing         (pause requested)
+    pausing -> paused           (stopped in place)
+    paused -> plotting          (resume)
+    paused -> canceling         (cancel requested)
 
 Additional state variables are:
 
@@ -33,3 +42,5 @@ class State(Enum):
     plotting = 2
     canceling = 3
     processing = 4
+    pausing = 5
+    paused = 6
@@ -6,13 +6,24 @@ import logging
 import math
 import re
 
+import numpy as np
+
 from xml.etree import ElementTree
-from svg.path import parse_path, Path, Line
+from collections import deque
+
+from svg.path import parse_path, Path, Line, CubicBezier, QuadraticBezier, Arc
 
 from . import transform
 
 log = logging.getLogger(__name__)
 
+# Size in inches of the cells in the spatial hash of lines already drawn.
+INK_GRID_SIZE = 0.05
+
+# Ranges of more points than this are simplified with numpy, which has too
+# much overhead for shorter ones.
+SIMPLIFY_ARRAY_SIZE = 32
+
 
 def convert_to_inches(s):
     """
@@ -199,34 +210,330 @@ def subdivide_path(path, resolution):
     return points
 
 
+def iter_segments(paths, resolution):
+    """
+    Generator version of plan_segments(), yielding the points of each path as
+    it is subdivided.
+    """
+    for path in paths:
+        yield subdivide_path(path, resolution)
+
+
 def plan_segments(paths, resolution):
     """
     Takes a list of Path instances, returns a list of lists of points.
     """
-    return [subdivide_path(path, resolution) for path in paths]
+    return list(iter_segments(paths, resolution))
+
 
+def chain_ends(ends, tolerance):
+    """
+    Takes a list of (start, end) points, one for each path, and finds chains
+    of paths which can be plotted continuously, because an end of each path
+    is within ``tolerance`` of an end of the next. Paths are reversed where
+    needed.
+
+    Returns a list of chains, each a list of (index, reverse) tuples, which
+    together cover every path once. Endpoints are looked up in a spatial hash,
+    so this takes linear time.
+    """
+    def key(point):
+        if not tolerance:
+            return point
+        return (int(math.floor(point[0] / tolerance)),
+                int(math.floor(point[1] / tolerance)))
+
+    def nearby(point):
+        if not tolerance:
+            return [point]
+        x, y = key(point)
+        return [(x + dx, y + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+
+    index = {}
+    for n, (start, end) in enumerate(ends):
+        index.setdefault(key(start), []).append((n, 0))
+        index.setdefault(key(end), []).append((n, 1))
+    used = [False] * len(ends)
+
+    def find(point):
+        for cell in nearby(point):
+            entries = index.get(cell)
+            if not entries:
+                continue
+            entries[:] = [entry for entry in entries if not used[entry[0]]]
+            for n, which in entries:
+                other = ends[n][which]
+                if math.hypot(other[0] - point[0],
+                              other[1] - point[1]) <= tolerance:
+                    used[n] = True
+                    return n, which
+        return None
 
-def join_segments(segments, min_gap):
+    chains = []
+    for n, (start, end) in enumerate(ends):
+        if used[n]:
+            continue
+        used[n] = True
+        chain = deque([(n, False)])
+        # Extend the chain forwards from its end...
+        point = end
+        found = find(point)
+        while found:
+            m, which = found
+            # A path joined by its end has to be plotted backwards.
+            reverse = which == 1
+            chain.append((m, reverse))
+            point = ends[m][0] if reverse else ends[m][1]
+            found = find(point)
+        # ...and backwards from its start.
+        point = start
+        found = find(point)
+        while found:
+            m, which = found
+            reverse = which == 0
+            chain.appendleft((m, reverse))
+            point = ends[m][1] if reverse else ends[m][0]
+            found = find(point)
+        chains.append(list(chain))
+    return chains
+
+
+def reverse_piece(piece):
     """
-    Takes a list of segments (which are lists of points) and joins them when
-    the start of one segment is within a certain tolerance of the end of the
-    previous segment.
+    Return a piece of a path traversed in the opposite direction.
+    """
+    if isinstance(piece, Line):
+        return Line(piece.end, piece.start)
+    elif isinstance(piece, CubicBezier):
+        return CubicBezier(piece.end, piece.control2, piece.control1,
+                           piece.start)
+    elif isinstance(piece, QuadraticBezier):
+        return QuadraticBezier(piece.end, piece.control, piece.start)
+    elif isinstance(piece, Arc):
+        return Arc(piece.end, piece.radius, piece.rotation, piece.arc,
+                   not piece.sweep, piece.start)
+    else:
+        raise ValueError("Don't know how to reverse %r." % piece)
 
-    XXX this needs to actually get called, maybe. Not sure it helps.
+
+def join_paths(paths, tolerance):
+    """
+    Takes a list of Path instances and joins them where they share endpoints,
+    to within ``tolerance``, reversing paths as needed. SVG editors often
+    split a single stroke into many paths, which would otherwise be plotted
+    with a pen lift at every join.
     """
-    if len(segments) < 2:
-        return segments
-    last_segment = segments[0]
-    new_segments = [last_segment]
-    for segment in segments[1:]:
-        x0, y0 = last_segment[-1]
-        x1, y1 = segment[0]
-        if math.sqrt((x1 - x0)**2 + (y1 - y0)**2) < min_gap:
-            last_segment.extend(segment)
+    ends = [((path[0].start.real, path[0].start.imag),
+             (path[-1].end.real, path[-1].end.imag))
+            for path in paths]
+    joined = []
+    for chain in chain_ends(ends, tolerance):
+        if len(chain) == 1 and not chain[0][1]:
+            joined.append(paths[chain[0][0]])
+            continue
+        pieces = []
+        for n, reverse in chain:
+            if reverse:
+                pieces.extend(reverse_piece(piece)
+                              for piece in reversed(paths[n]))
+            else:
+                pieces.extend(paths[n])
+        joined.append(Path(*pieces))
+    return joined
+
+
+def point_line_distance(a, b, p):
+    """
+    Distance of point ``p`` from the line segment from ``a`` to ``b``.
+    """
+    dx = b[0] - a[0]
+    dy = b[1] - a[1]
+    length_squared = dx**2 + dy**2
+    if length_squared:
+        t = (((p[0] - a[0]) * dx) + ((p[1] - a[1]) * dy)) / length_squared
+        t = min(max(t, 0), 1)
+    else:
+        t = 0
+    return math.hypot(p[0] - (a[0] + t * dx), p[1] - (a[1] + t * dy))
+
+
+def furthest_point(points, start, end):
+    """
+    Return the index and distance of the point between ``start`` and ``end``
+    which is furthest from the line segment between them.
+    """
+    a = points[start]
+    b = points[end]
+    furthest = start
+    furthest_dist = 0
+    for n in range(start + 1, end):
+        dist = point_line_distance(a, b, points[n])
+        if dist > furthest_dist:
+            furthest = n
+            furthest_dist = dist
+    return furthest, furthest_dist
+
+
+def furthest_point_array(xy, start, end):
+    """
+    Array version of furthest_point(), for long ranges of points.
+    """
+    a = xy[start]
+    ab = xy[end] - a
+    ap = xy[start + 1:end] - a
+    length_squared = ab.dot(ab)
+    if length_squared:
+        t = np.clip(ap.dot(ab) / length_squared, 0, 1)
+        ap -= t[:, np.newaxis] * ab
+    dist = np.hypot(ap[:, 0], ap[:, 1])
+    n = int(dist.argmax())
+    return start + 1 + n, dist[n]
+
+
+def simplify_segment(points, tolerance):
+    """
+    Simplify a list of points with the Douglas-Peucker algorithm, so that no
+    dropped point is further than ``tolerance`` from the simplified path. The
+    first and last points are always kept.
+
+    Each range is split at its furthest point until every point in it is
+    within tolerance, which takes O(n log n) time for typical drawings. Ranges
+    are kept on a stack rather than recursed into, so long paths are fine, and
+    the distances across long ranges are found with numpy.
+    """
+    if len(points) < 3:
+        return list(points)
+    xy = None
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    ranges = [(0, len(points) - 1)]
+    while ranges:
+        start, end = ranges.pop()
+        if end - start < 2:
+            continue
+        if end - start > SIMPLIFY_ARRAY_SIZE:
+            if xy is None:
+                xy = np.array(points, dtype=float)
+            furthest, dist = furthest_point_array(xy, start, end)
         else:
-            last_segment = segment
-            new_segments.append(segment)
-    return new_segments
+            furthest, dist = furthest_point(points, start, end)
+        if dist > tolerance:
+            keep[furthest] = True
+            ranges.append((start, furthest))
+            ranges.append((furthest, end))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def iter_simplified(segments, tolerance):
+    """
+    Generator version of simplify_segments().
+    """
+    for segment in segments:
+        yield simplify_segment(segment, tolerance) if tolerance else segment
+
+
+def simplify_segments(segments, tolerance):
+    """
+    Takes a list of segments, and returns a list with each segment simplified
+    to within ``tolerance``. See simplify_segment().
+    """
+    return list(iter_simplified(segments, tolerance))
+
+
+class InkGrid:
+    """
+    A spatial hash of the lines drawn so far, to find whether a point lies on
+    one of them. Each line is stored in every cell it crosses.
+    """
+    def __init__(self, cell_size=INK_GRID_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+
+    def cell(self, point):
+        return (int(math.floor(point[0] / self.cell_size)),
+                int(math.floor(point[1] / self.cell_size)))
+
+    def add(self, points):
+        for a, b in zip(points, points[1:]):
+            steps = int(math.ceil(math.hypot(b[0] - a[0], b[1] - a[1]) /
+                                  self.cell_size))
+            cells = {self.cell(a)}
+            for n in range(1, steps + 1):
+                t = n / steps
+                cells.add(self.cell((a[0] + t * (b[0] - a[0]),
+                                     a[1] + t * (b[1] - a[1]))))
+            for key in cells:
+                self.cells.setdefault(key, []).append((a, b))
+
+    def inked(self, point, tolerance):
+        """
+        Return True if ``point`` is within ``tolerance`` of a line.
+        """
+        x, y = self.cell(point)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for a, b in self.cells.get((x + dx, y + dy), ()):
+                    if point_line_distance(a, b, point) <= tolerance:
+                        return True
+        return False
+
+
+def iter_bridged(segments, min_gap, tolerance=None):
+    """
+    Join consecutive pen-down segments when the gap between the end of one
+    and the start of the next is shorter than ``min_gap``, so that the pen is
+    dragged across the gap instead of being lifted.
+
+    If ``tolerance`` is given, only bridge gaps which lie within that distance
+    of lines which have already been drawn.
+    """
+    ink = InkGrid() if tolerance is not None else None
+    current = None
+    for segment in segments:
+        if current:
+            a = current[-1]
+            b = segment[0]
+            gap = math.hypot(b[0] - a[0], b[1] - a[1])
+            bridge = gap < min_gap
+            if bridge and ink is not None:
+                bridge = all(ink.inked((a[0] + t * (b[0] - a[0]),
+                                        a[1] + t * (b[1] - a[1])), tolerance)
+                             for t in (0.25, 0.5, 0.75))
+            if bridge:
+                current.extend(segment)
+            else:
+                yield current
+                current = list(segment)
+        else:
+            current = list(segment)
+        if ink is not None:
+            ink.add(segment)
+    if current:
+        yield current
+
+
+def bridge_gaps(segments, min_gap, tolerance=None):
+    """
+    Takes a list of pen-down segments, and returns a list with consecutive
+    segments joined where the gap between them is shorter than ``min_gap``.
+    See iter_bridged().
+    """
+    return list(iter_bridged(segments, min_gap, tolerance))
+
+
+def iter_pen_up_moves(segments):
+    """
+    Generator version of add_pen_up_moves(), which only needs to look at one
+    pen-down segment at a time.
+    """
+    origin = 0, 0
+    last_point = origin
+    for seg in segments:
+        assert seg
+        yield [last_point, seg[0]], True
+        yield seg, False
+        last_point = seg[-1]
+    yield [last_point, origin], True
 
 
 def add_pen_up_moves(segments):
@@ -240,26 +547,7 @@ def add_pen_up_moves(segments):
     length of the input list.
     """
     assert segments
-    origin = 0, 0
-
-    out_segments = []
-    start_seg = [origin, segments[0][0]]
-    out_segments.append((start_seg, True))
-
-    count = len(segments)
-
-    for n, seg in enumerate(segments, start=1):
-        assert seg
-        out_segments.append((seg, False))
-        if n == count:
-            # last one
-            next_seg_start = origin
-        else:
-            next_seg_start = segments[n][0]
-        inter_seg = [seg[-1], next_seg_start]
-        out_segments.append((inter_seg, True))
-
-    return out_segments
+    return list(iter_pen_up_moves(segments))
 
 
 def transform_path(s, transform_matrix):
@@ -385,6 +673,94 @@ def split_disconnected_paths(paths):
     return out_paths
 
 
+def line_key(a, b):
+    """
+    Given two distinct integer points, return a key identifying the line
+    through them, and the positions of ``a`` and ``b`` along it. Every pair of
+    points on the same line gives the same key.
+    """
+    dx = b[0] - a[0]
+    dy = b[1] - a[1]
+    divisor = math.gcd(dx, dy)
+    dx //= divisor
+    dy //= divisor
+    if (dx < 0) or ((dx == 0) and (dy < 0)):
+        dx, dy = -dx, -dy
+    key = dx, dy, (dy * a[0]) - (dx * a[1])
+    return key, (dx * a[0]) + (dy * a[1]), (dx * b[0]) + (dy * b[1])
+
+
+def subtract_intervals(covered, lo, hi):
+    """
+    Return the parts of the interval from ``lo`` to ``hi`` which aren't in
+    ``covered``, a sorted list of disjoint intervals, and add it to
+    ``covered``.
+    """
+    uncovered = []
+    merged = []
+    start = lo
+    new_lo = lo
+    new_hi = hi
+    for a, b in covered:
+        if b < lo or a > hi:
+            merged.append((a, b))
+            continue
+        if a > start:
+            uncovered.append((start, a))
+        start = max(start, b)
+        new_lo = min(new_lo, a)
+        new_hi = max(new_hi, b)
+    if start < hi:
+        uncovered.append((start, hi))
+    merged.append((new_lo, new_hi))
+    covered[:] = sorted(merged)
+    return uncovered
+
+
+def remove_overlaps(paths, dpi):
+    """
+    Takes a list of Path instances and removes the parts of straight pieces
+    which retrace lines already drawn, such as the shared edges of adjacent
+    tiles or polygons. Points are rounded to a grid of ``dpi`` points per
+    inch, usually the motor steps, so that lines which would be plotted the
+    same way are found to overlap.
+
+    Lines are kept in a hash of the covered intervals along each distinct
+    line, so each piece only has to be compared with the pieces on the same
+    line. Returns a tuple of the paths, which may now be discontinuous, and
+    the length removed in inches.
+    """
+    covered = {}
+    removed = 0
+    out_paths = []
+    for path in paths:
+        pieces = []
+        for piece in path:
+            a = (int(round(piece.start.real * dpi)),
+                 int(round(piece.start.imag * dpi)))
+            b = (int(round(piece.end.real * dpi)),
+                 int(round(piece.end.imag * dpi)))
+            if not isinstance(piece, Line) or a == b:
+                pieces.append(piece)
+                continue
+            key, ta, tb = line_key(a, b)
+            uncovered = subtract_intervals(covered.setdefault(key, []),
+                                           min(ta, tb), max(ta, tb))
+            kept = 0
+            for lo, hi in sorted(uncovered, reverse=(ta > tb)):
+                u0 = (lo - ta) / (tb - ta)
+                u1 = (hi - ta) / (tb - ta)
+                if ta > tb:
+                    u0, u1 = u1, u0
+                kept += u1 - u0
+                pieces.append(Line(piece.point(u0) if u0 else piece.start,
+                                   piece.point(u1) if u1 < 1 else piece.end))
+            removed += (1 - kept) * piece.length()
+        if pieces:
+            out_paths.append(Path(*pieces))
+    return out_paths, removed
+
+
 def distance_squared(a, b):
     return ((b.real - a.real)**2) + ((b.imag - a.imag)**2)
 
@@ -415,7 +791,18 @@ def sort_paths(paths):
     return out_paths
 
 
-def preprocess_paths(paths):
+def preprocess_paths(paths, join_tolerance=None, overlap_dpi=None):
+    """
+    Remove lines which overlap others on a grid of ``overlap_dpi`` points per
+    inch if it's given, split paths at discontinuities, join paths which share
+    endpoints to within ``join_tolerance`` inches if it's given, and order the
+    paths.
+    """
+    if overlap_dpi:
+        paths, removed = remove_overlaps(paths, overlap_dpi)
+        log.info("Removed %.2f inches of overlapping lines.", removed)
     paths = split_disconnected_paths(paths)
+    if join_tolerance is not None:
+        paths = join_paths(paths, join_tolerance)
     paths = sort_paths(paths)
     return paths
@@ -0,0 +1,75 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import os
+import os.path
+import shutil
+import tempfile
+
+import pytest
+
+from .. import cache, config, planning
+
+from . import utils
+
+
+@pytest.fixture
+def plan_cache():
+    directory = tempfile.mkdtemp(prefix='axibot-test-cache-')
+    yield cache.PlanCache(directory)
+    shutil.rmtree(directory)
+
+
+def test_hit_and_miss(plan_cache):
+    doc = utils.load_example('line.svg')
+    job = cache.plan_job(doc, 'line.svg', cache=plan_cache)
+    stats = plan_cache.stats()
+    assert stats['misses'] == 1
+    assert stats['hits'] == 0
+    assert stats['entries'] == 1
+
+    cached = cache.plan_job(doc, 'renamed.svg', cache=plan_cache)
+    assert list(cached) == list(job)
+    assert cached.filename == 'renamed.svg'
+    assert plan_cache.stats()['hits'] == 1
+
+
+def test_key_depends_on_settings(monkeypatch):
+    doc = utils.load_example('line.svg')
+    key = cache.cache_key(doc)
+    monkeypatch.setattr(config, 'SPEED_PEN_DOWN', config.SPEED_PEN_DOWN / 2)
+    assert cache.cache_key(doc) != key
+
+
+def test_key_depends_on_planner_config():
+    doc = utils.load_example('line.svg')
+    default = planning.PlannerConfig.default()
+    slow = default._replace(speed_pen_down=default.speed_pen_down / 2)
+    assert cache.cache_key(doc, default) == cache.cache_key(doc)
+    assert cache.cache_key(doc, slow) != cache.cache_key(doc)
+
+
+def test_eviction(plan_cache):
+    job = cache.plan_job(utils.load_example('line.svg'), 'line.svg',
+                         cache=plan_cache)
+    size = plan_cache.stats()['size']
+    # Make sure the first entry is unambiguously the least recently used.
+    [(mtime, _, path)] = plan_cache.entries()
+    os.utime(path, (mtime - 60, mtime - 60))
+    plan_cache.max_size = size
+    plan_cache.put('<svg>another document</svg>', job)
+    entries = plan_cache.entries()
+    assert len(entries) == 1
+    assert entries[0][2] == plan_cache.path(
+        cache.cache_key('<svg>another document</svg>'))
+
+
+def test_corrupt_entry(plan_cache):
+    doc = utils.load_example('line.svg')
+    cache.plan_job(doc, 'line.svg', cache=plan_cache)
+    [(_, size, path)] = plan_cache.entries()
+    assert path.endswith('.axibot.bin')
+    with open(path, 'r+b') as f:
+        f.truncate(size // 2)
+    assert plan_cache.get(doc) is None
+    assert not os.path.exists(path)
@@ -0,0 +1,55 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import os.path
+import shutil
+import tempfile
+
+from .. import checkpoint, planning
+from ..job import Job
+from ..action import XYMove, PenUpMove, PenDownMove
+
+
+def make_job():
+    return Job([XYMove(10, 10, 100),
+                PenDownMove(400),
+                XYMove(4, -4, 50),
+                PenUpMove(300)],
+               pen_up_position=60, pen_down_position=40, servo_speed=150)
+
+
+def test_checkpoint_roundtrip():
+    directory = tempfile.mkdtemp(prefix='axibot-test-checkpoint-')
+    try:
+        path = os.path.join(directory, 'checkpoint.json')
+        job = make_job()
+        checkpointer = checkpoint.Checkpointer(job, path=path, interval=60)
+        checkpointer.update(2)
+        # Too soon for another write.
+        checkpointer.update(3)
+
+        saved = checkpoint.load(path)
+        assert checkpointer.matches(saved)
+        assert saved['action_index'] == 2
+        assert saved['pen_up'] is False
+        assert saved['position'] == [10, 0]
+
+        other = make_job()
+        other.append(XYMove(-10, -10, 100))
+        assert not checkpoint.Checkpointer(other).matches(saved)
+
+        checkpointer.clear()
+        assert checkpoint.load(path) is None
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_plan_seek():
+    actions = planning.plan_seek((0, 0), True, (1000, 500), False,
+                                 pen_up_delay=300, pen_down_delay=400)
+    assert actions[-1] == PenDownMove(400)
+    x = y = 0
+    for action in actions[:-1]:
+        x += (action.m1 + action.m2) // 2
+        y += (action.m1 - action.m2) // 2
+    assert (x, y) == (1000, 500)
@@ -1,13 +1,68 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import logging
 import os.path
+
+import pytest
+
 from axibot.cmd import main
 
+from .. import config, profile
 from . import utils
 
 
+@pytest.fixture(autouse=True)
+def isolated(monkeypatch, tmpdir):
+    # Keep the developer's own profiles, cached plans and checkpoints out of
+    # the tests, and undo the settings main() applies from a profile.
+    for name in ('PROFILE_DIR', 'CACHE_DIR', 'CHECKPOINT_DIR'):
+        monkeypatch.setattr(config, name, str(tmpdir.join(name)))
+    for name in profile.PROFILE_SETTINGS:
+        monkeypatch.setattr(config, name, getattr(config, name))
+
+
 def test_info_smoke():
     filename = os.path.join(utils.example_dir, 'circles.svg')
     args = ['axibot', 'info', filename]
     main(args)
+
+
+def test_profile(caplog):
+    profile.save('slow', {'SERVO_SPEED': 42})
+    filename = os.path.join(utils.example_dir, 'line.svg')
+    main(['axibot', '--profile', 'slow', 'info', filename])
+    assert config.SERVO_SPEED == 42
+    caplog.set_level(logging.WARNING)
+    main(['axibot', '--profile', 'missing', 'info', filename])
+    assert 'No profile named missing.' in caplog.text
+
+
+def test_resume_streamed_plot(monkeypatch, caplog):
+    from .. import cmd, checkpoint
+    from ..ebb import MockEiBotBoard
+    monkeypatch.setattr(cmd, 'input', lambda prompt: '')
+
+    done = []
+    do = MockEiBotBoard.do
+
+    def crash_after_20(self, move):
+        if len(done) == 20:
+            raise KeyboardInterrupt
+        done.append(move)
+        return do(self, move)
+
+    # A plot streamed while it's planned checkpoints its progress...
+    monkeypatch.setattr(MockEiBotBoard, 'do', crash_after_20)
+    filename = os.path.join(utils.example_dir, 'line.svg')
+    with pytest.raises(KeyboardInterrupt):
+        main(['axibot', '--mock', '--no-cache', 'plot', filename])
+    saved = checkpoint.load()
+    assert saved['action_index'] > 0
+
+    # ...so it can be resumed, even with the job replanned from scratch.
+    monkeypatch.setattr(MockEiBotBoard, 'do', do)
+    caplog.set_level(logging.INFO)
+    main(['axibot', '--mock', '--no-cache', 'plot', '--resume', filename])
+    assert ('Resuming from action %d/' % saved['action_index']) in caplog.text
+    assert checkpoint.load() is None
@@ -1,7 +1,13 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
-from ..job import Job
+import os.path
+
+import numpy as np
+import pytest
+from six.moves import StringIO
+
+from ..job import Job, ACTION_DTYPE
 from ..action import XYMove, PenUpMove, PenDownMove
 
 
@@ -20,3 +26,106 @@ def test_roundtrip():
         newjob = Job.deserialize(f)
 
     assert job == newjob
+    assert newjob.servo_down_speed == 150
+
+
+def test_asymmetric_servo_speeds():
+    job = Job([PenDownMove(400)], pen_up_position=60, pen_down_position=40,
+              servo_speed=150)
+    slow_down = Job([PenDownMove(400)], pen_up_position=60,
+                    pen_down_position=40, servo_speed=150,
+                    servo_down_speed=100)
+    assert job.servo_down_speed == 150
+    assert slow_down.metadata()['servo_down_speed'] == 100
+    assert job.content_hash() != slow_down.content_hash()
+
+
+def test_binary_roundtrip(tmpdir):
+    job = Job(pen_up_position=60, pen_down_position=40, servo_speed=150,
+              document='<svg/>', filename='test.svg')
+    job.append(PenDownMove(400))
+    job.append(XYMove(500, -300, 200))
+    job.append(XYMove(-2, 7, 30))
+    job.append(PenUpMove(400))
+
+    testfile = str(tmpdir.join('test.axibot.bin'))
+
+    with open(testfile, 'wb') as f:
+        job.serialize_binary(f)
+
+    mapped = Job.deserialize_binary(testfile)
+    assert mapped == job
+    assert len(mapped) == len(job)
+    assert list(mapped) == list(job)
+    assert mapped[1] == job[1]
+    assert mapped.duration() == job.duration()
+    assert mapped.metadata() == job.metadata()
+
+    # Converting back to JSON is lossless.
+    f = StringIO()
+    mapped.serialize(f)
+    f.seek(0)
+    assert Job.deserialize(f) == job
+
+
+def test_mutate_mapped_job(tmpdir):
+    job = Job([PenDownMove(400), XYMove(500, 300, 200), PenUpMove(400)],
+              pen_up_position=60, pen_down_position=40, servo_speed=150)
+
+    testfile = str(tmpdir.join('test-mutate.axibot.bin'))
+    with open(testfile, 'wb') as f:
+        job.serialize_binary(f)
+
+    mapped = Job.deserialize_binary(testfile)
+    mapped.insert(2, XYMove(-500, -300, 200))
+    del mapped[0]
+    mapped[0] = XYMove(1, 2, 30)
+    assert list(mapped) == [XYMove(1, 2, 30), XYMove(-500, -300, 200),
+                            PenUpMove(400)]
+    assert mapped[::2] == [XYMove(1, 2, 30), PenUpMove(400)]
+
+
+def test_invalid_binary_job(tmpdir):
+    job = Job([XYMove(500, 300, 200)], pen_up_position=60,
+              pen_down_position=40, servo_speed=150)
+    testfile = str(tmpdir.join('invalid.axibot.bin'))
+    with open(testfile, 'wb') as f:
+        job.serialize_binary(f)
+    offset = os.path.getsize(testfile) - ACTION_DTYPE.itemsize
+    records = np.memmap(testfile, dtype=ACTION_DTYPE, mode='r+',
+                        offset=offset)
+    records['time'] = 10
+    records.flush()
+    del records
+    with pytest.raises(ValueError):
+        Job.deserialize_binary(testfile)
+
+
+def test_moves_are_slotted():
+    move = XYMove(500, 300, 200)
+    assert not hasattr(move, '__dict__')
+    assert move.as_dict() == {'m1': 500, 'm2': 300, 'duration': 200}
+
+
+def test_index():
+    job = Job([XYMove(10, 10, 100),
+               PenDownMove(400),
+               XYMove(4, -4, 50),
+               PenUpMove(300)],
+              pen_up_position=60, pen_down_position=40, servo_speed=150)
+    assert job.duration().total_seconds() == 0.85
+    assert [job.time_at(n) for n in range(5)] == [0, 100, 500, 550, 850]
+    assert [job.position_at(n) for n in range(5)] == \
+        [(0, 0), (10, 0), (10, 0), (10, 4), (10, 4)]
+    assert [job.pen_up_at(n) for n in range(5)] == \
+        [True, True, False, False, True]
+    assert job.index_at_time(0) == 0
+    assert job.index_at_time(99) == 0
+    assert job.index_at_time(100) == 1
+    assert job.index_at_time(549) == 2
+    assert job.index_at_time(10000) == 4
+
+    # Modifying the job invalidates the index.
+    job.append(XYMove(-10, -10, 100))
+    assert job.position_at(5) == (0, 4)
+    assert job.duration().total_seconds() == 0.95
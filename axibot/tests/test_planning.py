@@ -1,6 +1,11 @@
 import math
 
-from .. import planning, config
+import pytest
+
+from .. import planning, config, svg
+from ..action import XYMove
+
+from . import utils
 
 
 vmax = config.SPEED_PEN_DOWN
@@ -75,3 +80,392 @@ def test_cornering_speed_reverse():
     vmax = config.SPEED_PEN_DOWN
     v = planning.cornering_speed(0, vmax)
     assert v == 0
+
+
+def test_plan_job_progress():
+    calls = []
+
+    def progress(stage, percent):
+        calls.append((stage, percent))
+
+    planning.plan_job(utils.load_example('line.svg'), 'line.svg',
+                      progress=progress)
+    stages = [stage for stage, percent in calls]
+    assert stages[0] == 'extracting'
+    for stage in ('segments', 'speed', 'actions'):
+        assert (stage, 100) in calls
+    assert all(0 <= percent <= 100 for stage, percent in calls)
+
+
+def test_plan_job_cancel():
+    cancel = planning.CancelToken()
+
+    def progress(stage, percent):
+        if stage == 'speed':
+            cancel.cancel()
+
+    with pytest.raises(planning.PlanningCanceled):
+        planning.plan_job(utils.load_example('line.svg'), 'line.svg',
+                          progress=progress, cancel=cancel)
+
+
+def test_pause_and_unpause_preserve_path():
+    accel = planning.max_acceleration(False)
+    vmax = config.SPEED_PEN_DOWN
+    moves = [XYMove(m1=int(vmax * 30), m2=int(vmax * 30), duration=30)
+             for n in range(20)]
+    decel, consumed, remainder = planning.plan_pause(moves, vmax, accel)
+    assert decel
+    assert 0 < consumed < len(moves)
+    for action in decel:
+        assert action.duration >= 30
+
+    resumed = [remainder] + moves[consumed + 1:] if remainder else \
+        moves[consumed:]
+    ramp, ramp_consumed = planning.plan_unpause(resumed, accel)
+    assert ramp
+    actions = decel + ramp + resumed[ramp_consumed:]
+
+    def total(actions):
+        return tuple(map(sum, zip(*(planning.move_vector(action)
+                                    for action in actions))))
+
+    assert total(actions) == total(moves)
+    # Stopping and starting again can only take longer.
+    assert sum(a.duration for a in actions) > sum(m.duration for m in moves)
+
+
+def test_plan_resume():
+    job = planning.plan_job(utils.load_example('worldmap.svg'),
+                            'worldmap.svg')
+
+    def speed(n):
+        if isinstance(job[n], XYMove):
+            return abs(job[n].m1) / job[n].duration
+        return 0
+
+    # Resume partway through the fastest stretch of the job.
+    index = max(range(len(job)), key=speed)
+    ramp, next_index = planning.plan_resume(job, index)
+    assert ramp and next_index > index
+
+    # Same path, starting slowly enough to accelerate from rest.
+    def total(actions):
+        return tuple(map(sum, zip(*(planning.move_vector(action)
+                                    for action in actions))))
+
+    assert total(ramp) == total(job[index:next_index])
+    first = ramp[0]
+    dx, dy = planning.move_vector(first)
+    accel = planning.max_acceleration(job.pen_up_at(index))
+    assert math.hypot(dx, dy) <= accel * first.duration**2 / 2 + 2
+
+
+def test_replan_segment_range():
+    document = utils.load_example('line.svg')
+    job = planning.plan_job(document, 'line.svg')
+    step_segments = planning.plan_step_segments(document)
+    ranges = planning.segment_action_ranges(job)
+    assert len(ranges) == len(step_segments)
+
+    replanned = planning.plan_segment_range(step_segments, 0,
+                                            len(step_segments))
+    for (start, stop), actions in zip(ranges, replanned):
+        assert job[start:stop] == actions
+
+    n = max(range(len(ranges)), key=lambda n: ranges[n][1] - ranges[n][0])
+    start, stop = ranges[n]
+    slower, = planning.plan_segment_range(step_segments, n, n + 1,
+                                          speed_scale=0.5)
+    original = job[start:stop]
+    # Same path, but slower.
+    assert sum(a.m1 for a in slower) == sum(a.m1 for a in original)
+    assert sum(a.m2 for a in slower) == sum(a.m2 for a in original)
+    assert (sum(a.duration for a in slower) >
+            sum(a.duration for a in original))
+
+
+def test_stream_segment_actions_matches_plan_job():
+    document = utils.load_example('line.svg')
+    job = planning.plan_job(document, 'line.svg')
+    pen_up_delay, pen_down_delay = planning.calculate_pen_delays(
+        job.pen_up_position, job.pen_down_position, job.servo_speed)
+    segments = planning.stream_segment_actions(document,
+                                               pen_up_delay=pen_up_delay,
+                                               pen_down_delay=pen_down_delay)
+    streamed = []
+    for actions in planning.PlanBuffer(segments, size=2):
+        streamed.extend(actions)
+    assert job == streamed
+
+
+def test_plan_buffer_reraises_errors():
+    def items():
+        yield 1
+        raise ValueError('planner failed')
+
+    buffered = iter(planning.PlanBuffer(items()))
+    assert next(buffered) == 1
+    with pytest.raises(ValueError):
+        next(buffered)
+
+
+def test_parallel_plan_job_matches_serial():
+    document = utils.load_example('worldmap.svg')
+    serial = planning.plan_job(document, 'worldmap.svg')
+    parallel = planning.plan_job(document, 'worldmap.svg', workers=2)
+    assert parallel == serial
+
+
+def test_parallel_plan_job_without_shared_memory(monkeypatch):
+    from .. import parallel
+    monkeypatch.setattr(parallel, 'available', False)
+    document = utils.load_example('line.svg')
+    assert (planning.plan_job(document, 'line.svg', workers=2) ==
+            planning.plan_job(document, 'line.svg'))
+
+
+def test_planner_config():
+    document = utils.load_example('line.svg')
+    default = planning.PlannerConfig.default()
+    assert default.speed_pen_down == config.SPEED_PEN_DOWN
+    with pytest.raises(AttributeError):
+        default.speed_pen_down = 1
+
+    slow = default._replace(speed_pen_down=default.speed_pen_down / 2)
+    job = planning.plan_job(document, 'line.svg')
+    slow_job = planning.plan_job(document, 'line.svg', planner_config=slow)
+    assert slow_job.duration() > job.duration()
+    # The module config is untouched.
+    assert planning.plan_job(document, 'line.svg') == job
+
+
+def test_interpolate_moves_memoized():
+    planning.clear_interpolation_cache()
+    vmax = config.SPEED_PEN_DOWN
+    expected = planning.dtarray_to_moves(
+        (100, 200), (400, 300),
+        planning.interpolate_pair((100, 200), 0, (400, 300), vmax / 2, False))
+    moves = planning.interpolate_moves((100, 200), 0, (400, 300), vmax / 2,
+                                       False)
+    assert list(moves) == expected
+    # The same stroke somewhere else reuses the same moves.
+    again = planning.interpolate_moves((0, 0), 0, (300, 100), vmax / 2, False)
+    assert again is moves
+    stats = planning.interpolation_cache_stats()
+    assert stats['moves'] == {'hits': 1, 'misses': 1, 'size': 1}
+
+
+def test_merge_short_moves():
+    # Dense points along a straight line merge into hops of at least min_dist.
+    line = [(n * 10, 0) for n in range(21)]
+    merged = planning.merge_short_moves(line, 50, 1)
+    assert merged[0] == line[0] and merged[-1] == line[-1]
+    assert merged == [(0, 0), (50, 0), (100, 0), (150, 0), (200, 0)]
+
+    # A sharp corner is out of tolerance, so it's kept.
+    corner = [(0, 0), (10, 0), (20, 0), (20, 10), (20, 20)]
+    assert (20, 0) in planning.merge_short_moves(corner, 50, 1)
+
+    # The tip of a stroke which doubles back is kept, even though it lies on
+    # the line through the chord.
+    back = [(0, 0), (100, 0), (50, 0), (50, 50)]
+    assert planning.merge_short_moves(back, 187, 4) == back
+    hairpin = [(0, 0), (120, 0), (60, 2), (0, 4), (0, 200)]
+    assert (120, 0) in planning.merge_short_moves(hairpin, 187, 4)
+
+    # Every dropped point stays within tolerance of the new path.
+    curve = [(int(1000 * math.cos(n / 50.)), int(1000 * math.sin(n / 50.)))
+             for n in range(100)]
+    merged = planning.merge_short_moves(curve, 100, 4)
+    assert len(merged) < len(curve)
+    for point in curve:
+        assert min(svg.point_line_distance(a, b, point)
+                   for a, b in zip(merged, merged[1:])) <= 4
+
+
+def test_collapse_collinear():
+    # Long hops which wobble by less than the tolerance collapse to one move.
+    wobble = [(n * 200, n % 2) for n in range(31)]
+    assert planning.collapse_collinear(wobble, 2) == [(0, 0), (6000, 0)]
+    assert planning.collapse_collinear(wobble, 0.25) == wobble
+
+    # A path which doubles back keeps its turning point.
+    back = [(0, 0), (100, 0), (200, 0), (100, 0), (0, 0)]
+    assert planning.collapse_collinear(back, 1) == [(0, 0), (200, 0),
+                                                    (0, 0)]
+
+    # Every dropped point stays within tolerance of the new path.
+    curve = [(int(10000 * math.cos(n / 100.)),
+              int(10000 * math.sin(n / 100.))) for n in range(300)]
+    collapsed = planning.collapse_collinear(curve, 4)
+    assert collapsed[0] == curve[0] and collapsed[-1] == curve[-1]
+    assert len(collapsed) < len(curve)
+    for point in curve:
+        assert min(svg.point_line_distance(a, b, point)
+                   for a, b in zip(collapsed, collapsed[1:])) <= 4
+
+
+def test_jump_speed():
+    vjump = 0.05 * config.SPEED_SCALE
+    jumpy = planning.PlannerConfig.default()._replace(jump_speed=vjump)
+    # Short moves from rest jump straight to the jump speed.
+    dtarray = planning.interpolate_distance(10, 0, 0, vmax, accel_max,
+                                            timeslice, vjump)
+    assert dtarray == [(10, timeslice)]
+    dtarray = planning.interpolate_distance(100, 0, 0, vmax, accel_max,
+                                            timeslice, vjump)
+    assert dtarray == [(100, 100 / vjump)]
+
+    # A reversal has to slow to half the jump speed, since the velocity
+    # change is twice the speed.
+    v = planning.jump_cornering_speed(0, vjump)
+    assert v == pytest.approx(vjump / 2)
+    assert planning.jump_cornering_speed(math.pi, vjump) == math.inf
+
+    limits = planning.segment_corner_limits([(0, 0), (100, 0), (0, 0)],
+                                            False, planner_config=jumpy)
+    assert [v for point, v in limits] == pytest.approx([vjump, vjump / 2,
+                                                        vjump])
+
+
+def test_motor_limits():
+    default = planning.PlannerConfig.default()
+    motor = default._replace(motor_limits=True)
+    vmax, accel_rate = planning.speed_limits(False)
+
+    # Diagonals already run the busier motor at its limit, axis-aligned moves
+    # can go faster.
+    diagonal = planning.direction_limits((0, 0), (100, 100), False,
+                                         planner_config=motor)
+    assert diagonal == pytest.approx((vmax, accel_rate))
+    axis = planning.direction_limits((0, 0), (0, 100), False,
+                                     planner_config=motor)
+    assert axis == pytest.approx((math.sqrt(2) * vmax,
+                                  math.sqrt(2) * accel_rate))
+    assert planning.direction_limits((0, 0), (0, 100), False) == \
+        (vmax, accel_rate)
+
+    segments = [([(0, 0), (8000, 0), (8000, 8000), (0, 0)], False)]
+
+    def moves(planner_config):
+        actions = planning.plan_actions(
+            planning.plan_speed(segments, planner_config=planner_config),
+            pen_up_delay=0, pen_down_delay=0, planner_config=planner_config)
+        return [a for a in actions if isinstance(a, XYMove)]
+
+    faster = moves(motor)
+    assert (sum(a.duration for a in faster) <
+            sum(a.duration for a in moves(default)))
+    for move in faster:
+        # Allow for rounding the durations to whole milliseconds.
+        motor_speed = max(abs(move.m1), abs(move.m2)) / move.duration
+        assert motor_speed <= math.sqrt(2) * vmax * 1.03
+
+
+def test_max_step_rate_with_override():
+    # Even with motor limits off, a fast override never steps a motor faster
+    # than the EBB can...
+    max_step_rate = config.MAX_STEP_RATE
+    vmax, accel_rate = planning.direction_limits((0, 0), (0, 100), True,
+                                                 speed_scale=1.5)
+    assert vmax == pytest.approx(max_step_rate)
+    segments = [([(0, 0), (0, 40000)], True)]
+    actions, = planning.plan_segment_range(segments, 0, 1, speed_scale=1.5)
+    for move in actions:
+        # Allow for rounding the durations to whole milliseconds.
+        motor_speed = max(abs(move.m1), abs(move.m2)) / move.duration
+        assert motor_speed <= max_step_rate * 1.03
+
+    # ...or faster than it would without the override, if that's already
+    # more.
+    unscaled, _ = planning.speed_limits(True)
+    vmax, accel_rate = planning.direction_limits((0, 0), (100, 100), True,
+                                                 speed_scale=1.5)
+    assert unscaled * math.sqrt(2) > max_step_rate
+    assert vmax == pytest.approx(unscaled)
+
+
+def test_max_step_rate_unscaled():
+    # Without an override, the cap doesn't change plans at all.
+    for pen_up in (True, False):
+        limits = planning.speed_limits(pen_up)
+        for b in ((100, 0), (100, 100), (100, 37), (-3, 100)):
+            assert planning.direction_limits((0, 0), b, pen_up) == limits
+    segments = [([(0, 0), (20000, 20000)], True)]
+    actions, = planning.plan_segment_range(segments, 0, 1)
+    speed = max(math.hypot(*planning.move_vector(move)) / move.duration
+                for move in actions)
+    assert speed == pytest.approx(config.SPEED_PEN_UP, rel=0.03)
+
+
+def test_scurve():
+    jerk_time = 50
+    for dist in (30, 3780, 9000):
+        dtarray = planning.interpolate_distance(dist, 0, 0, vmax, accel_max,
+                                                timeslice, jerk_time=jerk_time)
+        assert dtarray[-1][0] == dist
+        assert find_peak_speed(dtarray) <= vmax
+        assert all(duration >= timeslice for x, duration in dtarray)
+
+    # The speed eases in: the first slice gains less speed than constant
+    # acceleration would.
+    dtarray = planning.interpolate_distance(9000, 0, 0, vmax, accel_max,
+                                            timeslice, jerk_time=jerk_time)
+    x, duration = dtarray[0]
+    assert x / duration < accel_max * duration / 2
+
+    # Top speeds in the speed planner match the distance the S-curve needs.
+    for vstart, dist in ((0, 10), (0, 5000), (3, 50), (3, 5000)):
+        vend = planning.ramp_top_speed(vstart, dist, accel_max, jerk_time)
+        assert planning.scurve_ramp_distance(
+            vstart, vend, accel_max, jerk_time) == pytest.approx(dist)
+    assert planning.ramp_top_speed(1, 100, accel_max) == \
+        math.sqrt(2 * accel_max * 100 + 1)
+
+    scurve = planning.PlannerConfig.default()._replace(jerk_time=jerk_time)
+    document = utils.load_example('line.svg')
+    assert (planning.plan_job(document, 'line.svg',
+                              planner_config=scurve).duration() >
+            planning.plan_job(document, 'line.svg').duration())
+
+
+def test_pen_up_delay_overlaps_travel():
+    default = planning.PlannerConfig.default()
+    up, down = planning.calculate_pen_delays(60, 50, 150, default)
+    assert up < down == 66
+    assert up == math.ceil(66 * default.pen_clear_fraction) + \
+        default.pen_clear_margin
+    whole = default._replace(pen_clear_fraction=1)
+    assert planning.calculate_pen_delays(60, 50, 150, whole) == (66, 66)
+
+
+def test_asymmetric_pen_delays():
+    default = planning.PlannerConfig.default()._replace(pen_clear_fraction=1)
+    up, down = planning.calculate_pen_delays(60, 50, 100, default,
+                                             servo_down_speed=200)
+    assert (up, down) == (100, 50)
+    calibrated = default._replace(extra_pen_up_delay=-20,
+                                  extra_pen_down_delay=-80)
+    assert planning.calculate_pen_delays(60, 50, 100, calibrated,
+                                         servo_down_speed=200) == (80, 0)
+
+
+def test_short_pen_up_moves():
+    default = planning.PlannerConfig.default()
+    threshold = default.short_threshold * default.dpi_16x
+    assert planning.is_short_move([(0, 0), (100, 0)], True)
+    assert not planning.is_short_move([(0, 0), (100, 0)], False)
+    assert not planning.is_short_move([(0, 0), (threshold, 0)], True)
+
+    def duration(steps, planner_config):
+        segments = planning.plan_speed([([(0, 0), (steps, 0)], True)],
+                                       planner_config=planner_config)
+        return sum(action.duration for action in planning.plan_actions(
+            segments, pen_up_delay=0, pen_down_delay=0,
+            planner_config=planner_config))
+
+    never_short = default._replace(short_threshold=0)
+    for mm in (2, 5, 10, 20):
+        steps = int(mm / 25.4 * default.dpi_16x)
+        assert duration(steps, default) < duration(steps, never_short)
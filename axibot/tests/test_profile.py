@@ -0,0 +1,50 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import json
+import os.path
+import shutil
+import tempfile
+
+from .. import config, planning, profile
+
+
+def test_profile_overrides_config():
+    directory = tempfile.mkdtemp(prefix='axibot-test-profile-')
+    saved = {key: getattr(config, key) for key in profile.PROFILE_SETTINGS}
+    old_dir = config.PROFILE_DIR
+    config.PROFILE_DIR = directory
+    try:
+        assert profile.activate('missing') is None
+
+        profile.save('slow-servo', {'SERVO_DOWN_SPEED': 100,
+                                    'EXTRA_PEN_UP_DELAY': -5})
+        with open(profile.profile_path('slow-servo')) as f:
+            settings = json.load(f)
+        settings['NOT_A_SETTING'] = 1
+        with open(profile.profile_path('slow-servo'), 'w') as f:
+            json.dump(settings, f)
+
+        assert profile.activate('slow-servo') == {'SERVO_DOWN_SPEED': 100,
+                                                  'EXTRA_PEN_UP_DELAY': -5}
+        planner_config = planning.PlannerConfig.default()
+        assert planner_config.servo_down_speed == 100
+        assert planner_config.extra_pen_up_delay == -5
+        assert not hasattr(config, 'NOT_A_SETTING')
+    finally:
+        config.PROFILE_DIR = old_dir
+        profile.apply(saved)
+        shutil.rmtree(directory)
+
+
+def test_shortest_delay():
+    tried = []
+
+    def reliable(delay):
+        tried.append(delay)
+        return delay >= 42
+
+    delay = profile.shortest_delay(reliable, 0, 200, resolution=5)
+    assert 42 <= delay <= 47
+    assert len(tried) < 10
+    assert os.path.basename(profile.profile_path('x')) == 'x.json'
@@ -0,0 +1,394 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import asyncio
+import math
+import threading
+import time
+
+import pytest
+
+from .. import config, checkpoint, planning
+from ..action import PenUpMove, PenDownMove, XYMove
+from ..ebb import MockEiBotBoard
+from ..job import Job
+
+from . import utils
+
+server = pytest.importorskip('axibot.server')
+api = server.api
+handlers = server.handlers
+plotting = server.plotting
+State = server.State
+
+
+class App(dict):
+    """
+    Just enough of an aiohttp Application for the plotting code.
+    """
+    def __init__(self, loop):
+        dict.__init__(self)
+        self.loop = loop
+
+
+class Bot(MockEiBotBoard):
+    """
+    A mock bot which records what it was asked to do, without taking the
+    time to do it.
+    """
+    def __init__(self):
+        MockEiBotBoard.__init__(self)
+        self.moves = []
+        self.position = 0, 0
+        self.pen_is_up = True
+        # Called with the number of moves done so far before each move.
+        self.before_move = None
+
+    def do(self, move):
+        if self.before_move:
+            self.before_move(len(self.moves))
+        self.moves.append(move)
+        if isinstance(move, XYMove):
+            x, y = self.position
+            dx, dy = planning.move_vector(move)
+            self.position = x + dx, y + dy
+        elif isinstance(move, PenUpMove):
+            self.pen_is_up = True
+        elif isinstance(move, PenDownMove):
+            self.pen_is_up = False
+
+    def pen_up(self, delay):
+        self.do(PenUpMove(delay))
+
+    def pen_down(self, delay):
+        self.do(PenDownMove(delay))
+
+    def drawn_length(self):
+        length = 0
+        pen_up = True
+        for move in self.moves:
+            if isinstance(move, XYMove) and not pen_up:
+                length += math.hypot(*planning.move_vector(move))
+            elif not isinstance(move, XYMove):
+                pen_up = isinstance(move, PenUpMove)
+        return length
+
+
+class Client:
+    """
+    A connected client, which collects the messages sent to it.
+    """
+    def __init__(self):
+        self.messages = []
+
+    def send_str(self, s):
+        self.messages.append(api.Message.deserialize(s))
+
+    def received(self, msg_class):
+        return [msg for msg in self.messages if isinstance(msg, msg_class)]
+
+
+@pytest.fixture
+def app(monkeypatch, tmpdir):
+    monkeypatch.setattr(config, 'CHECKPOINT_DIR',
+                        str(tmpdir.join('checkpoints')))
+    loop = asyncio.new_event_loop()
+    app = App(loop)
+    server.setup_state(app, Bot(), use_cache=False)
+    app['client'] = client = Client()
+    app['clients'].add(client)
+    yield app
+    loop.close()
+
+
+def run_until(app, condition, timeout=30):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "Timed out."
+        app.loop.run_until_complete(asyncio.sleep(0.01))
+
+
+def run_until_idle(app):
+    run_until(app, lambda: not asyncio.all_tasks(app.loop))
+
+
+def send(app, msg):
+    app.loop.run_until_complete(
+        handlers.handle_user_message(app, app['client'], msg))
+
+
+def wait(condition, timeout=30):
+    # For the bot's thread, while the event loop runs.
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "Timed out."
+        time.sleep(0.001)
+
+
+def keep_up_with_replanner(app, override=None):
+    """
+    Make the bot wait for each window of segments the replanner has started
+    on, as if plotting took long enough for replanning to keep up. If
+    ``override`` is a tuple of (move count, percent), the bot also sets the
+    speed override to ``percent`` after that many moves.
+    """
+    count, percent = override or (None, None)
+
+    def before_move(n):
+        if n == count:
+            asyncio.run_coroutine_threadsafe(
+                handlers.handle_user_message(
+                    app, app['client'], api.SetSpeedOverrideMessage(percent)),
+                app.loop)
+            wait(lambda: app['speed_override'] == percent / 100.)
+        replanner = app['replanner']
+        if replanner:
+            wait(lambda: replanner.step_segments is not None)
+            wait(lambda: not replanner.pending)
+
+    app['bot'].before_move = before_move
+
+
+def displacement(actions):
+    x, y = 0, 0
+    for action in actions:
+        if isinstance(action, XYMove):
+            dx, dy = planning.move_vector(action)
+            x, y = x + dx, y + dy
+    return x, y
+
+
+def plot_time(bot):
+    return sum(move.time() for move in bot.moves) / 1000.
+
+
+def plot_job(job, start=0):
+    """
+    Return a bot which has done the actions of ``job`` from ``start`` on.
+    """
+    bot = Bot()
+    if not job.pen_up_at(start):
+        bot.pen_down(0)
+    for n in range(start, len(job)):
+        bot.do(job[n])
+    return bot
+
+
+def plan_example(app, filename):
+    return planning.plan_job(utils.load_example(filename), filename,
+                             planner_config=app['planner_config'])
+
+
+def test_planning_fails_while_plotting(app, monkeypatch):
+    stream = planning.stream_segment_actions
+
+    def failing_stream(*args, **kwargs):
+        for n, actions in enumerate(stream(*args, **kwargs)):
+            if n == 10:
+                # Fail once plotting is well under way.
+                wait(lambda: app['bot'].drawn_length() > 0)
+                raise RuntimeError("Planner failed.")
+            yield actions
+
+    monkeypatch.setattr(planning, 'stream_segment_actions', failing_stream)
+    monkeypatch.setattr(config, 'PLAN_BUFFER_SIZE', 2)
+    send(app, api.SetDocumentMessage(filename='circles.svg',
+                                     document=utils.load_example(
+                                         'circles.svg')))
+    run_until(app, lambda: app['planning_job'] and len(app['job']))
+    job = app['job']
+    send(app, api.ResumePlottingMessage())
+    run_until_idle(app)
+
+    # The part that was planned is abandoned, rather than finished as if it
+    # were the whole document...
+    client = app['client']
+    bot = app['bot']
+    assert [msg.text for msg in client.received(api.ErrorMessage)] == \
+        ["Planner failed."]
+    assert not client.received(api.CompletedJobMessage)
+    assert app['state'] == State.idle
+    assert bot.position == (0, 0)
+    assert bot.pen_is_up
+    # ...and never checkpointed, or plotted again.
+    assert checkpoint.load() is None
+    send(app, api.ResumePlottingMessage())
+    assert app['job'] is job
+    assert app['state'] == State.idle
+    assert client.received(api.ErrorMessage)[-1].text == \
+        "Cannot plot a document which failed to plan."
+
+
+def test_replanner_window(app, monkeypatch):
+    monkeypatch.setattr(config, 'REPLAN_WINDOW', 3)
+    job = plan_example(app, 'rectangles.svg')
+    replanner = plotting.Replanner(app, job)
+    run_until(app, lambda: replanner.step_segments is not None)
+    assert sorted(replanner.starts.values()) == \
+        [n for n, (start, stop) in enumerate(replanner.ranges)
+         if start != stop]
+    first = min(replanner.starts)
+    n = replanner.starts[first]
+
+    # Nothing is replanned without an override.
+    assert replanner.take(first, 1.0) is None
+    assert not replanner.pending
+
+    # Reaching a segment replans a window of the segments after it, in the
+    # background.
+    assert replanner.take(first, 1.5) is None
+    assert replanner.pending
+    run_until(app, lambda: not replanner.pending)
+    window = range(n + 1, min(n + 1 + config.REPLAN_WINDOW,
+                              len(replanner.ranges)))
+    assert sorted(replanner.planned) == list(window)
+
+    # A replanned segment is swapped in for the job's own actions, ending up
+    # in the same place, but sooner.
+    start, stop = replanner.ranges[n + 1]
+    end, actions = replanner.take(start, 1.5)
+    assert end == stop
+    x0, y0 = job.position_at(start)
+    x1, y1 = job.position_at(stop)
+    assert displacement(actions) == (x1 - x0, y1 - y0)
+    duration = sum(action.time() for action in actions)
+    assert duration < job.time_at(stop) - job.time_at(start)
+    assert n + 1 not in replanner.planned
+    run_until(app, lambda: not replanner.pending)
+
+    # Changing the override throws away what was planned for the old one.
+    start, stop = replanner.ranges[n + 2]
+    assert replanner.take(start, 0.5) is None
+    assert replanner.scale == 0.5
+    assert not replanner.planned
+    run_until(app, lambda: not replanner.pending)
+    assert min(replanner.planned) == n + 3
+
+
+@pytest.mark.parametrize('percent', [150, 50])
+def test_override_mid_job(app, monkeypatch, percent):
+    monkeypatch.setattr(config, 'REPLAN_WINDOW', 3)
+    job = plan_example(app, 'rectangles.svg')
+    handlers.set_job(app, job)
+    keep_up_with_replanner(app, override=(len(job) // 4, percent))
+    send(app, api.ResumePlottingMessage())
+    run_until_idle(app)
+
+    # The rest of the job was plotted at the new speed...
+    bot = app['bot']
+    assert app['replanner'].job is job
+    ratio = plot_time(bot) / job.duration().total_seconds()
+    if percent > 100:
+        assert ratio < 0.99
+    else:
+        assert ratio > 1.1
+
+    # ...without changing what was drawn.
+    assert app['client'].received(api.CompletedJobMessage)
+    assert bot.position == job.position_at(len(job))
+    assert bot.drawn_length() == pytest.approx(plot_job(job).drawn_length(),
+                                               rel=0.005)
+    assert checkpoint.load() is None
+
+
+def test_override_while_planning(app, monkeypatch):
+    stream = planning.stream_segment_actions
+    planned = threading.Event()
+
+    def slow_stream(*args, **kwargs):
+        for n, actions in enumerate(stream(*args, **kwargs)):
+            if n == 4:
+                planned.wait(10)
+            yield actions
+
+    monkeypatch.setattr(planning, 'stream_segment_actions', slow_stream)
+    monkeypatch.setattr(config, 'PLAN_BUFFER_SIZE', 2)
+    monkeypatch.setattr(config, 'REPLAN_WINDOW', 3)
+    send(app, api.SetDocumentMessage(filename='rectangles.svg',
+                                     document=utils.load_example(
+                                         'rectangles.svg')))
+    run_until(app, lambda: app['planning_job'] and len(app['job']))
+    job = app['job']
+    send(app, api.ResumePlottingMessage())
+
+    # A job which is still being planned can't be replanned yet...
+    send(app, api.SetSpeedOverrideMessage(150))
+    assert app['speed_override'] == 1.5
+    assert app['replanner'] is None
+
+    # ...so it's replanned once planning is done.
+    keep_up_with_replanner(app)
+    planned.set()
+    run_until_idle(app)
+    assert app['replanner'].job is job
+    bot = app['bot']
+    assert plot_time(bot) < 0.99 * job.duration().total_seconds()
+    assert app['client'].received(api.CompletedJobMessage)
+    assert bot.position == job.position_at(len(job))
+    assert bot.drawn_length() == pytest.approx(plot_job(job).drawn_length(),
+                                               rel=0.005)
+
+
+def test_resume_at_time(app):
+    job = plan_example(app, 'rectangles.svg')
+    handlers.set_job(app, job)
+    seconds = job.duration().total_seconds() / 2
+    index = job.index_at_time(seconds * 1000)
+    assert job.pen_up_at(index) is False
+    send(app, api.ResumePlottingMessage(seconds=seconds))
+    run_until_idle(app)
+
+    # Only the rest of the job was plotted, starting partway through a line.
+    bot = app['bot']
+    client = app['client']
+    assert client.received(api.CompletedJobMessage)
+    assert bot.position == job.position_at(len(job))
+    assert bot.drawn_length() == pytest.approx(
+        plot_job(job, index).drawn_length(), rel=0.005)
+
+    # Progress is reported through the job, not from when plotting resumed.
+    states = [msg for msg in client.received(api.StateMessage)
+              if (msg.state == 'plotting') and (msg.action_index > index)]
+    assert states
+    assert states[0].consumed_time >= seconds
+    for msg in states:
+        assert msg.consumed_time == job.time_at(msg.action_index) / 1000.
+        assert msg.estimated_time == job.duration().total_seconds()
+
+
+def test_resume_empty_job_at_time(app, monkeypatch):
+    planner_config = app['planner_config']
+    empty = Job(pen_up_position=planner_config.pen_up_position,
+                pen_down_position=planner_config.pen_down_position,
+                servo_speed=planner_config.servo_speed)
+    handlers.set_job(app, empty)
+    send(app, api.ResumePlottingMessage(seconds=10))
+    run_until_idle(app)
+    assert app['client'].received(api.CompletedJobMessage)
+    assert app['state'] == State.idle
+    assert app['bot'].position == (0, 0)
+
+    # Likewise for a document which hasn't planned any actions yet.
+    stream = planning.stream_segment_actions
+    planned = threading.Event()
+
+    def slow_stream(*args, **kwargs):
+        planned.wait(10)
+        for actions in stream(*args, **kwargs):
+            yield actions
+
+    monkeypatch.setattr(planning, 'stream_segment_actions', slow_stream)
+    send(app, api.SetDocumentMessage(filename='rectangles.svg',
+                                     document=utils.load_example(
+                                         'rectangles.svg')))
+    run_until(app, lambda: app['planning_job'] is not None)
+    job = app['job']
+    assert len(job) == 0
+    send(app, api.ResumePlottingMessage(seconds=10))
+    assert app['action_index'] == 0
+    planned.set()
+    run_until_idle(app)
+    assert len(app['client'].received(api.CompletedJobMessage)) == 2
+    assert app['bot'].position == job.position_at(len(job))
+    assert app['bot'].drawn_length() == pytest.approx(
+        plot_job(job).drawn_length(), rel=0.005)
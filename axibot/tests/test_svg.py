@@ -1,6 +1,7 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 import os.path
+import math
 
 from .. import svg, config
 
@@ -19,3 +20,82 @@ def test_smoke():
 
     segments = svg.add_pen_up_moves(segments)
     assert segments
+
+
+def test_bridge_gaps():
+    segments = [[(0, 0), (1, 0)],
+                [(1.005, 0), (2, 0)],
+                [(2, 1), (3, 1)]]
+    bridged = svg.bridge_gaps(segments, min_gap=0.01)
+    assert bridged == [[(0, 0), (1, 0), (1.005, 0), (2, 0)],
+                       [(2, 1), (3, 1)]]
+    # The input isn't modified.
+    assert segments[0] == [(0, 0), (1, 0)]
+
+    # Only bridge over ink which has already been drawn.
+    segments = [[(0, 0), (2, 0)],
+                [(1, 1), (1, 0.001)],
+                [(1, -0.001), (1, -1)],
+                [(1.005, -1), (1.5, -2)]]
+    bridged = svg.bridge_gaps(segments, min_gap=0.01, tolerance=0.001)
+    assert len(bridged) == 3
+    assert bridged[1] == segments[1] + segments[2]
+
+
+def test_simplify_segment():
+    # A corner survives, the wobble either side of it doesn't.
+    points = [(0, 0), (1, 0.0001), (2, 0), (2.0001, 1), (2, 2)]
+    assert svg.simplify_segment(points, 0.001) == [(0, 0), (2, 0), (2, 2)]
+    assert svg.simplify_segment(points, 0.00001) == points
+
+    # Long paths take the array version, with the same guarantee that every
+    # dropped point is within tolerance of the simplified path.
+    curve = [(math.cos(n / 100.), math.sin(n / 100.)) for n in range(300)]
+    simplified = svg.simplify_segment(curve, 0.0005)
+    assert simplified[0] == curve[0] and simplified[-1] == curve[-1]
+    assert len(simplified) < len(curve) / 4
+    for point in curve:
+        assert min(svg.point_line_distance(a, b, point)
+                   for a, b in zip(simplified, simplified[1:])) <= 0.0005
+
+
+def test_join_paths():
+    from svg.path import Path, Line, CubicBezier
+    curve = CubicBezier(2 + 0j, 3 + 1j, 4 + 1j, 5 + 0j)
+    paths = [Path(Line(0j, 1 + 0j), Line(1 + 0j, 2 + 0j)),
+             Path(Line(9 + 9j, 8 + 8j)),
+             Path(CubicBezier(curve.end, curve.control2, curve.control1,
+                              curve.start))]
+    joined = svg.join_paths(paths, 0.001)
+    assert len(joined) == 2
+    path = joined[0]
+    assert path[0].start == 0j and path[-1].end == 5 + 0j
+    # The reversed curve is the same shape, traversed the other way.
+    for t in (0, 0.3, 0.5, 1):
+        assert abs(path[-1].point(t) - curve.point(t)) < 1e-9
+    assert joined[1] is paths[1]
+
+
+def test_remove_overlaps():
+    from svg.path import Path, Line, CubicBezier
+    # Two squares sharing an edge, drawn in opposite directions.
+    left = Path(Line(0j, 1 + 0j), Line(1 + 0j, 1 + 1j), Line(1 + 1j, 1j),
+                Line(1j, 0j))
+    right = Path(Line(1 + 0j, 2 + 0j), Line(2 + 0j, 2 + 1j),
+                 Line(2 + 1j, 1 + 1j), Line(1 + 1j, 1 + 0j))
+    paths, removed = svg.remove_overlaps([left, right], 2032)
+    assert abs(removed - 1) < 1e-9
+    assert list(paths[0]) == list(left)
+    assert list(paths[1]) == list(right)[:3]
+
+    # Only the overlapping part of a line is removed, and curves are kept.
+    curve = CubicBezier(0j, 1j, 1 + 1j, 1 + 0j)
+    paths, removed = svg.remove_overlaps(
+        [Path(Line(0j, 2 + 0j)), Path(Line(3 + 0j, 1 + 0j), curve)], 2032)
+    assert abs(removed - 1) < 1e-9
+    assert list(paths[1]) == [Line(3 + 0j, 2 + 0j), curve]
+
+    # Lines which round to the same motor steps overlap.
+    paths, removed = svg.remove_overlaps(
+        [Path(Line(0j, 1 + 0j)), Path(Line(0.0001j, 1 + 0.0001j))], 2032)
+    assert len(paths) == 1
@@ -2,3 +2,8 @@ import os.path
 
 __here__ = os.path.dirname(__file__)
 example_dir = os.path.join(__here__, '..', '..', 'examples')
+
+
+def load_example(filename):
+    with open(os.path.join(example_dir, filename)) as f:
+        return f.read()
@@ -32,6 +32,7 @@ setup(name='axibot',
           'pyserial',
           'svg.path<3.0',
           'colormath',
+          'numpy',
       ],
       setup_requires=['pytest-runner'],
       tests_require=['pytest'],